@@ -1,305 +1,211 @@
 import os
+import time
+
+# Measured from the top of the script so every rerun reports how long it took
+rerun_start = time.perf_counter()
 
 os.environ['HF_HUB_DISABLE_SYMLINKS_WARNING'] = '1'
 
-import re
-import mysql.connector
+import pandas as pd
 import streamlit as st
-import google.generativeai as genai
 from dotenv import load_dotenv
-import chromadb
-from chromadb.config import Settings
 
-from sentence_transformers import SentenceTransformer  # For semantic search
-import faiss  # For efficient similarity search
-import numpy as np
+# Models, clients and the FAISS index are created once per process and shared across reruns
+import resources
+from answer_cache import answer_cache, ENABLED as ANSWER_CACHE_ENABLED
+from db_pool import pool_stats
+from result_cache import result_cache
+from embedding_cache import embedding_cache
+import telemetry
 
 # Load environment variables
 load_dotenv()
 
-# Configure Genai Key
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
-try:
-    settings = Settings(
-        chroma_api_impl="rest",
-        chroma_server_host="127.0.0.1",
-        chroma_server_http_port=8000
-    )
-    client = chromadb.Client(settings)
-    # OR alternatively use PersistentClient:
-    # client = chromadb.PersistentClient(path="./chroma_db")
-    
-    db_collection = client.get_or_create_collection("query_embeddings")
-    st.success("Connected to ChromaDB successfully!")
-except Exception as e:
-    st.error(f"Failed to connect to ChromaDB: {e}")
-    st.error("Please make sure the ChromaDB server is running")
-
-transformer_model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
-
+# With SERVICE_URL set the question flow runs in service.py's workers and this script
+# is only a client; otherwise it runs pipeline.py in this process
+SERVICE_URL = os.getenv("SERVICE_URL", "")
 
+if SERVICE_URL:
+    from service_client import ServiceClient, ServiceError
+    service = resources.get_or_create("service_client", lambda: ServiceClient(SERVICE_URL))
+    answer_question = service.answer_question
+else:
+    # The question flow itself lives in pipeline.py; this script only renders it
+    from pipeline import answer_question
+    service = None
 
-# Function to load Google Gemini Model and provide queries as response
-def get_gemini_response(question, prompt):
     try:
-        model = genai.GenerativeModel('gemini-pro')
-        response = model.generate_content([prompt, question])
-        return response.text.strip()
+        db_collection = resources.get_db_collection()
+        st.success("Connected to ChromaDB successfully!")
     except Exception as e:
-        st.error(f"Error generating response from Gemini model: {e}")
-        return None
+        st.error(f"Failed to connect to ChromaDB: {e}")
+        st.error("Please make sure the ChromaDB server is running")
 
-# Function to retrieve query from the database
+    # Load the embedding model and index in the background on first run
+    resources.warm_up()
 
+    # Prometheus metrics on METRICS_PORT, one server per process
+    resources.get_or_create("metrics_server", telemetry.serve_metrics)
 
-# Function to retrieve query from the database
-def execute_query(query, host, user, password, database):
-    try:
-        connection = mysql.connector.connect(
-            host=host,
-            user=user,
-            password=password,
-            database=database
-        )
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute(f"USE {database};")  # Explicitly select the database
-        cursor.execute(query)
-        result = cursor.fetchall()
-        cursor.close()
-        connection.close()
-        return result
-    except mysql.connector.Error as e:
-        st.error(f"Database error: {e}")
-        # print(f"Database error: {e}")
-        # if e.errno == mysql.connector.errorcode.ER_BAD_DB_ERROR:
-        #     print("Database does not exist")
-        # elif e.errno == mysql.connector.errorcode.ER_ACCESS_DENIED_ERROR:
-        #     print("Username or password is incorrect")
-        # else:
-        #     print(f"Error: {e}")
-        return None
-
-def semantic_search(question, db_collection, top_k=3):
-    question_embedding = transformer_model.encode([question])  # Embed the question
-
-    stored_data = db_collection.get()
-    if not stored_data or 'embeddings' not in stored_data or len(stored_data['embeddings']) == 0:
-        st.warning("No embeddings found in ChromaDB.")
-        return []
-
-    stored_embeddings = np.array(stored_data['embeddings'])
-
-    index = faiss.IndexFlatL2(question_embedding.shape[1])  # Faiss index
-    index.add(stored_embeddings)
-
-    distances, indices = index.search(question_embedding, top_k)  # Search for top_k similar queries
-    return [db_collection.get_item(idx) for idx in indices[0]]  # Return top_k closest results
-
-
-# Define Few-Shot Examples
-few_shot_examples = [
-    {
-        "question": "What is the average rental duration for all films?",
-        "sql_query": "SELECT AVG(rental_duration) AS average_rental_duration FROM film;",
-        "expected_result": "The average rental duration for all films is 4.98 days."
-    },
-    {
-        "question": "List all the film titles.",
-        "sql_query": "SELECT title FROM film;",
-        "expected_result": "Here are the titles of all films in the database."
-    },
-    {
-        "question": "How many films are there in each category?",
-        "sql_query": """
-            SELECT category.name AS category_name, COUNT(f.film_id) AS num_films
-            FROM category c
-            JOIN film_category fc ON c.category_id = fc.category_id
-            JOIN film f ON fc.film_id = f.film_id
-            GROUP BY c.name;
-        """,
-        "expected_result": "Here is the count of films in each category."
-    },
-    {
-        "question": "Show the top 5 films with the longest rental duration.",
-        "sql_query": """
-            SELECT title, rental_duration
-            FROM film
-            ORDER BY rental_duration DESC
-            LIMIT 5;
-        """,
-        "expected_result": "Here are the top 5 films with the longest rental duration."
-    },
-    {
-        "question": "What is the total revenue generated from film rentals?",
-        "sql_query": """
-            SELECT SUM(p.amount) AS total_revenue
-            FROM payment p
-            JOIN rental r ON p.rental_id = r.rental_id;
-        """,
-        "expected_result": "The total revenue generated from film rentals is $XXXX."
-    }
-]
-
-# Construct Prompt Template for Few-Shot Learning
-def construct_prompt_template(few_shot_examples):
-    prompt = """
-        You are interacting with the Sakila database, which contains several key tables:
-        
-        1. **Actor:**
-           - `actor_id` (INT): Primary key, unique identifier for each actor.
-           - `first_name` (VARCHAR): First name of the actor.
-           - `last_name` (VARCHAR): Last name of the actor.
-           - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        2. **Film:**
-           - `film_id` (INT): Primary key, unique identifier for each film.
-           - `title` (VARCHAR): Title of the film.
-           - `description` (TEXT): Description or summary of the film.
-           - `release_year` (YEAR): Year of the film's release.
-           - `language_id` (TINYINT): Foreign key referencing `language.language_id`.
-           - `rental_duration` (TINYINT): Number of days the film can be rented.
-           - `rental_rate` (DECIMAL): Rental rate per day for the film.
-           - `length` (SMALLINT): Duration of the film in minutes.
-           - `replacement_cost` (DECIMAL): Cost to replace the film if lost or damaged.
-           - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        3. **Film_Actor:**
-           - `actor_id` (INT): Foreign key referencing `actor.actor_id`.
-           - `film_id` (INT): Foreign key referencing `film.film_id`.
-           - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        4. **Category:**
-           - `category_id` (INT): Primary key, unique identifier for each category.
-           - `name` (VARCHAR): Name of the category.
-           - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        5. **Film_Category:**
-           - `film_id` (INT): Foreign key referencing `film.film_id`.
-           - `category_id` (INT): Foreign key referencing `category.category_id`.
-           - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        6. **Language:**
-           - `language_id` (TINYINT): Primary key, unique identifier for each language.
-           - `name` (CHAR): Name of the language.
-           - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        7. **Inventory:**
-           - `inventory_id` (INT): Primary key, unique identifier for each inventory item.
-           - `film_id` (INT): Foreign key referencing `film.film_id`.
-           - `store_id` (INT): Foreign key referencing `store.store_id`.
-           - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        8. **Store:**
-           - `store_id` (INT): Primary key, unique identifier for each store.
-           - `manager_staff_id` (INT): Foreign key referencing `staff.staff_id`.
-           - `address_id` (INT): Foreign key referencing `address.address_id`.
-           - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        9. **Staff:**
-            - `staff_id` (INT): Primary key, unique identifier for each staff member.
-            - `first_name` (VARCHAR): First name of the staff member.
-            - `last_name` (VARCHAR): Last name of the staff member.
-            - `address_id` (INT): Foreign key referencing `address.address_id`.
-            - `email` (VARCHAR): Email address of the staff member.
-            - `store_id` (INT): Foreign key referencing `store.store_id`.
-            - `active` (BOOLEAN): Indicates if the staff member is active.
-            - `username` (VARCHAR): Username for staff login.
-            - `password` (VARCHAR): Password for staff login.
-            - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        10. **Address:**
-            - `address_id` (INT): Primary key, unique identifier for each address.
-            - `address` (VARCHAR): Street address.
-            - `district` (VARCHAR): District or region.
-            - `city_id` (INT): Foreign key referencing `city.city_id`.
-            - `postal_code` (VARCHAR): Postal code.
-            - `phone` (VARCHAR): Phone number.
-            - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        11. **City:**
-            - `city_id` (INT): Primary key, unique identifier for each city.
-            - `city` (VARCHAR): Name of the city.
-            - `country_id` (INT): Foreign key referencing `country.country_id`.
-            - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        12. **Country:**
-            - `country_id` (INT): Primary key, unique identifier for each country.
-            - `country` (VARCHAR): Name of the country.
-            - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        13. **Customer:**
-            - `customer_id` (INT): Primary key, unique identifier for each customer.
-            - `store_id` (INT): Foreign key referencing `store.store_id`.
-            - `first_name` (VARCHAR): First name of the customer.
-            - `last_name` (VARCHAR): Last name of the customer.
-            - `email` (VARCHAR): Email address of the customer.
-            - `address_id` (INT): Foreign key referencing `address.address_id`.
-            - `active` (BOOLEAN): Indicates if the customer is active.
-            - `create_date` (DATETIME): Date the customer was created.
-            - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        14. **Rental:**
-            - `rental_id` (INT): Primary key, unique identifier for each rental.
-            - `rental_date` (DATETIME): Date and time the rental was made.
-            - `inventory_id` (INT): Foreign key referencing `inventory.inventory_id`.
-            - `customer_id` (INT): Foreign key referencing `customer.customer_id`.
-            - `return_date` (DATETIME): Date and time the rental was returned.
-            - `staff_id` (INT): Foreign key referencing `staff.staff_id`.
-            - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        15. **Payment:**
-            - `payment_id` (INT): Primary key, unique identifier for each payment.
-            - `customer_id` (INT): Foreign key referencing `customer.customer_id`.
-            - `staff_id` (INT): Foreign key referencing `staff.staff_id`.
-            - `rental_id` (INT): Foreign key referencing `rental.rental_id`.
-            - `amount` (DECIMAL): Amount of the payment.
-            - `payment_date` (DATETIME): Date and time of the payment.
-            - `last_update` (TIMESTAMP): Timestamp of the last update.
-
-        You will be provided with questions, and your task is to generate the appropriate SQL query to retrieve the required data from the Sakila database.
-
-        Here are some examples:
-
-    """
-    for example in few_shot_examples:
-        prompt += f"    \n\nQuestion: {example['question']}\n    SQL Query: {example['sql_query']}\n    Expected Result: {example['expected_result']}"
-    
-    return prompt
 
 # Streamlit App Interface
 st.title("Sakila Database Query Assistant")
 question = st.text_input("Enter your question about the Sakila database:")
-prompt_template = construct_prompt_template(few_shot_examples)
+use_answer_cache = st.checkbox("Reuse SQL from near-identical past questions", value=ANSWER_CACHE_ENABLED)
+show_timing_panel = telemetry.ENABLED and st.checkbox("Show timing panel", value=False)
+
+result = None
 
 if st.button("Generate Query"):
     if question:
-        # Get Gemini response
-        similar_queries = semantic_search(question,db_collection)
-        st.markdown("### Similar Queries Found:")
-        for q in similar_queries:
-            st.write(q['question'], " -> ", q['sql_query'])
-
-        gemini_response = get_gemini_response(question, prompt_template)
-        if gemini_response:
+        # Show the model's reply as it streams in; replaced by the full result below
+        live_response = st.empty()
+
+        def show_progress(kind, value):
+            if kind == "llm_text":
+                live_response.code(value, language="sql")
+
+        result = answer_question(question, use_answer_cache, on_event=show_progress)
+        render_start = time.perf_counter()
+        live_response.empty()
+        for warning in result["warnings"]:
+            st.warning(warning)
+
+        if result["similar_queries"]:
+            st.markdown("### Similar Queries Found:")
+            for q in result["similar_queries"]:
+                st.write(q['question'], " -> ", q['sql_query'])
+
+        if result["cached_answer"]:
+            st.info(f"Reusing SQL from a similar past question: {result['cached_answer']['question']}")
+        elif result["prompt_info"]:
+            prompt_info = result["prompt_info"]
+            st.caption(
+                f"Prompt: ~{prompt_info['prompt_tokens']} tokens "
+                f"(full schema and examples: ~{prompt_info['full_prompt_tokens']}), "
+                f"tables: {', '.join(prompt_info['tables'])}"
+            )
+
+        if result["response"]:
             st.markdown("### Generated SQL Query:")
-            st.code(gemini_response, language="sql")
-            # Extract SQL query using regex (improve regex as needed)
-            match = re.search(r"(WITH|SELECT|INSERT|UPDATE|DELETE|CREATE|DROP|ALTER)\s+.*?;", gemini_response, re.DOTALL)
-            if match:
-                sql_query = match.group(0)
-                st.markdown("### Extracted SQL Query:")
-                st.code(sql_query, language="sql")
-                # Execute SQL query on Sakila database
-                results = execute_query(sql_query, "localhost", "root", "root", "sakila1")
-                if results:
-                    st.markdown("### Query Results:")
-                    st.write(results)
-                else:
-                    st.error("No results found or error executing query.")
-            else:
-                st.error("Could not extract SQL query from Gemini response.")
+            st.code(result["response"], language="sql")
+        if result["sql"]:
+            st.markdown("### Extracted SQL Query:")
+            st.code(result["sql"], language="sql")
+        if result["executed_sql"] and result["executed_sql"] != result["sql"]:
+            st.caption("Executed as:")
+            st.code(result["executed_sql"], language="sql")
+
+        previous = st.session_state.pop("pager", None)
+        if previous:
+            previous.close()
+        if result["error"]:
+            st.error(result["error"])
+        elif result["pager"] and result["pager"].rows:
+            st.session_state["pager"] = result["pager"]
         else:
-            st.error("No response generated from Gemini model.")
+            st.error("No results found or error executing query.")
+
+        st.caption(" | ".join(f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in result["timings"].items()))
     else:
         st.warning("Please enter a question.")
+
+# Results stay in the session so further pages can be fetched on later reruns
+pager = st.session_state.get("pager")
+if pager:
+    st.markdown("### Query Results:")
+    table = st.empty()
+    status = st.empty()
+    load_error = None
+    if not pager.exhausted and st.button("Load more rows"):
+        try:
+            pager.fetch_next()
+        except Exception as e:
+            # A database or service error on a later page; keep the rows already loaded
+            load_error = e
+            pager.close()
+    table.dataframe(pd.DataFrame.from_records(pager.rows, columns=pager.columns))
+    if load_error is not None:
+        status.error(f"Could not load more rows: {load_error}")
+    elif pager.truncated:
+        status.warning(f"Showing the first {len(pager.rows)} rows; the result was cut off at the row/size limit.")
+    else:
+        status.caption(f"{len(pager.rows)} rows" + ("" if pager.exhausted else " loaded so far"))
+
+# Render time goes to the metrics and the panel; the trace log entry was already
+# written when the pipeline finished
+if result is not None:
+    result["trace"].add_span("render", time.perf_counter() - render_start)
+    if show_timing_panel and result["trace"].spans:
+        st.markdown("### Timing:")
+        st.dataframe(pd.DataFrame([
+            {
+                "stage": span.name,
+                "ms": round(span.duration * 1000, 1) if span.duration is not None else None,
+                "status": span.status,
+                "attributes": ", ".join(f"{key}={value}" for key, value in span.attributes.items()),
+            }
+            for span in result["trace"].spans.values()
+        ]))
+
+# Pool, cache and LLM client figures, from this process or from the service worker
+# that answered the stats request
+if service is not None:
+    try:
+        stats = service.stats()
+        metrics_text = service.metrics()
+    except ServiceError as e:
+        st.error(f"Could not read service stats: {e}")
+        stats = metrics_text = None
+else:
+    llm_backend = resources.get_llm_backend()
+    stats = {
+        "pool": pool_stats(),
+        "result_cache": result_cache.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "llm_client": llm_backend.stats() if hasattr(llm_backend, "stats") else None,
+        "timings": resources.timings(),
+    }
+    metrics_text = telemetry.render_metrics() if telemetry.ENABLED else None
+
+# Report rerun and cold-start timings so regressions are visible
+if stats:
+    timings = stats["timings"]
+    load_times = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings["load_times"].items())
+    st.caption(
+        f"Rerun: {(time.perf_counter() - rerun_start) * 1000:.0f} ms | "
+        f"Process up: {timings['uptime']:.0f}s | Loaded: {load_times or 'nothing yet'}"
+        + (f" | Worker: {stats['pid']}" if service is not None else "")
+    )
+
+    # Connection pool size and wait counters
+    with st.expander("Connection pool"):
+        st.json(stats["pool"])
+
+    # Result cache hits, evictions and memory/disk use
+    with st.expander("Result cache"):
+        st.json(stats["result_cache"])
+
+    # Question embeddings reused instead of encoded again
+    with st.expander("Embedding cache"):
+        st.json(stats["embedding_cache"])
+
+    # Answer cache hit rate and LLM time saved
+    with st.expander("Answer cache"):
+        st.json(stats["answer_cache"])
+
+    # LLM request latency, retries, hedged requests and coalesced calls
+    if stats["llm_client"]:
+        with st.expander("LLM client"):
+            st.json(stats["llm_client"])
+
+    # Requests running and waiting in the worker, and how many were turned away
+    if service is not None:
+        with st.expander("Admission"):
+            st.json(stats["admission"])
+
+# Stage latency histograms and cache/error counters, as served on METRICS_PORT
+if metrics_text:
+    with st.expander("Metrics"):
+        st.code(metrics_text)
@@ -0,0 +1,106 @@
+import os
+import re
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import resources
+
+# Reuse the stored SQL when the closest past question is within this squared L2
+# distance. all-MiniLM-L6-v2 embeddings are unit length, so 0.1 is about cosine 0.95.
+HIT_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.1"))
+
+# New questions this close to a stored one are not written back
+DUPLICATE_THRESHOLD = float(os.getenv("ANSWER_CACHE_DUPLICATE_THRESHOLD", "0.02"))
+
+ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") != "0"
+
+
+# Cache of question -> SQL answers on top of the query_embeddings collection.
+# Lookups reuse the semantic_search results; write-back runs on a background
+# thread so the user never waits for ChromaDB or the index.
+class AnswerCache:
+    def __init__(self, hit_threshold=HIT_THRESHOLD, duplicate_threshold=DUPLICATE_THRESHOLD):
+        self.hit_threshold = hit_threshold
+        self.duplicate_threshold = duplicate_threshold
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="answer-cache")
+        self._lock = threading.Lock()
+        self._llm_latency = None
+        self._stats = {
+            "lookups": 0,
+            "hits": 0,
+            "bypassed": 0,
+            "stored": 0,
+            "duplicates_skipped": 0,
+            "store_errors": 0,
+        }
+
+    # Return the closest match if it is near enough to reuse its SQL, otherwise None
+    def lookup(self, similar_queries, bypass=False):
+        with self._lock:
+            if bypass:
+                self._stats["bypassed"] += 1
+                return None
+            self._stats["lookups"] += 1
+            if not similar_queries:
+                return None
+            best = similar_queries[0]
+            if best.get("distance", float("inf")) > self.hit_threshold or not best.get("sql_query"):
+                return None
+            self._stats["hits"] += 1
+            return best
+
+    # Keep a moving average of LLM call time so hits can be credited with the time they saved
+    def record_llm_latency(self, seconds):
+        with self._lock:
+            if self._llm_latency is None:
+                self._llm_latency = seconds
+            else:
+                self._llm_latency = 0.9 * self._llm_latency + 0.1 * seconds
+
+    # Queue a successful question/SQL pair to be added to the collection
+    def store_async(self, question, sql_query, question_embedding):
+        return self._writer.submit(self._store, question, sql_query, question_embedding)
+
+    def _store(self, question, sql_query, question_embedding):
+        try:
+            from faiss_index import add_query_embeddings
+            index = resources.get_query_index()
+            nearest = index.search(question_embedding, 1)
+            if nearest and nearest[0]["distance"] <= self.duplicate_threshold:
+                with self._lock:
+                    self._stats["duplicates_skipped"] += 1
+                return False
+            add_query_embeddings(
+                resources.get_db_collection(),
+                index,
+                [question_id(question)],
+                [list(map(float, question_embedding[0]))],
+                [{"question": question, "sql_query": sql_query}],
+            )
+            with self._lock:
+                self._stats["stored"] += 1
+            return True
+        except Exception as e:
+            print(f"Failed to store answer in cache: {e}")
+            with self._lock:
+                self._stats["store_errors"] += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+            stats["latency_saved"] = stats["hits"] * (self._llm_latency or 0.0)
+            return stats
+
+
+# Function to build a stable collection id from the normalized question text
+def question_id(question):
+    normalized = re.sub(r"\s+", " ", question.strip().lower())
+    return "q-" + hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+# Shared by every session in the process
+answer_cache = AnswerCache()
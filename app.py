@@ -1,22 +1,25 @@
 import os
 import re
+import sqlite3
 import mysql.connector
+from db_pool import get_pool, pool_stats
+from result_cache import result_cache
+from sql_guard import guard_sql, SqlGuardError, ENABLED as SQL_GUARD_ENABLED
+import pandas as pd
 import streamlit as st
-import google.generativeai as genai
 from dotenv import load_dotenv
 
+# The LLM backend is created once per process and shared across reruns
+import resources
+from pipeline import run_sync, open_results
+
 # Load environment variables
 load_dotenv()
 
-# Configure Genai Key
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
-# Function to load Google Gemini Model and provide queries as response
+# Function to ask the LLM backend (Gemini unless LLM_BACKEND says otherwise) for the query
 def get_gemini_response(question, prompt):
     try:
-        model = genai.GenerativeModel('gemini-pro')
-        response = model.generate_content([prompt, question])
-        return response.text.strip()
+        return run_sync(resources.get_llm_backend().generate(prompt, question)).strip()
     except Exception as e:
         st.error(f"Error generating response from Gemini model: {e}")
         return None
@@ -24,17 +27,8 @@ def get_gemini_response(question, prompt):
 # Function to retrieve query from the database
 def read_sql_query(sql, db):
     try:
-        conn = mysql.connector.connect(
-            host="localhost",
-            user="root",
-            password="root",
-            database=db
-        )
-        cur = conn.cursor(dictionary=True)  # Use dictionary cursor for easier result handling
-        cur.execute(sql)
-        rows = cur.fetchall()
-        conn.close()
-        return rows
+        # Shares the same pool as execute_query; rows come back as dicts
+        return get_pool("localhost", "root", "root", db).execute(sql)
     except mysql.connector.Error as e:
         st.error(f"MySQL error: {e.msg}")
         return None
@@ -42,19 +36,8 @@ def read_sql_query(sql, db):
 # Function to retrieve query from the database
 def execute_query(query, host, user, password, database):
     try:
-        connection = mysql.connector.connect(
-            host=host,
-            user=user,
-            password=password,
-            database=database
-        )
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute(f"USE {database};")  # Explicitly select the database
-        cursor.execute(query)
-        result = cursor.fetchall()
-        cursor.close()
-        connection.close()
-        return result
+        # Pooled connections already have the database selected
+        return get_pool(host, user, password, database).execute(query)
     except mysql.connector.Error as e:
         st.error(f"Database error: {e}")
         print(f"Database error: {e}")
@@ -66,6 +49,30 @@ def execute_query(query, host, user, password, database):
             print(f"Error: {e}")
         return None
 
+# Function to check generated SQL before it runs; returns the SQL to execute, or None if rejected
+def guard_query(query, host, user, password, database):
+    try:
+        guarded = guard_sql(query, get_pool(host, user, password, database))
+    except SqlGuardError as e:
+        st.error(f"Query rejected: {e}")
+        return None
+    except (mysql.connector.Error, sqlite3.Error) as e:
+        st.error(f"Query rejected: EXPLAIN failed: {e}")
+        return None
+    for warning in guarded["warnings"]:
+        st.warning(warning)
+    return guarded["sql"]
+
+# Function to stream query results page by page instead of fetching them all at once
+def stream_query(query, host, user, password, database):
+    try:
+        # Same path as the pipeline: unchanged data is served from the result cache instead
+        # of MySQL, the first page is read straight away and the run goes to the query log
+        return open_results(query, host, user, password, database)
+    except (mysql.connector.Error, sqlite3.Error) as e:
+        st.error(f"Database error: {e}")
+        return None
+
 # Define Few-Shot Examples
 few_shot_examples = [
     {
@@ -81,7 +88,7 @@ few_shot_examples = [
     {
         "question": "How many films are there in each category?",
         "sql_query": """
-            SELECT category.name AS category_name, COUNT(f.film_id) AS num_films
+            SELECT c.name AS category_name, COUNT(f.film_id) AS num_films
             FROM category c
             JOIN film_category fc ON c.category_id = fc.category_id
             JOIN film f ON fc.film_id = f.film_id
@@ -255,15 +262,50 @@ if st.button("Generate Query"):
                 st.markdown("### Extracted SQL Query:")
                 st.code(sql_query, language="sql")
                 # Execute SQL query on Sakila database
-                results = execute_query(sql_query, "localhost", "root", "root", "sakila1")
-                if results:
-                    st.markdown("### Query Results:")
-                    st.write(results)
-                else:
-                    st.error("No results found or error executing query.")
+                previous = st.session_state.pop("pager", None)
+                if previous:
+                    previous.close()
+                if SQL_GUARD_ENABLED:
+                    sql_query = guard_query(sql_query, "localhost", "root", "root", "sakila1")
+                if sql_query:
+                    pager = stream_query(sql_query, "localhost", "root", "root", "sakila1")
+                    if pager and pager.rows:
+                        st.session_state["pager"] = pager
+                    else:
+                        st.error("No results found or error executing query.")
             else:
                 st.error("Could not extract SQL query from Gemini response.")
         else:
             st.error("No response generated from Gemini model.")
     else:
         st.warning("Please enter a question.")
+
+# Results stay in the session so further pages can be fetched on later reruns
+pager = st.session_state.get("pager")
+if pager:
+    st.markdown("### Query Results:")
+    table = st.empty()
+    status = st.empty()
+    load_error = None
+    if not pager.exhausted and st.button("Load more rows"):
+        try:
+            pager.fetch_next()
+        except (mysql.connector.Error, sqlite3.Error) as e:
+            # Keep the rows already loaded; the rest of this result cannot be read
+            load_error = e
+            pager.close()
+    table.dataframe(pd.DataFrame.from_records(pager.rows, columns=pager.columns))
+    if load_error is not None:
+        status.error(f"Database error while loading more rows: {load_error}")
+    elif pager.truncated:
+        status.warning(f"Showing the first {len(pager.rows)} rows; the result was cut off at the row/size limit.")
+    else:
+        status.caption(f"{len(pager.rows)} rows" + ("" if pager.exhausted else " loaded so far"))
+
+# Connection pool size and wait counters
+with st.expander("Connection pool"):
+    st.json(pool_stats())
+
+# Result cache hits, evictions and memory/disk use
+with st.expander("Result cache"):
+    st.json(result_cache.stats())
@@ -0,0 +1,350 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+
+# Answer a file of questions without the UI.
+#
+#   python batch.py questions.jsonl answers.jsonl --concurrency 8 --llm-rate 2
+#   python batch.py questions.jsonl answers.parquet
+#
+# Questions are read as a stream and run through the pipeline with at most
+# --concurrency in flight, and LLM calls are started no faster than --llm-rate per
+# second. Repeats of a question (after normalizing case and whitespace) are answered
+# once. Each answer is written out as soon as it is complete; ids of written answers go
+# to <output>.checkpoint, and re-running the same command skips them.
+
+# Parquet answers are buffered and written as one part file per this many records
+PARQUET_ROW_GROUP = 100
+
+
+# Function to read (question id, question, input record) from a JSONL file
+def read_questions(path, question_field="question"):
+    from answer_cache import question_id
+
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping malformed line {number}")
+                continue
+            question = (record.get(question_field) or "").strip()
+            if question:
+                yield question_id(question), question, record
+
+
+def _load_checkpoint(path):
+    done = set()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    done.add(line.strip())
+    except OSError:
+        pass
+    return done
+
+
+class JsonlWriter:
+    def __init__(self, path):
+        self._file = open(path, "a", encoding="utf-8")
+
+    # Write a record; returns the ids now safely on disk
+    def write(self, record):
+        self._file.write(json.dumps(record, default=str) + "\n")
+        self._file.flush()
+        return [record["id"]]
+
+    def close(self):
+        self._file.close()
+        return []
+
+
+# Writes a directory of Parquet parts. Every flush writes a complete part under a
+# temporary name and renames it into place, so a part is either whole (footer included)
+# or absent, and its ids are only checkpointed once it is readable. A resumed run never
+# rewrites earlier parts; pandas.read_parquet(path) reads them all.
+class ParquetWriter:
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow (pip install pyarrow)")
+        self._pyarrow = pyarrow
+        self._dir = path
+        os.makedirs(path, exist_ok=True)
+        drop_incomplete_parts(path)
+        numbers = [int(name[5:10]) for name in os.listdir(path) if _is_part(name)]
+        self._next_part = max(numbers, default=-1) + 1
+        self._buffer = []
+
+    def write(self, record):
+        self._buffer.append(record)
+        if len(self._buffer) >= PARQUET_ROW_GROUP:
+            return self.flush()
+        return []
+
+    def flush(self):
+        if not self._buffer:
+            return []
+        # Nested values go in as JSON text so every row group has the same schema
+        columns = {
+            key: [json.dumps(record.get(key), default=str) if key in ("columns", "rows", "warnings", "timings")
+                  else record.get(key) for record in self._buffer]
+            for key in OUTPUT_FIELDS
+        }
+        table = self._pyarrow.table(columns, schema=self._schema())
+        path = os.path.join(self._dir, f"part-{self._next_part:05d}.parquet")
+        self._pyarrow.parquet.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self._next_part += 1
+        ids = [record["id"] for record in self._buffer]
+        self._buffer = []
+        return ids
+
+    def _schema(self):
+        pa = self._pyarrow
+        types = {"row_count": pa.int64(), "truncated": pa.bool_(), "cached_answer": pa.bool_()}
+        return pa.schema([(field, types.get(field, pa.string())) for field in OUTPUT_FIELDS])
+
+    def close(self):
+        return self.flush()
+
+    # Ids of the answers in the parts on disk
+    def written_ids(self):
+        ids = set()
+        for name in os.listdir(self._dir):
+            if _is_part(name):
+                table = self._pyarrow.parquet.read_table(os.path.join(self._dir, name), columns=["id"])
+                ids.update(table.column("id").to_pylist())
+        return ids
+
+
+def _is_part(name):
+    return name.startswith("part-") and name.endswith(".parquet") and name[5:10].isdigit()
+
+
+# Function to remove what a killed run may have left in a Parquet output directory:
+# temporary files, and parts without the footer (written by versions that appended
+# row groups to an open part), whose ids were checkpointed but cannot be read back.
+# Returns the names removed.
+def drop_incomplete_parts(path):
+    removed = []
+    for name in sorted(os.listdir(path)):
+        full = os.path.join(path, name)
+        if name.startswith("part-") and name.endswith(".parquet.tmp"):
+            removed.append(name)
+        elif _is_part(name):
+            with open(full, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() >= 12:
+                    f.seek(-4, os.SEEK_END)
+                    if f.read(4) == b"PAR1":
+                        continue
+            removed.append(name)
+        else:
+            continue
+        os.remove(full)
+    return removed
+
+
+OUTPUT_FIELDS = [
+    "id", "question", "sql", "executed_sql", "columns", "rows", "row_count", "truncated",
+    "cached_answer", "error", "error_stage", "warnings", "timings",
+]
+
+
+# Function to turn a pipeline result into an output record with at most max_rows rows
+def to_record(question_id, question, result, max_rows):
+    pager = result["pager"]
+    rows = []
+    if pager is not None:
+        while len(pager.rows) < max_rows and not pager.exhausted:
+            if not pager.fetch_next():
+                break
+        rows = [list(row) for row in pager.rows[:max_rows]]
+        pager.close()
+    return {
+        "id": question_id,
+        "question": question,
+        "sql": result["sql"],
+        "executed_sql": result["executed_sql"],
+        "columns": pager.columns if pager is not None else [],
+        "rows": rows,
+        "row_count": len(rows),
+        "truncated": pager is not None and (pager.truncated or len(pager.rows) > max_rows or not pager.exhausted),
+        "cached_answer": result["cached_answer"] is not None,
+        "error": result["error"],
+        "error_stage": result["error_stage"],
+        "warnings": result["warnings"],
+        "timings": result["timings"],
+    }
+
+
+# Function to record a question whose run raised instead of returning a result, e.g. a
+# database error while reading further pages. result is None if the pipeline itself raised.
+def failed_record(question_id, question, result, error):
+    result = result or {}
+    if result.get("pager") is not None:
+        result["pager"].close()
+    return {
+        "id": question_id,
+        "question": question,
+        "sql": result.get("sql"),
+        "executed_sql": result.get("executed_sql"),
+        "columns": [],
+        "rows": [],
+        "row_count": 0,
+        "truncated": False,
+        "cached_answer": result.get("cached_answer") is not None,
+        "error": f"{type(error).__name__}: {error}",
+        "error_stage": "rows" if result else "batch",
+        "warnings": result.get("warnings", []),
+        "timings": result.get("timings", {}),
+    }
+
+
+# Function to answer the questions with at most `concurrency` in flight. New questions
+# are only read once a slot frees up, so memory does not grow with the input.
+async def run_batch(questions, writer, checkpoint, concurrency, max_rows, use_answer_cache, store_answers):
+    from pipeline import run_question
+
+    slots = asyncio.Semaphore(concurrency)
+    pending = set()
+    errors = []
+    counts = {"answered": 0, "failed": 0}
+    started = time.perf_counter()
+
+    async def answer(question_id, question):
+        try:
+            result = None
+            try:
+                result = await run_question(question, use_answer_cache, store_answer=store_answers)
+                # Reading further pages talks to the database, so keep it off the event loop
+                record = await asyncio.get_running_loop().run_in_executor(None, to_record, question_id, question, result, max_rows)
+            except Exception as e:
+                record = failed_record(question_id, question, result, e)
+            for written in writer.write(record):
+                checkpoint.write(written + "\n")
+            checkpoint.flush()
+            counts["failed" if record["error"] else "answered"] += 1
+            done = counts["answered"] + counts["failed"]
+            if done % 10 == 0:
+                rate = done / (time.perf_counter() - started) * 60
+                print(f"{done} questions done ({counts['failed']} failed), {rate:.0f}/min")
+        finally:
+            slots.release()
+
+    # Failures left here are the writer's (disk full, ...); they stop the batch
+    def finished(task):
+        pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            errors.append(task.exception())
+
+    for question_id, question in questions:
+        if errors:
+            break
+        await slots.acquire()
+        task = asyncio.ensure_future(answer(question_id, question))
+        pending.add(task)
+        task.add_done_callback(finished)
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+    if errors:
+        raise errors[0]
+    return counts
+
+
+# Function to run a batch; returns {"answered", "failed", "duplicates", "skipped"}
+def batch(input_path, output_path, concurrency=4, llm_rate=0.0, llm_burst=1, max_rows=100,
+          question_field="question", use_answer_cache=True, store_answers=False, restart=False):
+    import resources
+    from llm_backend import create_backend, TokenBucket
+    from pipeline import run_sync
+
+    if llm_rate > 0:
+        bucket = TokenBucket(llm_rate, llm_burst)
+        backend = resources.get_or_create("llm_backend", lambda: create_backend(bucket=bucket))
+        # The backend may have been created earlier in this process without the bucket
+        if not hasattr(backend, "bucket"):
+            raise RuntimeError("--llm-rate cannot be applied: the LLM backend was already created without a rate limit")
+        backend.bucket = bucket
+
+    checkpoint_path = output_path.rstrip("/\\") + ".checkpoint"
+    if restart:
+        if os.path.isfile(checkpoint_path):
+            os.remove(checkpoint_path)
+        if os.path.isdir(output_path):
+            for name in os.listdir(output_path):
+                if name.startswith("part-"):
+                    os.remove(os.path.join(output_path, name))
+        elif os.path.isfile(output_path):
+            os.remove(output_path)
+    writer = ParquetWriter(output_path) if output_path.endswith(".parquet") else JsonlWriter(output_path)
+    done = _load_checkpoint(checkpoint_path)
+    if isinstance(writer, ParquetWriter):
+        # Answers in a part that was dropped for having no footer are asked again
+        done &= writer.written_ids()
+    if done:
+        print(f"Resuming: {len(done)} questions already answered")
+
+    seen = set(done)
+    stats = {"duplicates": 0, "skipped": len(done)}
+
+    def unique_questions():
+        for question_id, question, _ in read_questions(input_path, question_field):
+            if question_id in seen:
+                if question_id not in done:
+                    stats["duplicates"] += 1
+                continue
+            seen.add(question_id)
+            yield question_id, question
+
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+        try:
+            counts = run_sync(run_batch(
+                unique_questions(), writer, checkpoint, concurrency, max_rows, use_answer_cache, store_answers
+            ))
+        finally:
+            for written in writer.close():
+                checkpoint.write(written + "\n")
+    return {**counts, **stats}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions without the UI.")
+    parser.add_argument("input", help="JSONL file with one question per line")
+    parser.add_argument("output", help="answers as JSONL, or a directory of Parquet parts if it ends in .parquet")
+    parser.add_argument("--question-field", default="question")
+    parser.add_argument("--concurrency", type=int, default=4, help="questions in flight at once")
+    parser.add_argument("--llm-rate", type=float, default=0.0, help="LLM calls started per second (0 = unlimited)")
+    parser.add_argument("--llm-burst", type=int, default=1, help="LLM calls that may start back to back")
+    parser.add_argument("--max-rows", type=int, default=100, help="result rows written per question")
+    parser.add_argument("--no-answer-cache", action="store_true", help="always ask the LLM")
+    parser.add_argument("--store-answers", action="store_true", help="add new answers to the answer cache")
+    parser.add_argument("--restart", action="store_true", help="discard the checkpoint and output and start over")
+    args = parser.parse_args()
+
+    summary = batch(
+        args.input,
+        args.output,
+        concurrency=args.concurrency,
+        llm_rate=args.llm_rate,
+        llm_burst=args.llm_burst,
+        max_rows=args.max_rows,
+        question_field=args.question_field,
+        use_answer_cache=not args.no_answer_cache,
+        store_answers=args.store_answers,
+        restart=args.restart,
+    )
+    print(f"{summary['answered']} answered, {summary['failed']} failed, "
+          f"{summary['duplicates']} duplicates, {summary['skipped']} already done")
+
+
+if __name__ == "__main__":
+    main()
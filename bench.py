@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import resource
+
+# End-to-end benchmark of the question pipeline.
+#
+#   python bench.py questions.jsonl --concurrency 1,4,16 --save-baseline bench_baseline.json
+#   python bench.py questions.jsonl --concurrency 1,4,16 --compare bench_baseline.json
+#
+# Every question in the corpus goes through pipeline.run_question at each concurrency
+# level, with the LLM replaced by the offline stub (or a replay of recorded replies) and
+# the database from DB_HOST/DB_NAME. The report has p50/p95/p99 per stage, throughput
+# per level and peak RSS. --compare exits with status 1 when a p95 or the throughput is
+# worse than the baseline by more than --tolerance.
+
+STAGES = ["embed", "retrieve", "schema", "llm_first_chunk", "llm", "extract", "guard", "execute", "total"]
+
+
+# Function to read questions from a JSONL corpus
+def read_questions(path, question_field="question"):
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                question = json.loads(line).get(question_field)
+                if question:
+                    questions.append(question)
+    return questions
+
+
+# Nearest-rank percentile of an unsorted list
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024
+
+
+# Function to run every question once with at most `concurrency` in flight; returns the results
+async def run_level(questions, concurrency, use_answer_cache):
+    from pipeline import run_question
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(question):
+        async with semaphore:
+            result = await run_question(question, use_answer_cache, store_answer=False)
+            if result["pager"]:
+                result["pager"].close()
+            return result
+
+    return await asyncio.gather(*(one(question) for question in questions))
+
+
+# Function to summarise one level's results
+def summarise(results, concurrency, elapsed):
+    stages = {}
+    for stage in STAGES:
+        values = [result["timings"][stage] for result in results if stage in result["timings"]]
+        if values:
+            stages[stage] = {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+            }
+    errors = {}
+    for result in results:
+        if result["error_stage"]:
+            errors[result["error_stage"]] = errors.get(result["error_stage"], 0) + 1
+    return {
+        "concurrency": concurrency,
+        "questions": len(results),
+        "elapsed": elapsed,
+        "throughput": len(results) / elapsed if elapsed else None,
+        "errors": errors,
+        "stages": stages,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def print_level(level):
+    print(f"\nconcurrency {level['concurrency']}: {level['questions']} questions in {level['elapsed']:.2f}s, "
+          f"{level['throughput']:.2f} q/s, peak RSS {level['peak_rss_mb']:.0f} MB")
+    if level["errors"]:
+        print("  errors: " + ", ".join(f"{stage} {count}" for stage, count in level["errors"].items()))
+    print(f"  {'stage':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, summary in level["stages"].items():
+        print(f"  {stage:<16}{summary['p50'] * 1000:>10.1f}{summary['p95'] * 1000:>10.1f}{summary['p99'] * 1000:>10.1f}")
+
+
+# Function to compare a report with a baseline; returns a list of regressions
+def compare(report, baseline, tolerance):
+    regressions = []
+    previous_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in report["levels"]:
+        previous = previous_levels.get(level["concurrency"])
+        if previous is None:
+            continue
+        concurrency = level["concurrency"]
+        if level["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"concurrency {concurrency}: throughput {level['throughput']:.2f} q/s vs {previous['throughput']:.2f}"
+            )
+        for stage, summary in level["stages"].items():
+            before = previous["stages"].get(stage)
+            if before and summary["p95"] > before["p95"] * (1 + tolerance):
+                regressions.append(
+                    f"concurrency {concurrency}: {stage} p95 {summary['p95'] * 1000:.1f} ms vs {before['p95'] * 1000:.1f} ms"
+                )
+    return regressions
+
+
+# Function to run the benchmark; returns the report
+def bench(questions, concurrency_levels, llm="stub", use_answer_cache=False, warmup=1):
+    import resources
+    from llm_backend import create_backend
+    from pipeline import run_sync
+    from result_cache import ENABLED as RESULT_CACHE_ENABLED
+
+    # Must come before anything asks for the backend, so the configured one never loads
+    backend = resources.get_or_create("llm_backend", lambda: create_backend(llm))
+
+    # Model and index loads are reported separately instead of landing in the first level
+    start = time.perf_counter()
+    if warmup:
+        run_sync(run_level(questions[:warmup], 1, use_answer_cache))
+    warmup_time = time.perf_counter() - start
+
+    levels = []
+    for concurrency in concurrency_levels:
+        start = time.perf_counter()
+        results = run_sync(run_level(questions, concurrency, use_answer_cache))
+        level = summarise(results, concurrency, time.perf_counter() - start)
+        print_level(level)
+        levels.append(level)
+
+    return {
+        "created_at": time.time(),
+        "python": sys.version.split()[0],
+        "llm": llm,
+        "answer_cache": use_answer_cache,
+        "result_cache": RESULT_CACHE_ENABLED,
+        "questions": len(questions),
+        "warmup_time": warmup_time,
+        "load_times": resources.timings()["load_times"],
+        "levels": levels,
+        "llm_client": backend.stats() if hasattr(backend, "stats") else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the question pipeline against local stand-ins.")
+    parser.add_argument("path", help="JSONL corpus with one question per line")
+    parser.add_argument("--question-field", default="question")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels")
+    parser.add_argument("--repeat", type=int, default=1, help="run the corpus this many times per level")
+    parser.add_argument("--llm", default="stub", choices=["stub", "replay", "gemini"], help="LLM backend")
+    parser.add_argument("--answer-cache", action="store_true", help="allow answers to be reused from the answer cache")
+    parser.add_argument("--result-cache", action="store_true", help="allow results to be served from the result cache")
+    parser.add_argument("--warmup", type=int, default=1, help="questions run before measuring")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--save-baseline", help="write the report as the baseline to compare later runs against")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a regression is reported")
+    args = parser.parse_args()
+
+    # Read by result_cache at import time, so set before the pipeline is imported
+    os.environ["RESULT_CACHE_ENABLED"] = "1" if args.result_cache else "0"
+
+    questions = read_questions(args.path, args.question_field) * args.repeat
+    if not questions:
+        parser.error(f"No questions found in {args.path}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+    report = bench(questions, levels, args.llm, args.answer_cache, args.warmup)
+    print(f"\nwarm-up {report['warmup_time']:.2f}s, peak RSS {report['peak_rss_mb']:.0f} MB")
+    client = report["llm_client"]
+    if client:
+        print(f"LLM client: {client['calls']} calls, {client['requests']} requests, {client['coalesced']} coalesced, "
+              f"{client['retries']} retries, {client['hedges']} hedges ({client['hedge_wins']} won)")
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            print(f"Report written to {path}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions against the baseline:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("\nNo regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import mysql.connector
+from mysql.connector import errorcode
+
+# "mysql" for a MySQL server, or "sqlite" to run queries against the local SQLite file (see sqlite_pool)
+DB_ENGINE = os.getenv("DB_ENGINE", "mysql")
+
+# Pool sizing and checkout behaviour, configurable per deployment
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+
+# Connections idle for longer than this are pinged before being handed out
+HEALTH_CHECK_AFTER = float(os.getenv("DB_POOL_HEALTH_CHECK_AFTER", "30"))
+
+# Prepared statements kept open per connection
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_POOL_STATEMENT_CACHE_SIZE", "32"))
+
+# Streaming results: rows per batch and the hard caps on what one query may return
+STREAM_BATCH_SIZE = int(os.getenv("DB_STREAM_BATCH_SIZE", "500"))
+STREAM_MAX_ROWS = int(os.getenv("DB_STREAM_MAX_ROWS", "100000"))
+STREAM_MAX_BYTES = int(os.getenv("DB_STREAM_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+# Pool of open connections to one database.
+#
+# The database is selected when the connection is made, so no extra USE round trip
+# is needed per query. A statement is executed with the text protocol the first time
+# it is seen; if it comes back it is prepared once per connection and re-executed.
+class ConnectionPool:
+    engine = "mysql"
+
+    def __init__(self, host, user, password, database,
+                 min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, timeout=POOL_TIMEOUT):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.database = database
+        self.label = f"{user}@{host}/{database}"
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.timeout = timeout
+        self._idle = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self._statements = {}
+        self._seen = OrderedDict()
+        self.stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "max_wait_time": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "discarded": 0,
+            "prepared_hits": 0,
+        }
+        for _ in range(min(min_size, self.max_size)):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        connection = mysql.connector.connect(
+            host=self.host,
+            user=self.user,
+            password=self.password,
+            database=self.database,
+            # Without autocommit a pooled connection keeps reading from its first snapshot
+            autocommit=True
+        )
+        self.stats["created"] += 1
+        return connection
+
+    # Take a connection from the pool, opening a new one if below max_size
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        connection, last_used = None, None
+        with self._cond:
+            while True:
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    raise mysql.connector.errors.PoolError(
+                        f"No connection available to {self.database} after {self.timeout}s"
+                    )
+                self._cond.wait(remaining)
+            waited = time.monotonic() - start
+            self.stats["checkouts"] += 1
+            if waited > 0.001:
+                self.stats["waits"] += 1
+                self.stats["wait_time"] += waited
+                self.stats["max_wait_time"] = max(self.stats["max_wait_time"], waited)
+
+        if connection is not None and time.monotonic() - last_used > HEALTH_CHECK_AFTER:
+            try:
+                connection.ping(reconnect=False)
+            except mysql.connector.Error:
+                self._close(connection)
+                connection = None
+        if connection is None:
+            try:
+                connection = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return connection
+
+    # Return a connection; broken ones are closed and their slot freed
+    def release(self, connection, broken=False):
+        if broken:
+            self._close(connection)
+            with self._cond:
+                self._size -= 1
+                self.stats["discarded"] += 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    def _close(self, connection):
+        for cursor in self._statements.pop(id(connection), {}).values():
+            try:
+                cursor.close()
+            except mysql.connector.Error:
+                pass
+        try:
+            connection.close()
+        except mysql.connector.Error:
+            pass
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        broken = False
+        try:
+            yield connection
+        except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(connection, broken)
+
+    # Run a query on a pooled connection and return the rows as dicts
+    def execute(self, query, params=None):
+        statement = query.strip().rstrip(";")
+        with self.connection() as connection:
+            cursor, owned = self._cursor(connection, query)
+            try:
+                try:
+                    cursor.execute(statement, params)
+                except mysql.connector.Error as e:
+                    # Some statements cannot be prepared; run those with the text protocol
+                    if owned or e.errno != errorcode.ER_UNSUPPORTED_PS:
+                        raise
+                    self._statements[id(connection)].pop(query.strip()).close()
+                    cursor, owned = connection.cursor(), True
+                    cursor.execute(statement, params)
+                if not cursor.with_rows:
+                    return []
+                columns = cursor.column_names
+                return [dict(zip(columns, row)) for row in cursor.fetchall()]
+            finally:
+                if owned:
+                    cursor.close()
+
+    # Run a query on an unbuffered cursor and yield (columns, rows, end) batches of
+    # tuples, so rows are read from the server only as they are consumed. end is None
+    # while more rows may follow, "complete" on the last batch and "truncated" when
+    # max_rows or max_bytes was reached before the result ran out.
+    def stream(self, query, batch_size=STREAM_BATCH_SIZE, max_rows=STREAM_MAX_ROWS, max_bytes=STREAM_MAX_BYTES):
+        connection = self.acquire()
+        cursor = None
+        pending = False
+        released = False
+        broken = False
+        try:
+            cursor = connection.cursor(buffered=False)
+            cursor.execute(query.strip().rstrip(";"))
+            if not cursor.with_rows:
+                return
+            pending = True
+            columns = cursor.column_names
+            row_count = 0
+            byte_count = 0
+            while True:
+                requested = min(batch_size, max_rows - row_count)
+                rows = cursor.fetchmany(requested)
+                row_count += len(rows)
+                byte_count += sum(row_size(row) for row in rows)
+                if len(rows) < requested:
+                    # Result fully read: hand the connection back before the last batch goes out
+                    pending = False
+                    cursor.close()
+                    self.release(connection)
+                    released = True
+                    if rows:
+                        yield columns, rows, "complete"
+                    return
+                if row_count >= max_rows and cursor.fetchone() is None:
+                    # Exactly max_rows rows: the peek past the cap found nothing more
+                    pending = False
+                    cursor.close()
+                    self.release(connection)
+                    released = True
+                    yield columns, rows, "complete"
+                    return
+                if row_count >= max_rows or byte_count >= max_bytes:
+                    yield columns, rows, "truncated"
+                    return
+                yield columns, rows, None
+        except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if not released:
+                # Rows still on the wire would have to be read before the connection could
+                # be reused; for a capped or abandoned result closing it is cheaper than draining
+                if pending:
+                    broken = True
+                elif cursor is not None:
+                    cursor.close()
+                self.release(connection, broken)
+
+    # Pick a cursor for the query: a cached prepared one for repeated statements,
+    # otherwise a plain cursor that the caller closes
+    def _cursor(self, connection, query):
+        key = query.strip()
+        statements = self._statements.setdefault(id(connection), OrderedDict())
+        if key in statements:
+            statements.move_to_end(key)
+            self.stats["prepared_hits"] += 1
+            return statements[key], False
+
+        with self._cond:
+            repeated = key in self._seen
+            self._seen[key] = True
+            self._seen.move_to_end(key)
+            while len(self._seen) > STATEMENT_CACHE_SIZE * self.max_size:
+                self._seen.popitem(last=False)
+        if not repeated or STATEMENT_CACHE_SIZE <= 0:
+            return connection.cursor(), True
+
+        cursor = connection.cursor(prepared=True)
+        statements[key] = cursor
+        while len(statements) > STATEMENT_CACHE_SIZE:
+            _, old = statements.popitem(last=False)
+            old.close()
+        return cursor, False
+
+    def size(self):
+        with self._cond:
+            return {"size": self._size, "idle": len(self._idle), "in_use": self._size - len(self._idle)}
+
+
+# Rough in-memory size of a result row, used for the byte cap
+def row_size(row):
+    return sum(len(value) if isinstance(value, (str, bytes, bytearray)) else 8 for value in row)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pool_locks = {}
+
+
+# Function to get the shared pool for a database, creating it on first use. With
+# DB_ENGINE=sqlite every database maps to the SQLite file and the credentials are unused.
+# The password is part of the key, so changed credentials get a new pool. Opening the
+# first connections happens under a lock for that key only, so a slow connect does not
+# hold up callers of other pools.
+def get_pool(host, user, password, database):
+    key = (DB_ENGINE, host, user, password, database)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is not None:
+            return pool
+        lock = _pool_locks.setdefault(key, threading.Lock())
+    with lock:
+        with _pools_lock:
+            pool = _pools.get(key)
+        if pool is None:
+            if DB_ENGINE == "sqlite":
+                from sqlite_pool import SQLitePool, SQLITE_PATH
+                pool = SQLitePool(SQLITE_PATH, database)
+            else:
+                pool = ConnectionPool(host, user, password, database)
+            with _pools_lock:
+                _pools[key] = pool
+        return pool
+
+
+# Function to report size and wait counters for every pool
+def pool_stats():
+    with _pools_lock:
+        pools = dict(_pools)
+    return {pool.label: {**pool.size(), **pool.stats} for pool in pools.values()}
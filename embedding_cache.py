@@ -0,0 +1,149 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from answer_cache import question_id
+
+ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "1") != "0"
+
+# Embeddings kept in memory (about 1.5 KB each for a 384-dimension model)
+MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+
+# Optional on-disk store shared by every process on the machine. Empty disables it.
+DISK_DIR = os.getenv("EMBEDDING_CACHE_DIR", "")
+DISK_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_DISK_BYTES", str(256 * 1024 * 1024)))
+
+# Bytes of the question_id digest stored ahead of each vector on disk
+_KEY_BYTES = 20
+
+
+def _key(question):
+    return bytes.fromhex(question_id(question)[2:])
+
+
+# Append-only file of fixed-size (question digest, float32 vector) records for one model.
+# Each record goes out in a single append, so several processes can share the file;
+# records another process added are picked up the next time a lookup misses.
+class _DiskStore:
+    def __init__(self, path, dim):
+        self.path = path
+        self.dim = dim
+        self.record = np.dtype([("key", "u1", _KEY_BYTES), ("vector", "<f4", dim)])
+        self.rows = {}
+        self.vectors = None
+        self.count = 0
+
+    def refresh(self):
+        try:
+            count = os.path.getsize(self.path) // self.record.itemsize
+        except OSError:
+            return
+        if count <= self.count:
+            return
+        records = np.memmap(self.path, dtype=self.record, mode="r", shape=(count,))
+        keys = records["key"][self.count:].tobytes()
+        for row in range(self.count, count):
+            offset = (row - self.count) * _KEY_BYTES
+            self.rows.setdefault(keys[offset:offset + _KEY_BYTES], row)
+        self.vectors = records["vector"]
+        self.count = count
+
+    def get(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            self.refresh()
+            row = self.rows.get(key)
+        if row is None:
+            return None
+        return np.array(self.vectors[row]).reshape(1, -1)
+
+    def add(self, key, vector):
+        if self.count * self.record.itemsize >= DISK_MAX_BYTES:
+            return
+        with open(self.path, "ab") as f:
+            f.write(key + np.ascontiguousarray(vector, dtype="<f4").tobytes())
+
+
+# Question embeddings keyed by normalized question text (case and whitespace, the same
+# as the answer cache) and by the encoder that produced them: an LRU in memory, backed
+# by the optional disk store, so a repeated question skips the encoder entirely.
+class EmbeddingCache:
+    def __init__(self, max_entries=MAX_ENTRIES, disk_dir=DISK_DIR):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._stores = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+
+    def _store(self, model_id, dim):
+        if not self.disk_dir:
+            return None
+        store = self._stores.get(model_id)
+        if store is None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            name = re.sub(r"[^\w.-]+", "_", model_id)
+            store = self._stores[model_id] = _DiskStore(os.path.join(self.disk_dir, f"{name}-{dim}.f32"), dim)
+            store.refresh()
+        return store
+
+    # Return (embedding of shape (1, dim), "memory" | "disk" | "encoded")
+    def encode(self, model, model_id, question):
+        key = _key(question)
+        with self._lock:
+            embedding = self._entries.get((model_id, key))
+            if embedding is not None:
+                self._entries.move_to_end((model_id, key))
+                self._stats["memory_hits"] += 1
+                return embedding, "memory"
+            store = self._store(model_id, model.get_sentence_embedding_dimension())
+            embedding = store.get(key) if store is not None else None
+            if embedding is not None:
+                self._stats["disk_hits"] += 1
+                self._insert((model_id, key), embedding)
+                return embedding, "disk"
+            self._stats["misses"] += 1
+
+        # Encoded outside the lock; two threads missing on the same question both encode it
+        embedding = np.asarray(model.encode([question]), dtype="float32").reshape(1, -1)
+        with self._lock:
+            self._insert((model_id, key), embedding)
+            if store is not None:
+                store.add(key, embedding)
+        return embedding, "encoded"
+
+    def _insert(self, key, embedding):
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for store in self._stores.values():
+                if os.path.exists(store.path):
+                    os.remove(store.path)
+            self._stores.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+            stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+            stats["entries"] = len(self._entries)
+            stats["disk_rows"] = sum(len(store.rows) for store in self._stores.values())
+            return stats
+
+
+# Shared by every session in the process
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,457 @@
+import os
+import json
+import math
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import faiss
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows; run a single process against an index directory there
+    fcntl = None
+
+# Directory holding the persisted index, its delta file and the row -> record map
+INDEX_DIR = os.getenv("FAISS_INDEX_DIR", "./faiss_index")
+
+# Number of rows pulled from ChromaDB per page when building or syncing
+CHROMA_PAGE_SIZE = int(os.getenv("FAISS_CHROMA_PAGE_SIZE", "5000"))
+
+# Once this many rows have been added since the last save, they are folded into the base index
+COMPACT_EVERY = int(os.getenv("FAISS_COMPACT_EVERY", "10000"))
+
+# Base index type. "flat" is exact; the others trade a little recall for memory and speed:
+#   ivf_flat  inverted lists over full vectors; searches FAISS_NPROBE of FAISS_NLIST lists
+#   ivf_pq    inverted lists over product-quantized codes (FAISS_PQ_M bytes per vector)
+#   hnsw      graph index over full vectors, no training needed
+#   sq_fp16   float16 vectors (half the memory, near-exact)
+#   sq_int8   int8 vectors (a quarter of the memory)
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "sq_fp16", "sq_int8")
+INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat")
+NLIST = int(os.getenv("FAISS_NLIST", "0"))  # 0 picks about 4 * sqrt(rows)
+NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+PQ_M = int(os.getenv("FAISS_PQ_M", "16"))
+PQ_BITS = 8
+HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+HNSW_EF_SEARCH = int(os.getenv("FAISS_HNSW_EF_SEARCH", "64"))
+
+# Rows sampled for training, and how much the collection may grow before the base is
+# retrained from scratch instead of having new rows added to the existing one
+TRAIN_SIZE = int(os.getenv("FAISS_TRAIN_SIZE", "100000"))
+RETRAIN_GROWTH = float(os.getenv("FAISS_RETRAIN_GROWTH", "2"))
+
+# Approximate indexes return this many times top_k candidates, which are re-ranked by
+# exact distance against the raw vectors on disk (0 turns re-ranking off)
+RERANK_FACTOR = int(os.getenv("FAISS_RERANK_FACTOR", "4"))
+
+# k-means wants about this many training points per centroid
+_POINTS_PER_CENTROID = 39
+
+
+def _nlist(rows):
+    return NLIST or max(1, min(65536, int(4 * math.sqrt(rows))))
+
+
+# Function to get the faiss.index_factory string for an index type over `rows` vectors.
+# Too few rows to train the type well falls back to "Flat", which is exact anyway.
+def factory_string(index_type, rows, dim):
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown FAISS_INDEX_TYPE: {index_type}")
+    nlist = _nlist(rows)
+    if index_type == "ivf_flat" and rows >= nlist * _POINTS_PER_CENTROID:
+        return f"IVF{nlist},Flat"
+    if index_type == "ivf_pq" and rows >= max(nlist, 2 ** PQ_BITS) * _POINTS_PER_CENTROID and dim % PQ_M == 0:
+        return f"IVF{nlist},PQ{PQ_M}x{PQ_BITS}"
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_M},Flat"
+    if index_type == "sq_fp16":
+        return "SQfp16"
+    if index_type == "sq_int8" and rows:
+        return "SQ8"
+    return "Flat"
+
+
+# Function to apply the search-time settings (nprobe, efSearch) an index type understands
+def set_search_params(index, nprobe=NPROBE, ef_search=HNSW_EF_SEARCH):
+    space = faiss.ParameterSpace()
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        if value is None:
+            continue
+        try:
+            space.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass  # Not a parameter of this index type
+
+
+# Function to build and fill an index over float32 vectors (an array or np.memmap).
+# Returns (index, factory string).
+def build_index(vectors, index_type, train_size=TRAIN_SIZE, chunk_size=65536):
+    rows, dim = vectors.shape
+    factory = factory_string(index_type, rows, dim)
+    index = faiss.index_factory(dim, factory)
+    if not index.is_trained:
+        sample = np.sort(np.random.default_rng(0).choice(rows, min(rows, train_size), replace=False))
+        index.train(np.ascontiguousarray(vectors[sample], dtype="float32"))
+    # Added in chunks so a memory-mapped source is never loaded whole
+    for start in range(0, rows, chunk_size):
+        index.add(np.ascontiguousarray(vectors[start:start + chunk_size], dtype="float32"))
+    set_search_params(index)
+    return index, factory
+
+
+# Long-lived FAISS index over the query_embeddings collection.
+#
+# The base index is written once and memory-mapped on load, so opening it costs
+# almost nothing regardless of size. Rows added afterwards go to a small in-memory
+# delta index and are appended to a raw float32 file, so nothing is lost on restart.
+# FAISS row ids are positions in `records`, which hold the stored question/SQL pairs.
+# When an id comes back with a different question or SQL its new row is appended and
+# the old one is left dead in the index, skipped by search and dropped on the next rebuild.
+#
+# All raw vectors are also kept in vectors.f32. The base index of any type is built
+# from that file, and approximate indexes re-rank their candidates against it, both
+# through a memory map rather than in RAM.
+#
+# Several processes (forked service workers, the ingest CLI) may share one directory.
+# Writes hold an exclusive flock on index.lock and first reload whatever another process
+# wrote; searches reload under a shared lock when the files have changed since last read.
+class QueryIndex:
+    def __init__(self, dim, index_dir=INDEX_DIR, index_type=INDEX_TYPE):
+        self.dim = dim
+        self.index_dir = index_dir
+        self.index_type = index_type
+        self.index_path = os.path.join(index_dir, "query_embeddings.index")
+        self.delta_path = os.path.join(index_dir, "delta.f32")
+        self.vectors_path = os.path.join(index_dir, "vectors.f32")
+        self.records_path = os.path.join(index_dir, "records.jsonl")
+        self.meta_path = os.path.join(index_dir, "index_meta.json")
+        self.lock_path = os.path.join(index_dir, "index.lock")
+        self.base = faiss.IndexFlatL2(dim)
+        self.delta = faiss.IndexFlatL2(dim)
+        self.vectors = None
+        self.meta = {}
+        self.records = []
+        self.positions = {}
+        self.dead = 0
+        self.lock = threading.Lock()
+        self._loaded_state = None
+
+    @property
+    def ntotal(self):
+        return self.base.ntotal + self.delta.ntotal
+
+    # Hold the cross-process lock on the index directory
+    @contextmanager
+    def file_lock(self, exclusive=True):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Identity of the files every write changes: records.jsonl is appended to and the
+    # base index is replaced, so (inode, size, mtime) of the two moves on each write
+    def _file_state(self):
+        state = []
+        for path in (self.index_path, self.records_path):
+            try:
+                st = os.stat(path)
+                state.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except OSError:
+                state.append(None)
+        return tuple(state)
+
+    # Reload if another process wrote since we last read or wrote; the caller holds the
+    # file lock. Returns False if what is on disk could not be loaded.
+    def _reload_if_changed(self):
+        if self._file_state() == self._loaded_state:
+            return True
+        return self.load(rebuild=False)
+
+    # Before a write: pick up other processes' rows, starting over if the files are unusable
+    def _prepare_write(self):
+        if not self._reload_if_changed():
+            self.clear()
+
+    # Before a read: reload under a shared lock if the files changed, else keep what we have
+    def _refresh(self):
+        if self._file_state() != self._loaded_state:
+            with self.file_lock(exclusive=False):
+                self._reload_if_changed()
+
+    # Load a previously saved index; returns False if there is nothing on disk.
+    # rebuild=False keeps an index saved with another FAISS_INDEX_TYPE as it is.
+    def load(self, rebuild=True):
+        if not os.path.exists(self.index_path) or not os.path.exists(self.records_path):
+            return False
+        base = faiss.read_index(self.index_path, faiss.IO_FLAG_MMAP_IFC)
+        if base.d != self.dim:
+            return False
+        with open(self.records_path, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+
+        delta = faiss.IndexFlatL2(self.dim)
+        if os.path.exists(self.delta_path):
+            vectors = np.fromfile(self.delta_path, dtype="float32")
+            rows = vectors.size // self.dim
+            if rows:
+                delta.add(vectors[: rows * self.dim].reshape(rows, self.dim))
+
+        # A crash between appending records and appending vectors leaves them out of step
+        records = records[: base.ntotal + delta.ntotal]
+        if len(records) != base.ntotal + delta.ntotal:
+            return False
+
+        self.base = base
+        self.delta = delta
+        self.records = records
+        self._index_positions()
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self.meta = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self.meta = {"index_type": "flat", "factory": "Flat", "trained_rows": base.ntotal}
+        set_search_params(self.base)
+        self._open_vectors()
+        self._loaded_state = self._file_state()
+        if rebuild and self.meta.get("index_type") != self.index_type:
+            # FAISS_INDEX_TYPE changed since the index was saved
+            self._compact(rebuild=True)
+        return True
+
+    def _open_vectors(self):
+        self.vectors = None
+        rows = self.base.ntotal
+        if rows and os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) >= rows * self.dim * 4:
+            self.vectors = np.memmap(self.vectors_path, dtype="float32", mode="r", shape=(rows, self.dim))
+
+    # Forget everything on disk so the index can be rebuilt from ChromaDB
+    def clear(self):
+        self.vectors = None
+        for path in (self.index_path, self.delta_path, self.vectors_path, self.records_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.base = faiss.IndexFlatL2(self.dim)
+        self.delta = faiss.IndexFlatL2(self.dim)
+        self.meta = {}
+        self.records = []
+        self.positions = {}
+        self.dead = 0
+        self._loaded_state = self._file_state()
+
+    # Map each id to its latest row; earlier rows for the same id are dead
+    def _index_positions(self):
+        self.positions = {record["id"]: row for row, record in enumerate(self.records)}
+        self.dead = len(self.records) - len(self.positions)
+
+    # Pull embeddings from ChromaDB page by page and add any ids we have not seen yet
+    def sync(self, collection):
+        with self.lock:
+            self._refresh()
+        total = collection.count()
+        if total <= len(self.positions):
+            return 0
+        added = 0
+        offset = len(self.positions)
+        while offset < total:
+            page = collection.get(include=["embeddings", "metadatas"], limit=CHROMA_PAGE_SIZE, offset=offset)
+            if not page or len(page["ids"]) == 0:
+                break
+            added += self.add(page["ids"], page["embeddings"], page["metadatas"])
+            offset += len(page["ids"])
+        # New rows are normally at the end; if not, fall back to one full pass
+        if len(self.positions) < total and offset > 0:
+            offset = 0
+            while offset < total:
+                page = collection.get(include=["embeddings", "metadatas"], limit=CHROMA_PAGE_SIZE, offset=offset)
+                if not page or len(page["ids"]) == 0:
+                    break
+                added += self.add(page["ids"], page["embeddings"], page["metadatas"])
+                offset += len(page["ids"])
+        return added
+
+    # Add new rows to the index. Ids already present are skipped unless their question or
+    # SQL changed, in which case the new row replaces the old one; with existing_only=True
+    # unknown ids are skipped too.
+    def add(self, ids, embeddings, metadatas, existing_only=False):
+        with self.lock, self.file_lock():
+            self._prepare_write()
+            pending = {}
+            for chroma_id, embedding, metadata in zip(ids, embeddings, metadatas):
+                metadata = metadata or {}
+                record = {
+                    "id": chroma_id,
+                    "question": metadata.get("question"),
+                    "sql_query": metadata.get("sql_query"),
+                }
+                row = self.positions.get(chroma_id)
+                if row is None and existing_only:
+                    continue
+                if row is not None and self.records[row] == record:
+                    continue
+                pending[chroma_id] = (embedding, record)
+            if not pending:
+                return 0
+
+            new_rows = [embedding for embedding, _ in pending.values()]
+            new_records = [record for _, record in pending.values()]
+            vectors = np.ascontiguousarray(np.asarray(new_rows, dtype="float32").reshape(-1, self.dim))
+            os.makedirs(self.index_dir, exist_ok=True)
+            with open(self.records_path, "a", encoding="utf-8") as f:
+                for record in new_records:
+                    f.write(json.dumps(record) + "\n")
+            with open(self.delta_path, "ab") as f:
+                vectors.tofile(f)
+            self.delta.add(vectors)
+            for record in new_records:
+                if record["id"] in self.positions:
+                    self.dead += 1
+                self.positions[record["id"]] = len(self.records)
+                self.records.append(record)
+            if self.delta.ntotal >= COMPACT_EVERY or not os.path.exists(self.index_path):
+                self._compact()
+            self._loaded_state = self._file_state()
+            return len(new_records)
+
+    # Return the top_k closest stored records, each with its L2 distance
+    def search(self, query_embeddings, top_k=3):
+        query = np.ascontiguousarray(np.asarray(query_embeddings, dtype="float32").reshape(-1, self.dim))
+        with self.lock:
+            self._refresh()
+            offset = self.base.ntotal
+            if min(top_k, self.ntotal) == 0:
+                return []
+            # Dead rows may take some of the places, so fetch enough to still fill top_k
+            k = min(top_k + self.dead, self.ntotal)
+            distances, indices = [], []
+            if self.base.ntotal:
+                distances_base, indices_base = self._search_base(query, k)
+                distances.append(distances_base)
+                indices.append(indices_base)
+            if self.delta.ntotal:
+                d, i = self.delta.search(query, min(k, self.delta.ntotal))
+                distances.append(d[0])
+                indices.append(i[0] + offset)
+            distances = np.concatenate(distances)
+            indices = np.concatenate(indices)
+            order = np.argsort(distances)
+            results = []
+            for pos in order:
+                row = indices[pos]
+                if row < 0 or self.positions.get(self.records[row]["id"]) != row:
+                    continue
+                record = dict(self.records[row])
+                record["distance"] = float(distances[pos])
+                results.append(record)
+                if len(results) == top_k:
+                    break
+            return results
+
+    # Search the base index; approximate types over-fetch and re-rank by exact distance
+    def _search_base(self, query, k):
+        rerank = RERANK_FACTOR > 0 and self.vectors is not None and self.meta.get("factory", "Flat") != "Flat"
+        fetch = min(k * RERANK_FACTOR if rerank else k, self.base.ntotal)
+        distances, indices = self.base.search(query, fetch)
+        if not rerank:
+            return distances[0], indices[0]
+        candidates = indices[0][indices[0] >= 0]
+        exact = ((self.vectors[candidates] - query[0]) ** 2).sum(axis=1)
+        return exact, candidates
+
+    # Write everything to disk as a single base index and re-open it memory-mapped
+    def save(self):
+        with self.lock, self.file_lock():
+            self._prepare_write()
+            self._compact()
+
+    # Fold the delta into the base. New rows are added to the existing base while the
+    # collection is under RETRAIN_GROWTH times the size it was trained at; past that
+    # (or with rebuild=True) the base is trained and built again from vectors.f32.
+    def _compact(self, rebuild=False):
+        os.makedirs(self.index_dir, exist_ok=True)
+        base_rows = self.base.ntotal
+        self.vectors = None
+        if base_rows and not os.path.exists(self.vectors_path):
+            # Saved before vectors.f32 existed, when the base was always an exact flat index
+            self.base.reconstruct_n(0, base_rows).astype("float32").tofile(self.vectors_path)
+        with open(self.vectors_path, "ab") as f:
+            # Rows past the base are left over from a compaction that did not finish
+            f.truncate(base_rows * self.dim * 4)
+            if self.delta.ntotal:
+                self.delta.reconstruct_n(0, self.delta.ntotal).astype("float32").tofile(f)
+        total = base_rows + self.delta.ntotal
+
+        incremental = (
+            not rebuild
+            and self.meta.get("index_type") == self.index_type
+            and total < max(self.meta.get("trained_rows", 0), 1) * RETRAIN_GROWTH
+            and os.path.exists(self.index_path)
+        )
+        if incremental:
+            index = faiss.read_index(self.index_path)
+            if self.delta.ntotal:
+                index.add(self.delta.reconstruct_n(0, self.delta.ntotal))
+            factory = self.meta["factory"]
+        else:
+            if self.dead:
+                total = self._drop_dead_rows(total)
+            vectors = np.memmap(self.vectors_path, dtype="float32", mode="r", shape=(total, self.dim)) if total else np.zeros((0, self.dim), dtype="float32")
+            index, factory = build_index(vectors, self.index_type)
+            del vectors
+            self.meta = {"index_type": self.index_type, "factory": factory, "trained_rows": total}
+
+        # Drop the mapping before replacing the file underneath it
+        self.base = index
+        tmp_path = self.index_path + ".tmp"
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, self.index_path)
+        with open(self.meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(self.meta_path + ".tmp", self.meta_path)
+        if os.path.exists(self.delta_path):
+            os.remove(self.delta_path)
+        self.base = faiss.read_index(self.index_path, faiss.IO_FLAG_MMAP_IFC)
+        set_search_params(self.base)
+        self.delta = faiss.IndexFlatL2(self.dim)
+        self._open_vectors()
+        self._loaded_state = self._file_state()
+
+    # Rewrite vectors.f32 and records.jsonl with only the live rows, ahead of a full rebuild
+    def _drop_dead_rows(self, total):
+        live = sorted(self.positions.values())
+        vectors = np.memmap(self.vectors_path, dtype="float32", mode="r", shape=(total, self.dim))
+        with open(self.vectors_path + ".tmp", "wb") as f:
+            for start in range(0, len(live), 65536):
+                np.ascontiguousarray(vectors[live[start:start + 65536]]).tofile(f)
+        del vectors
+        records = [self.records[row] for row in live]
+        with open(self.records_path + ".tmp", "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        os.replace(self.vectors_path + ".tmp", self.vectors_path)
+        os.replace(self.records_path + ".tmp", self.records_path)
+        self.records = records
+        self._index_positions()
+        return len(records)
+
+
+# Function to open the index saved on disk, starting empty if it is missing or inconsistent
+def load_query_index(dim, index_dir=INDEX_DIR, index_type=INDEX_TYPE):
+    index = QueryIndex(dim, index_dir, index_type)
+    with index.file_lock():
+        if not index.load():
+            index.clear()
+    return index
+
+
+# Function to store new question/SQL embeddings in ChromaDB and the index together
+def add_query_embeddings(collection, index, ids, embeddings, metadatas):
+    collection.upsert(ids=ids, embeddings=[list(map(float, e)) for e in embeddings], metadatas=metadatas)
+    return index.add(ids, embeddings, metadatas)
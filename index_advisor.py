@@ -0,0 +1,924 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import statistics
+
+import query_log
+from db_pool import get_pool, DB_ENGINE
+from pipeline import DB_HOST, DB_USER, DB_PASSWORD
+from schema_catalog import get_catalog
+from sql_guard import tokenize
+
+# Index advisor for the statements in the query log (see query_log.py).
+#
+#   python index_advisor.py                                    # top shapes by total time, with advice
+#   python index_advisor.py --top 5 --min-count 3 --output advice.json
+#   DB_ENGINE=sqlite python index_advisor.py --replay          # measured on a copy of SQLITE_PATH
+#   python index_advisor.py --replay --replay-database sakila_copy
+#
+# Logged statements are grouped by shape and ranked by the time they took in total.
+# For each frequent, slow shape the slowest example is EXPLAINed and parsed: the
+# equality, join and range predicates, GROUP BY / ORDER BY and selected columns of
+# every table give a composite index (equality columns, then join columns, then one
+# range column, then ordering), made covering when it stays small. Indexes that an
+# existing one already starts with are left out. Aggregates over joins get a summary
+# table grouped by the query's dimensions and filter columns. On MySQL the gain is
+# estimated from EXPLAIN's rows and filtered figures; --replay measures it instead, by
+# timing the example before and after creating the indexes on a copy of the database.
+# The indexes are dropped again unless --keep is given.
+#
+# For MySQL the copy is made beforehand, e.g. mysqldump sakila1 | mysql sakila_copy;
+# for SQLite the advisor copies the file itself. Only the outermost SELECT is analysed.
+
+# Most columns in a proposed index, covering columns included
+MAX_INDEX_COLUMNS = int(os.getenv("ADVISOR_MAX_INDEX_COLUMNS", "5"))
+# Rows a join must examine before a summary table is proposed for it
+SUMMARY_MIN_ROWS = float(os.getenv("ADVISOR_SUMMARY_MIN_ROWS", "100000"))
+# Timed runs of each example per replay measurement (after one warm-up run)
+REPLAY_REPEAT = int(os.getenv("ADVISOR_REPLAY_REPEAT", "5"))
+
+_CLAUSES = {"SELECT": "select", "FROM": "from", "WHERE": "where", "GROUP": "group",
+            "HAVING": "having", "ORDER": "order", "LIMIT": "limit", "WINDOW": "window"}
+_CLAUSE_ENDS = {"UNION", "INTERSECT", "EXCEPT", "FOR", ";"}
+_JOIN_WORDS = {"JOIN", "INNER", "LEFT", "RIGHT", "OUTER", "CROSS", "NATURAL", "STRAIGHT_JOIN"}
+_NOT_ALIASES = _JOIN_WORDS | {"ON", "USING", "FORCE", "USE", "IGNORE", "PARTITION"} | set(_CLAUSES)
+_AGGREGATES = {"COUNT", "SUM", "AVG", "MIN", "MAX"}
+_LITERAL_WORDS = {"NULL", "TRUE", "FALSE", "CURRENT_DATE", "CURRENT_TIME", "CURRENT_TIMESTAMP"}
+_DATE_TYPES = {"DATE", "DATETIME", "TIMESTAMP"}
+# Column types MySQL only indexes by prefix; never used as index columns
+_UNINDEXABLE_TYPES = {"TEXT", "TINYTEXT", "MEDIUMTEXT", "LONGTEXT", "BLOB", "TINYBLOB",
+                      "MEDIUMBLOB", "LONGBLOB", "JSON", "GEOMETRY"}
+
+_MYSQL_ACCESS = {
+    "ALL": "scan", "index": "index_scan", "range": "range",
+    "eq_ref": "unique", "const": "unique", "system": "unique", "unique_subquery": "unique",
+}
+_SQLITE_PLAN = re.compile(r"^(SCAN|SEARCH)(?: TABLE)? (\S+)(?: AS (\S+))?(?: USING (.*))?$")
+
+INDEXES_SQL = """
+    SELECT TABLE_NAME AS table_name, INDEX_NAME AS index_name, COLUMN_NAME AS column_name
+    FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = %s AND COLUMN_NAME IS NOT NULL
+    ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX
+"""
+
+
+# Original spelling of a word or identifier token
+def _name(sql, token):
+    kind, text, start, _ = token
+    if kind == "ident":
+        return text[1:-1].replace("``", "`")
+    return sql[start:start + len(text)]
+
+
+def _text(sql, tokens, start, end):
+    return sql[tokens[start][2]:tokens[end - 1][2] + len(tokens[end - 1][1])]
+
+
+# Index of the ")" closing the "(" at i (tokenize gives both the same depth)
+def _closing(tokens, i):
+    depth = tokens[i][3]
+    return next((j for j in range(i + 1, len(tokens)) if tokens[j][1] == ")" and tokens[j][3] == depth), len(tokens) - 1)
+
+
+def _opening(tokens, j):
+    depth = tokens[j][3]
+    return next((i for i in range(j - 1, -1, -1) if tokens[i][1] == "(" and tokens[i][3] == depth), 0)
+
+
+def _dedupe(items):
+    return list(dict.fromkeys(items))
+
+
+# Function to split the outermost SELECT into {clause: (first token, end)} ranges
+def _clauses(tokens, main):
+    ranges = {}
+    name, start = "select", main + 1
+    for i in range(main + 1, len(tokens)):
+        kind, text, _, depth = tokens[i]
+        if depth != 0:
+            continue
+        if text in _CLAUSE_ENDS or (kind == "word" and text in _CLAUSES):
+            ranges[name] = (start, i)
+            if text in _CLAUSE_ENDS:
+                return ranges
+            name = _CLAUSES[text]
+            start = i + 2 if text in ("GROUP", "ORDER") else i + 1
+    ranges[name] = (start, len(tokens))
+    return ranges
+
+
+# Parses a statement against the schema catalog into what the advisor needs: tables by
+# alias, column references, predicates, ordering and aggregates.
+class ParsedQuery:
+    def __init__(self, sql, catalog):
+        self.sql = sql
+        self.tokens = tokenize(sql)
+        self.tables = {}          # alias -> catalog table, or None for derived tables and CTEs
+        self.columns = {}         # catalog table -> {lower-case column: column info}
+        self.filters = []         # (alias, column, "eq" | "range", text, "on" | "where")
+        self.joins = []           # (alias, column, other alias, other column, text)
+        self.notes = []
+        self.where_joins = []     # texts of the join predicates written in WHERE
+        self.where_complex = False
+        self.star = set()
+        self.derived = False
+        self._catalog = {name.lower(): (name, info) for name, info in catalog["tables"].items()}
+
+        tokens = self.tokens
+        main = next((i for i, (kind, text, _, depth) in enumerate(tokens) if text == "SELECT" and depth == 0), None)
+        if main is None:
+            raise ValueError("no SELECT found")
+        self.distinct = main + 1 < len(tokens) and tokens[main + 1][1] == "DISTINCT"
+        self._skip = set()
+        for k, (kind, text, _, depth) in enumerate(tokens):
+            if text == "SELECT" and depth > 0:
+                opening = _opening(tokens, k)
+                self._skip.update(range(opening, _closing(tokens, opening) + 1))
+        self.ranges = _clauses(tokens, main)
+
+        conditions = self._parse_from(*self.ranges.get("from", (0, 0)))
+        # In FROM only the ON conditions hold column references
+        self.refs = {name: self._refs(*bounds) for name, bounds in self.ranges.items() if name != "from"}
+        self.refs["from"] = []
+        for start, end in conditions:
+            refs = self._refs(start, end)
+            self.refs["from"].extend(refs)
+            self._predicates(start, end, refs, "on")
+        if "where" in self.ranges:
+            self._predicates(*self.ranges["where"], self.refs["where"], "where")
+        self.group = self._plain_refs("group")
+        self.order = self._plain_refs("order")
+        self.referenced = {}
+        for refs in self.refs.values():
+            for _, _, alias, column in refs:
+                self.referenced.setdefault(alias, []).append(column)
+        self.referenced = {alias: _dedupe(columns) for alias, columns in self.referenced.items()}
+        start, end = self.ranges["select"]
+        for i in range(start, end):
+            if tokens[i][1] == "*" and tokens[i][3] == 0 and tokens[i - 1][1] in (",", ".", "SELECT", "DISTINCT"):
+                if tokens[i - 1][1] == ".":
+                    self.star.add(self._alias(_name(self.sql, tokens[i - 2])))
+                else:
+                    self.star.update(self.tables)
+
+    def _table(self, name):
+        entry = self._catalog.get(name.lower())
+        if entry is None:
+            return None
+        table, info = entry
+        if table not in self.columns:
+            self.columns[table] = {column["name"].lower(): column for column in info["columns"]}
+        return table
+
+    def _alias(self, name):
+        return next((alias for alias in self.tables if alias.lower() == name.lower()), None)
+
+    def column_type(self, alias, column):
+        return self.columns[self.tables[alias]][column.lower()]["type"]
+
+    # Function to read the table references; returns the token ranges of the ON conditions
+    def _parse_from(self, start, end):
+        tokens, sql = self.tokens, self.sql
+        conditions = []
+        expect_table = True
+        i = start
+        while i < end:
+            kind, text, _, depth = tokens[i]
+            if expect_table and text == "(":
+                # Derived table: its columns are unknown, so it only takes up an alias
+                self.derived = True
+                i = _closing(tokens, i) + 1
+                if i < end and tokens[i][1] == "AS":
+                    i += 1
+                if i < end and tokens[i][0] in ("word", "ident") and tokens[i][1] not in _NOT_ALIASES:
+                    self.tables[_name(sql, tokens[i])] = None
+                    i += 1
+                expect_table = False
+                continue
+            if expect_table and kind in ("word", "ident"):
+                name = _name(sql, tokens[i])
+                i += 1
+                while i + 1 < end and tokens[i][1] == ".":
+                    name = _name(sql, tokens[i + 1])
+                    i += 2
+                alias = name
+                if i < end and tokens[i][1] == "AS":
+                    i += 1
+                if i < end and tokens[i][0] in ("word", "ident") and tokens[i][1] not in _NOT_ALIASES:
+                    alias = _name(sql, tokens[i])
+                    i += 1
+                self.tables[alias] = self._table(name)
+                expect_table = False
+                continue
+            if text in (",", "JOIN", "STRAIGHT_JOIN"):
+                expect_table = True
+            elif text == "ON":
+                stop = next((j for j in range(i + 1, end) if tokens[j][3] == 0
+                             and (tokens[j][1] in _JOIN_WORDS or tokens[j][1] == ",")), end)
+                conditions.append((i + 1, stop))
+                i = stop
+                continue
+            elif text == "USING" and i + 1 < end and tokens[i + 1][1] == "(":
+                close = _closing(tokens, i + 1)
+                joined = list(self.tables)[-1]
+                for j in range(i + 2, close):
+                    if tokens[j][0] not in ("word", "ident"):
+                        continue
+                    column = _name(sql, tokens[j])
+                    other = next((alias for alias in list(self.tables)[:-1] if self._has(alias, column)), None)
+                    if other is not None and self._has(joined, column):
+                        self.joins.append((joined, self._column(joined, column), other, self._column(other, column), f"USING ({column})"))
+                        self.joins.append((other, self._column(other, column), joined, self._column(joined, column), f"USING ({column})"))
+                i = close + 1
+                continue
+            i += 1
+        return conditions
+
+    def _has(self, alias, column):
+        table = self.tables.get(alias)
+        return table is not None and column.lower() in self.columns[table]
+
+    def _column(self, alias, column):
+        return self.columns[self.tables[alias]][column.lower()]["name"]
+
+    # Function to find the column references in a token range: (start, end, alias, column)
+    def _refs(self, start, end):
+        tokens, sql = self.tokens, self.sql
+        refs = []
+        i = start
+        while i < end:
+            kind, text = tokens[i][:2]
+            if i in self._skip or kind not in ("word", "ident"):
+                i += 1
+                continue
+            if i + 2 < end and tokens[i + 1][1] == "." and tokens[i + 2][0] in ("word", "ident"):
+                alias = self._alias(_name(sql, tokens[i]))
+                column = _name(sql, tokens[i + 2])
+                if alias is not None and self._has(alias, column):
+                    refs.append((i, i + 3, alias, self._column(alias, column)))
+                i += 3
+                continue
+            is_call = kind == "word" and i + 1 < len(tokens) and tokens[i + 1][1] == "("
+            is_alias = i > 0 and tokens[i - 1][1] == "AS"
+            if not is_call and not is_alias:
+                column = _name(sql, tokens[i])
+                owners = [alias for alias in self.tables if self._has(alias, column)]
+                if len(owners) == 1:
+                    refs.append((i, i + 1, owners[0], self._column(owners[0], column)))
+            i += 1
+        return refs
+
+    # Columns listed one by one in GROUP BY or ORDER BY, in order
+    def _plain_refs(self, clause):
+        if clause not in self.ranges:
+            return []
+        start, end = self.ranges[clause]
+        return [(alias, column) for first, last, alias, column in self.refs[clause]
+                if self.tokens[first][3] == 0 and (last == end or self.tokens[last][1] in (",", "ASC", "DESC", "WITH"))]
+
+    # Operator at token i: (operator, tokens it spans), or (None, 1)
+    def _operator(self, i):
+        tokens = self.tokens
+        text = tokens[i][1]
+        if text in ("BETWEEN", "IN", "LIKE", "IS"):
+            if text == "IS" and i + 1 < len(tokens) and tokens[i + 1][1] == "NOT":
+                return None, 1
+            if i > 0 and tokens[i - 1][1] == "NOT":
+                return "NOT", 1
+            return text, 1
+        if text not in ("=", "<", ">", "!"):
+            return None, 1
+        operator, j = text, i + 1
+        while j < len(tokens) and tokens[j][1] in ("=", ">") and tokens[j][2] == tokens[j - 1][2] + 1:
+            operator += tokens[j][1]
+            j += 1
+        return operator, j - i
+
+    # Operand in tokens first .. last: ("column", ref) | ("constant", None)
+    # | ("expression", (function, refs)) | ("subquery", None) | ("other", None)
+    def _operand(self, first, last, refs):
+        tokens = self.tokens
+        inside = [ref for ref in refs if first <= ref[0] and ref[1] <= last]
+        if any(tokens[k][1] == "SELECT" for k in range(first, last)):
+            return "subquery", None
+        if not inside:
+            # A name that is no column of a known table (a derived table's, say) is not a constant
+            for k in range(first, last):
+                kind, text, _, depth = tokens[k]
+                is_call = k + 1 < len(tokens) and tokens[k + 1][1] == "("
+                if kind in ("word", "ident") and depth == tokens[first][3] and not is_call and text not in _LITERAL_WORDS:
+                    return "other", None
+            return "constant", None
+        if len(inside) == 1 and inside[0][0] == first and inside[0][1] == last:
+            return "column", inside[0]
+        function = self.tokens[first][1] if self.tokens[first][0] == "word" else ""
+        return "expression", (function, inside)
+
+    def _left(self, i, start, refs):
+        ref = next((ref for ref in refs if ref[1] == i), None)
+        if ref is not None:
+            return ref[0]
+        j = i - 1
+        if self.tokens[j][1] == ")":
+            j = _opening(self.tokens, j)
+            if j > start and self.tokens[j - 1][0] == "word":
+                j -= 1
+        return j
+
+    def _right(self, i, end, refs):
+        ref = next((ref for ref in refs if ref[0] == i), None)
+        if ref is not None:
+            return ref[1]
+        if i + 1 < end and self.tokens[i][0] == "word" and self.tokens[i + 1][1] == "(":
+            return _closing(self.tokens, i + 1) + 1
+        if self.tokens[i][1] == "(":
+            return _closing(self.tokens, i) + 1
+        return i + 1
+
+    # Function to collect the index-relevant predicates in a WHERE or ON condition. A WHERE
+    # that is anything but a plain AND of such predicates is marked complex, which rules
+    # out a summary table for it.
+    def _predicates(self, start, end, refs, clause):
+        tokens = self.tokens
+        or_depths = {tokens[k][3] for k in range(start, end) if tokens[k][1] == "OR" and k not in self._skip}
+        if or_depths and clause == "where":
+            self.notes.append("Conditions joined by OR are not used for index columns.")
+        usable = 0
+        i = start
+        while i < end:
+            operator, width = self._operator(i)
+            if operator is None or i in self._skip or i == start or i + width >= end:
+                i += width
+                continue
+            left_start = self._left(i, start, refs)
+            right_end = self._right(i + width, end, refs)
+            left = self._operand(left_start, i, refs)
+            right = self._operand(i + width, right_end, refs)
+            if operator == "BETWEEN" and right_end + 1 < end and tokens[right_end][1] == "AND":
+                # The AND belongs to BETWEEN; the upper bound must be a constant too
+                upper_end = self._right(right_end + 1, end, refs)
+                if self._operand(right_end + 1, upper_end, refs)[0] != "constant":
+                    right = "other", None
+                right_end = upper_end
+            text = _text(self.sql, tokens, left_start, right_end)
+            if tokens[i][3] not in or_depths and operator not in ("NOT", "!=", "<>"):
+                if left[0] == "constant" and right[0] == "column" and operator in ("=", "<=>", "<", ">", "<=", ">="):
+                    left, right = right, left
+                    operator = {"<": ">", ">": "<", "<=": ">=", ">=": "<="}.get(operator, operator)
+                usable += self._add(left, right, operator, tokens[i + width], text, clause)
+            i += width
+        if clause == "where":
+            conjuncts = 1 + sum(1 for k in range(start, end) if tokens[k][3] == 0 and tokens[k][1] == "AND") \
+                - sum(1 for k in range(start, end) if tokens[k][3] == 0 and tokens[k][1] == "BETWEEN")
+            self.where_complex = usable != conjuncts
+
+    # Function to record one predicate; returns 1 if it was a filter or join
+    def _add(self, left, right, operator, right_token, text, clause):
+        if left[0] == "expression" and right[0] == "constant":
+            function, inside = left[1]
+            _, _, alias, column = inside[0]
+            self.notes.append(
+                f"{text} cannot use an index on {self.tables[alias]}.{column}; "
+                f"compare {column} itself with a range instead of wrapping it in {function or 'an expression'}."
+            )
+            return 0
+        if left[0] != "column":
+            return 0
+        _, _, alias, column = left[1]
+        if right[0] == "column" and right[1][2] != alias and operator in ("=", "<=>"):
+            _, _, other, other_column = right[1]
+            self.joins.append((alias, column, other, other_column, text))
+            self.joins.append((other, other_column, alias, column, text))
+            if clause == "where":
+                self.where_joins.append(text)
+            return 1
+        if right[0] != "constant":
+            return 0
+        if operator in ("=", "<=>", "IN", "IS"):
+            self.filters.append((alias, column, "eq", text, clause))
+            return 1
+        if operator in ("<", ">", "<=", ">=", "BETWEEN"):
+            self.filters.append((alias, column, "range", text, clause))
+            return 1
+        if operator == "LIKE":
+            if right_token[0] == "string" and right_token[1][1:2] not in ("%", "_"):
+                self.filters.append((alias, column, "range", text, clause))
+                return 1
+            self.notes.append(f"{text} starts with a wildcard, so no index on {self.tables[alias]}.{column} helps.")
+        return 0
+
+    # Function to find the aggregate calls in the SELECT list, HAVING and ORDER BY:
+    # [(function, argument text, call text)]
+    def aggregates(self):
+        calls = []
+        for clause in ("select", "having", "order"):
+            start, end = self.ranges.get(clause, (0, 0))
+            for i in range(start, end - 1):
+                kind, text = self.tokens[i][:2]
+                if kind == "word" and text in _AGGREGATES and self.tokens[i + 1][1] == "(" and i not in self._skip:
+                    close = _closing(self.tokens, i + 1)
+                    argument = _text(self.sql, self.tokens, i + 2, close) if close > i + 2 else ""
+                    calls.append((text, argument, _text(self.sql, self.tokens, i, close + 1)))
+        return calls
+
+    # Items of a clause split at its top-level commas, as text
+    def items(self, clause):
+        start, end = self.ranges[clause]
+        bounds = [start] + [k + 1 for k in range(start, end) if self.tokens[k][1] == "," and self.tokens[k][3] == 0] + [end + 1]
+        return [_text(self.sql, self.tokens, a, b - 1) for a, b in zip(bounds, bounds[1:]) if b - 1 > a]
+
+
+# Function to EXPLAIN a statement into rows of {"id", "alias", "access", "key", "rows",
+# "filtered", "detail"}, where access is scan, index_scan, range, lookup or unique. SQLite
+# has no row estimates, so rows and filtered are None there.
+def explain_plan(pool, sql):
+    statement = sql.strip().rstrip(";")
+    plan = []
+    if pool.engine == "sqlite":
+        for row in pool.execute("EXPLAIN QUERY PLAN " + statement):
+            detail = row["detail"]
+            match = _SQLITE_PLAN.match(detail)
+            if match is None:
+                # USE TEMP B-TREE FOR ORDER BY and the like belong to the step before
+                if plan:
+                    plan[-1]["detail"] += "; " + detail
+                continue
+            verb, name, alias, using = match.groups()
+            using = using or ""
+            # An automatic index is built by scanning the table on every run
+            if "AUTOMATIC" in using or (verb == "SCAN" and not using):
+                access = "scan"
+            elif verb == "SCAN":
+                access = "index_scan"
+            elif "PRIMARY KEY" in using:
+                access = "unique"
+            elif "<" in using or ">" in using:
+                access = "range"
+            else:
+                access = "lookup"
+            key = re.search(r"INDEX (\w+)", using)
+            plan.append({"id": 1, "alias": alias or name, "access": access, "key": key and key.group(1),
+                         "rows": None, "filtered": None, "detail": detail})
+        return plan
+    for row in pool.execute("EXPLAIN " + statement):
+        plan.append({
+            "id": row.get("id"),
+            "alias": row.get("table"),
+            "access": _MYSQL_ACCESS.get(row.get("type"), "lookup"),
+            "key": row.get("key"),
+            "rows": float(row.get("rows") or 1),
+            "filtered": float(row.get("filtered") or 100.0),
+            "detail": " ".join(str(value) for value in (row.get("type"), row.get("key"), row.get("Extra")) if value),
+        })
+    return plan
+
+
+# Function to estimate the rows a plan reads. Each table is read once per row the
+# tables before it in the same SELECT pass on, and passes on (rows * filtered) of what
+# it reads. A table in `improved` gets an index that finds those rows directly.
+def examined_rows(plan, improved=()):
+    total = 0.0
+    passed = {}
+    for row in plan:
+        if row["rows"] is None:
+            return None
+        matching = max(row["rows"] * row["filtered"] / 100.0, 1.0)
+        outer = passed.get(row["id"], 1.0)
+        total += outer * (matching if row["alias"] in improved else row["rows"])
+        passed[row["id"]] = outer * matching
+    return total
+
+
+# Function to list the indexes of every table: {table: {index: [columns]}}
+def existing_indexes(pool, catalog):
+    indexes = {}
+    if pool.engine == "sqlite":
+        for table, info in catalog["tables"].items():
+            primary = [column["name"] for column in info["columns"] if column["primary_key"]]
+            if primary:
+                indexes.setdefault(table, {})["PRIMARY"] = primary
+            for index in pool.execute(f'PRAGMA index_list("{table}")'):
+                columns = sorted(pool.execute(f'PRAGMA index_info("{index["name"]}")'), key=lambda column: column["seqno"])
+                indexes.setdefault(table, {})[index["name"]] = [column["name"] for column in columns if column["name"]]
+        return indexes
+    for row in pool.execute(INDEXES_SQL, (pool.database,)):
+        indexes.setdefault(row["table_name"], {}).setdefault(row["index_name"], []).append(row["column_name"])
+    return indexes
+
+
+def _quote(name):
+    return "`" + name.replace("`", "``") + "`"
+
+
+def _starts_with(index_columns, columns):
+    return [column.lower() for column in index_columns[:len(columns)]] == [column.lower() for column in columns]
+
+
+def _index_name(table, columns):
+    name = f"idx_{table}_{'_'.join(columns)}"
+    if len(name) > 64:
+        name = name[:55] + "_" + hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]
+    return name
+
+
+def _join_order(query, plan):
+    return _dedupe([row["alias"] for row in plan if query.tables.get(row["alias"])]
+                   + [alias for alias, table in query.tables.items() if table])
+
+
+# Function to pick a table to start the join from when the plan starts by scanning one
+# that nothing filters: the one with the most WHERE filters, or None
+def driving_table(query, plan, proposals):
+    order = _join_order(query, plan)
+    first = next((row for row in plan if row["alias"] == order[0]), None) if order else None
+    if first is None or first["access"] not in ("scan", "index_scan") or any(p["alias"] == first["alias"] for p in proposals):
+        return None
+    counts = {}
+    for alias, _, kind, _, clause in query.filters:
+        if clause == "where" and alias != first["alias"]:
+            counts.setdefault(alias, [0, 0])[kind == "range"] += 1
+    return max(counts, key=lambda alias: counts[alias]) if counts else None
+
+
+# Function to propose at most one index per table, visiting the tables in plan order
+# (or starting from `driver`): equality columns, then columns joining it to tables
+# read before it, then one range column, or (for the first table, without a range) the
+# GROUP BY / ORDER BY columns. The rest of the columns the query reads from the table
+# are added when the index stays within MAX_INDEX_COLUMNS, so the rows need not be
+# looked up at all.
+def propose_indexes(query, plan, indexes, driver=None):
+    steps = {row["alias"]: row for row in plan if row["alias"] in query.tables}
+    order = _join_order(query, plan)
+    if driver is not None:
+        # The plan's access paths no longer apply once the join order changes
+        order = [driver] + [alias for alias in order if alias != driver]
+        steps = {}
+    ordering = query.group or query.order
+    proposals = []
+    for position, alias in enumerate(order):
+        table = query.tables[alias]
+        step = steps.get(alias)
+        if step is not None and step["access"] == "unique":
+            continue
+        earlier = set(order[:position])
+
+        def usable(column):
+            return query.column_type(alias, column) not in _UNINDEXABLE_TYPES
+
+        equal = [column for a, column, kind, _, _ in query.filters if a == alias and kind == "eq"]
+        joined = [column for a, column, other, _, _ in query.joins if a == alias and other in earlier]
+        ranges = [column for a, column, kind, _, _ in query.filters if a == alias and kind == "range"]
+        key = [column for column in _dedupe(equal + joined) if usable(column)]
+        ranges = [column for column in ranges if usable(column) and column not in key]
+        if ranges:
+            key.append(ranges[0])
+        elif position == 0 and ordering and all(a == alias for a, _ in ordering):
+            key += [column for _, column in ordering if column not in key and usable(column)]
+        if not key:
+            continue
+
+        columns = list(key)
+        covering = False
+        if alias not in query.star:
+            # Secondary indexes carry the primary key already (InnoDB's, and SQLite's rowid)
+            primary = {column["name"] for column in query.columns[table].values() if column["primary_key"]}
+            rest = [column for column in query.referenced.get(alias, []) if column not in columns and column not in primary]
+            if all(usable(column) for column in rest) and len(columns) + len(rest) <= MAX_INDEX_COLUMNS:
+                columns += rest
+                covering = True
+
+        existing = indexes.get(table, {}).values()
+        if any(_starts_with(index_columns, columns) for index_columns in existing):
+            continue
+        # Already looked up by these columns; only covering would be added
+        if step is not None and step["access"] not in ("scan", "index_scan") \
+                and any(_starts_with(index_columns, key) for index_columns in existing):
+            continue
+        name = _index_name(table, columns)
+        proposals.append({
+            "alias": alias,
+            "table": table,
+            "columns": columns,
+            "key_columns": key,
+            "covering": covering,
+            "access": step["access"] if step else None,
+            "name": name,
+            "ddl": f"CREATE INDEX {_quote(name)} ON {_quote(table)} ({', '.join(_quote(column) for column in columns)})",
+        })
+    return proposals
+
+
+# Function to propose a summary table for an aggregate over a join: grouped by the
+# query's GROUP BY expressions plus its WHERE filter columns (dates by day), with
+# sums, counts, minimums and maximums that can be added up again for any filter value
+def propose_summary(query, shape_id, examined):
+    if "group" not in query.ranges or query.derived or query.star or query.where_complex or query.distinct:
+        return None
+    tables = list(query.tables.values())
+    if len(tables) < 2 or None in tables or examined is None or examined < SUMMARY_MIN_ROWS:
+        return None
+    calls = query.aggregates()
+    if not calls or any(argument.upper().startswith("DISTINCT") for _, argument, _ in calls):
+        return None
+    group_items = query.items("group")
+    if any("ROLLUP" in item.upper() for item in group_items):
+        return None
+
+    dimensions = []
+    names = set()
+
+    def add(expression, name):
+        if expression.replace("`", "").lower() in {d.replace("`", "").lower() for d, _ in dimensions}:
+            return
+        while name in names:
+            name += "_"
+        names.add(name)
+        dimensions.append((expression, name))
+
+    refs = {_text(query.sql, query.tokens, first, last): column for first, last, _, column in query.refs["group"]}
+    for n, item in enumerate(group_items):
+        add(item, refs.get(item, f"dimension_{n + 1}"))
+    for alias, column, kind, _, clause in query.filters:
+        if clause != "where":
+            continue
+        expression = f"{_quote(alias)}.{_quote(column)}"
+        if kind == "range" and query.column_type(alias, column) in _DATE_TYPES:
+            add(f"DATE({expression})", f"{column}_day")
+        else:
+            add(expression, column)
+
+    measures = []
+    for function, argument, text in calls:
+        column = argument.split(".")[-1].strip("` ") if re.fullmatch(r"[\w`.]+", argument) else None
+        suffix = column or ("rows" if argument.strip() == "*" else f"{len(measures) + 1}")
+        if function == "AVG":
+            parts = [(f"SUM({argument})", f"sum_{suffix}"), (f"COUNT({argument})", f"count_{suffix}")]
+        else:
+            parts = [(text, f"{function.lower()}_{suffix}")]
+        for expression, name in parts:
+            if all(expression.upper() != existing.upper() for existing, _ in measures):
+                measures.append((expression, name))
+
+    table = f"summary_{shape_id[:12]}"
+    select = ",\n       ".join(f"{expression} AS {_quote(name)}" for expression, name in dimensions + measures)
+    ddl = f"CREATE TABLE {_quote(table)} AS\nSELECT {select}\nFROM {_text(query.sql, query.tokens, *query.ranges['from'])}"
+    if query.where_joins:
+        ddl += "\nWHERE " + " AND ".join(query.where_joins)
+    ddl += "\nGROUP BY " + ", ".join(expression for expression, _ in dimensions)
+    return {
+        "table": table,
+        "dimensions": [name for _, name in dimensions],
+        "measures": [name for _, name in measures],
+        "ddl": ddl,
+        "drop": f"DROP TABLE {_quote(table)}",
+    }
+
+
+# A copy of the database the advisor may change. For SQLite the file is copied into a
+# temporary directory; for MySQL it is an existing database made as a copy beforehand.
+class ReplayDatabase:
+    def __init__(self, database, copy=None):
+        self.directory = None
+        self._writer = None
+        if DB_ENGINE == "sqlite":
+            from sqlite_pool import SQLitePool, SQLITE_PATH
+
+            self.directory = tempfile.mkdtemp(prefix="index_advisor-")
+            self.label = os.path.join(self.directory, os.path.basename(SQLITE_PATH))
+            source = sqlite3.connect(f"file:{os.path.abspath(SQLITE_PATH)}?mode=ro", uri=True)
+            # The pool's connections are read-only; DDL goes through this one
+            self._writer = sqlite3.connect(self.label, isolation_level=None, check_same_thread=False)
+            try:
+                source.backup(self._writer)
+            finally:
+                source.close()
+            self.pool = SQLitePool(self.label, database)
+        else:
+            self.label = copy
+            self.pool = get_pool(DB_HOST, DB_USER, DB_PASSWORD, copy)
+
+    def run(self, statement):
+        if self._writer is not None:
+            from sqlite_pool import translate_mysql
+
+            self._writer.execute(translate_mysql(statement))
+        else:
+            self.pool.execute(statement)
+
+    # Median seconds to run and fetch a statement, after one warm-up run
+    def time_query(self, sql, repeat=REPLAY_REPEAT):
+        self.pool.execute(sql)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            self.pool.execute(sql)
+            times.append(time.perf_counter() - start)
+        return statistics.median(times)
+
+    def close(self, keep=False):
+        if self._writer is not None:
+            self._writer.close()
+        if self.directory is not None and not keep:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Advisor:
+    def __init__(self):
+        self._databases = {}
+
+    def _database(self, database):
+        if database not in self._databases:
+            pool = get_pool(DB_HOST, DB_USER, DB_PASSWORD, database)
+            catalog = get_catalog(DB_HOST, DB_USER, DB_PASSWORD, database)
+            self._databases[database] = (pool, catalog, existing_indexes(pool, catalog))
+        return self._databases[database]
+
+    # Function to analyse one shape from query_log.summarize
+    def advise(self, shape):
+        advice = {
+            **shape,
+            "plan": [],
+            "indexes": [],
+            "summary": None,
+            "estimate": None,
+            "notes": [],
+            "error": None,
+        }
+        try:
+            pool, catalog, indexes = self._database(shape["database"])
+            advice["plan"] = explain_plan(pool, shape["example"])
+            query = ParsedQuery(shape["example"], catalog)
+        except Exception as e:
+            advice["error"] = f"{type(e).__name__}: {e}"
+            return advice
+
+        advice["notes"] = _dedupe(query.notes)
+        advice["indexes"] = propose_indexes(query, advice["plan"], indexes)
+        driver = driving_table(query, advice["plan"], advice["indexes"])
+        if driver is not None:
+            advice["indexes"] = propose_indexes(query, advice["plan"], indexes, driver)
+            advice["notes"].append(
+                f"The plan reads all of {advice['plan'][0]['alias']} first; with these indexes it can start from "
+                f"{driver} instead. EXPLAIN cannot estimate that change, --replay measures it."
+            )
+        for proposal in advice["indexes"]:
+            proposal["drop"] = f"DROP INDEX {_quote(proposal['name'])}" + \
+                (f" ON {_quote(proposal['table'])}" if pool.engine == "mysql" else "")
+        before = examined_rows(advice["plan"])
+        if before and driver is None:
+            after = examined_rows(advice["plan"], {proposal["alias"] for proposal in advice["indexes"]})
+            saved = 1.0 - after / before
+            advice["estimate"] = {
+                "rows_before": before,
+                "rows_after": after,
+                "fraction_saved": saved,
+                "seconds_saved": shape["total_seconds"] * saved,
+            }
+        # Without EXPLAIN estimates (SQLite) the joined tables' sizes bound the work
+        examined = before if before is not None else sum(
+            catalog["tables"][table]["rows"] for table in query.tables.values() if table
+        )
+        advice["summary"] = propose_summary(query, shape["shape_id"], examined)
+        return advice
+
+    # Function to time a shape's example on the copy before and after its indexes, and
+    # build its summary table there. Everything created is dropped again unless keep.
+    def replay(self, advice, target, repeat=REPLAY_REPEAT, keep=False):
+        sql = advice["example"]
+        result = {"before_seconds": None, "after_seconds": None, "speedup": None, "plan_after": [], "errors": []}
+        created = []
+        try:
+            result["before_seconds"] = target.time_query(sql, repeat)
+            for proposal in advice["indexes"]:
+                try:
+                    target.run(proposal["ddl"])
+                    created.append(proposal)
+                except Exception as e:
+                    result["errors"].append(f"{proposal['name']}: {e}")
+            result["after_seconds"] = target.time_query(sql, repeat)
+            result["speedup"] = result["before_seconds"] / max(result["after_seconds"], 1e-9)
+            result["plan_after"] = explain_plan(target.pool, sql)
+            summary = advice["summary"]
+            if summary:
+                start = time.perf_counter()
+                target.run(summary["ddl"])
+                result["summary_build_seconds"] = time.perf_counter() - start
+                result["summary_rows"] = target.pool.execute(
+                    f"SELECT COUNT(*) AS row_count FROM {_quote(summary['table'])}"
+                )[0]["row_count"]
+                if not keep:
+                    target.run(summary["drop"])
+        except Exception as e:
+            result["errors"].append(f"{type(e).__name__}: {e}")
+        finally:
+            if not keep:
+                for proposal in created:
+                    target.run(proposal["drop"])
+        return result
+
+
+def _plan_text(plan):
+    return " | ".join(f"{row['alias']}: {row['detail']}" for row in plan)
+
+
+def print_advice(rank, advice):
+    print(f"{rank}. {advice['shape_id']}  {advice['database']}  {advice['executions']} runs "
+          f"({advice['cached']} cached, {advice['errors']} failed)  {advice['total_seconds']:.2f}s total  "
+          f"mean {advice['mean_seconds']:.3f}s  p95 {advice['p95_seconds']:.3f}s")
+    shape = advice["shape"]
+    print(f"   {shape if len(shape) <= 200 else shape[:197] + '...'}")
+    if advice["error"]:
+        print(f"   error    {advice['error']}")
+        return
+    print(f"   plan     {_plan_text(advice['plan'])}")
+    for proposal in advice["indexes"]:
+        print(f"   index    {proposal['ddl']}{'  (covering)' if proposal['covering'] else ''}")
+    estimate = advice["estimate"]
+    if estimate and advice["indexes"]:
+        print(f"   estimate {estimate['rows_before']:,.0f} -> {estimate['rows_after']:,.0f} rows read "
+              f"(-{estimate['fraction_saved']:.0%}), about {estimate['seconds_saved']:.2f}s of the logged time")
+    if advice["summary"]:
+        summary = advice["summary"]
+        print(f"   summary  {summary['table']} by {', '.join(summary['dimensions'])}:")
+        for line in summary["ddl"].splitlines():
+            print(f"              {line}")
+    for note in advice["notes"]:
+        print(f"   note     {note}")
+    replay = advice.get("replay")
+    if replay:
+        if replay["after_seconds"] is not None:
+            print(f"   replay   {replay['before_seconds']:.4f}s -> {replay['after_seconds']:.4f}s "
+                  f"({replay['speedup']:.1f}x); after: {_plan_text(replay['plan_after'])}")
+        if "summary_rows" in replay:
+            print(f"   replay   {advice['summary']['table']}: {replay['summary_rows']:,} rows, "
+                  f"built in {replay['summary_build_seconds']:.2f}s")
+        for error in replay["errors"]:
+            print(f"   replay   failed: {error}")
+    if not advice["indexes"] and not advice["summary"] and not advice["notes"]:
+        print("   nothing to suggest")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Suggest indexes and summary tables for the slow statements in the query log.")
+    parser.add_argument("--log", default=query_log.QUERY_LOG, help="query log to read")
+    parser.add_argument("--top", type=int, default=10, help="shapes to analyse, by total time")
+    parser.add_argument("--min-count", type=int, default=2, help="executions a shape needs")
+    parser.add_argument("--min-seconds", type=float, default=0.0, help="mean seconds a shape needs")
+    parser.add_argument("--output", help="also write the advice as JSON to this file")
+    parser.add_argument("--replay", action="store_true", help="measure the advice on a copy of the database")
+    parser.add_argument("--replay-database", help="MySQL database holding a copy to replay on")
+    parser.add_argument("--repeat", type=int, default=REPLAY_REPEAT, help="timed runs per measurement")
+    parser.add_argument("--keep", action="store_true", help="leave what the replay created (and a SQLite copy) in place")
+    args = parser.parse_args()
+
+    shapes = [
+        shape for shape in query_log.summarize(query_log.read_log(args.log))
+        if shape["executions"] >= args.min_count and shape["mean_seconds"] >= args.min_seconds
+    ][:args.top]
+    if not shapes:
+        sys.exit(f"No statement in {args.log} ran at least {args.min_count} times")
+    target = None
+    if args.replay:
+        if DB_ENGINE != "sqlite" and not args.replay_database:
+            sys.exit("--replay on MySQL needs --replay-database naming a copy of the database")
+        if DB_ENGINE != "sqlite" and args.replay_database in {shape["database"] for shape in shapes}:
+            sys.exit("--replay-database must be a copy, not a database the log was recorded on")
+        # One copy is of one database: replay the shapes of the top shape's database only
+        replay_database = shapes[0]["database"]
+        others = sorted({shape["database"] for shape in shapes} - {replay_database})
+        if others:
+            print(f"Replaying only the statements run on {replay_database}; not replaying those on {', '.join(others)}\n")
+        target = ReplayDatabase(replay_database, args.replay_database)
+
+    advisor = Advisor()
+    results = []
+    try:
+        for rank, shape in enumerate(shapes, 1):
+            advice = advisor.advise(shape)
+            if (target is not None and shape["database"] == replay_database and not advice["error"]
+                    and (advice["indexes"] or advice["summary"])):
+                advice["replay"] = advisor.replay(advice, target, args.repeat, args.keep)
+            print_advice(rank, advice)
+            print()
+            results.append(advice)
+    finally:
+        if target is not None:
+            target.close(args.keep)
+            if args.keep and target.directory:
+                print(f"Replay copy kept at {target.label}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, default=str)
+        print(f"Advice written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
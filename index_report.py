@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import faiss
+
+from faiss_index import INDEX_DIR, INDEX_TYPES, RERANK_FACTOR, build_index, set_search_params
+
+# Recall and latency of each FAISS index type against the exact flat index.
+#
+#   python index_report.py                                 # vectors saved in FAISS_INDEX_DIR
+#   python index_report.py --synthetic 1000000 --types ivf_flat,ivf_pq,sq_int8 --nprobe 4,16,64
+#
+# The last --queries rows are held out as queries, the rest are indexed. For every type
+# (and every nprobe / efSearch value given) the report has build time, index size,
+# per-query latency and recall@k, with and without the exact re-ranking QueryIndex does.
+
+
+def load_vectors(index_dir, dim):
+    path = os.path.join(index_dir, "vectors.f32")
+    if not os.path.exists(path):
+        raise SystemExit(f"{path} not found; save the index first or use --synthetic")
+    rows = os.path.getsize(path) // (dim * 4)
+    return np.memmap(path, dtype="float32", mode="r", shape=(rows, dim))
+
+
+# Unit-length vectors in loose clusters, roughly like sentence embeddings of similar questions
+def synthetic_vectors(rows, dim, clusters=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype("float32")
+    vectors = centers[rng.integers(0, clusters, rows)] + 0.5 * rng.standard_normal((rows, dim)).astype("float32")
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def _percentile(values, p):
+    return float(np.percentile(values, p)) if len(values) else None
+
+
+# Function to measure one built index; returns latency and recall figures
+def measure(index, base_vectors, queries, exact, k):
+    hits = 0
+    hits_reranked = 0
+    latencies = []
+    for query, truth in zip(queries, exact):
+        query = query.reshape(1, -1)
+        start = time.perf_counter()
+        _, indices = index.search(query, k * max(RERANK_FACTOR, 1))
+        latencies.append(time.perf_counter() - start)
+        candidates = indices[0][indices[0] >= 0]
+        truth = set(truth.tolist())
+        hits += len(truth & set(candidates[:k].tolist()))
+        exact_distances = ((base_vectors[candidates] - query[0]) ** 2).sum(axis=1)
+        hits_reranked += len(truth & set(candidates[np.argsort(exact_distances)[:k]].tolist()))
+    return {
+        "recall": hits / (len(queries) * k),
+        "recall_reranked": hits_reranked / (len(queries) * k),
+        "latency_p50_ms": _percentile(latencies, 50) * 1000,
+        "latency_p95_ms": _percentile(latencies, 95) * 1000,
+    }
+
+
+# Function to run the report; returns a list of result rows
+def report(vectors, index_types, k=10, query_count=1000, nprobes=(), ef_searches=()):
+    base_vectors = vectors[:-query_count]
+    queries = np.ascontiguousarray(vectors[-query_count:], dtype="float32")
+
+    exact_index = faiss.IndexFlatL2(vectors.shape[1])
+    for start in range(0, len(base_vectors), 65536):
+        exact_index.add(np.ascontiguousarray(base_vectors[start:start + 65536], dtype="float32"))
+    _, exact = exact_index.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        start = time.perf_counter()
+        index, factory = build_index(base_vectors, index_type)
+        build_time = time.perf_counter() - start
+        size = len(faiss.serialize_index(index))
+
+        settings = [{}]
+        if factory.startswith("IVF") and nprobes:
+            settings = [{"nprobe": value} for value in nprobes]
+        elif factory.startswith("HNSW") and ef_searches:
+            settings = [{"efSearch": value} for value in ef_searches]
+        for setting in settings:
+            if setting:
+                set_search_params(index, setting.get("nprobe"), setting.get("efSearch"))
+            row = {
+                "index_type": index_type,
+                "factory": factory,
+                **setting,
+                "build_s": build_time,
+                "size_mb": size / (1024 * 1024),
+                **measure(index, base_vectors, queries, exact, k),
+            }
+            rows.append(row)
+            print_row(row)
+    return rows
+
+
+def print_header():
+    print(f"{'type':<10}{'factory':<22}{'param':<14}{'build s':>9}{'size MB':>10}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'recall':>9}{'reranked':>10}")
+
+
+def print_row(row):
+    param = ", ".join(f"{key}={row[key]}" for key in ("nprobe", "efSearch") if key in row)
+    print(f"{row['index_type']:<10}{row['factory']:<22}{param:<14}{row['build_s']:>9.2f}{row['size_mb']:>10.1f}"
+          f"{row['latency_p50_ms']:>9.3f}{row['latency_p95_ms']:>9.3f}{row['recall']:>9.3f}{row['recall_reranked']:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare FAISS index types against the exact index.")
+    parser.add_argument("--index-dir", default=INDEX_DIR, help="directory with vectors.f32 from a saved index")
+    parser.add_argument("--dim", type=int, default=384, help="embedding dimension")
+    parser.add_argument("--synthetic", type=int, default=0, help="use this many synthetic vectors instead")
+    parser.add_argument("--types", default=",".join(INDEX_TYPES), help="comma-separated index types")
+    parser.add_argument("--queries", type=int, default=1000, help="rows held out as queries")
+    parser.add_argument("--k", type=int, default=10, help="neighbours compared for recall")
+    parser.add_argument("--nprobe", default="", help="comma-separated nprobe values for IVF types")
+    parser.add_argument("--ef-search", default="", help="comma-separated efSearch values for HNSW")
+    parser.add_argument("--output", help="write the rows to this JSON file")
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.synthetic, args.dim) if args.synthetic else load_vectors(args.index_dir, args.dim)
+    if len(vectors) <= args.queries:
+        sys.exit(f"Need more than {args.queries} vectors, found {len(vectors)}")
+    index_types = [value for value in args.types.split(",") if value]
+    nprobes = [int(value) for value in args.nprobe.split(",") if value]
+    ef_searches = [int(value) for value in args.ef_search.split(",") if value]
+
+    print(f"{len(vectors) - args.queries} indexed vectors, {args.queries} queries, recall@{args.k}")
+    print_header()
+    rows = report(vectors, index_types, args.k, args.queries, nprobes, ef_searches)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import resources
+from answer_cache import question_id
+from faiss_index import load_query_index
+
+# Bulk-load question/SQL pairs into the query_embeddings collection.
+#
+#   python ingest.py pairs.jsonl --workers 4
+#
+# Each input line is a JSON object with a question and its SQL (the same shape as
+# few_shot_examples). The file is read as a stream and encoded in large batches, so
+# memory stays bounded whatever its size. Progress is checkpointed by byte offset
+# after every upsert; re-running the same command resumes where it stopped.
+#
+# A question that is already stored is overwritten. Its row in the FAISS index on disk
+# is replaced in the same step, so the answer cache stops serving the old SQL; running
+# processes pick the change up on their next search. New questions reach the index
+# through its usual sync with ChromaDB (or straight away with --build-index).
+
+_worker_model = None
+
+
+def _init_worker(threads):
+    global _worker_model
+    # Split the cores between workers instead of letting each one use all of them
+    _worker_model = resources.load_encoder(threads)
+
+
+def _encode_in_worker(questions, encode_batch_size):
+    return _worker_model.encode(questions, batch_size=encode_batch_size, convert_to_numpy=True)
+
+
+# Function to read (question, sql, end_offset) from a JSONL file starting at a byte offset
+def read_pairs(path, question_field, sql_field, start_offset=0):
+    with open(path, "rb") as f:
+        f.seek(start_offset)
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            offset = f.tell()
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping malformed line ending at byte {offset}")
+                continue
+            question = record.get(question_field)
+            sql = record.get(sql_field)
+            if question and sql:
+                yield question.strip(), sql.strip(), offset
+
+
+# Function to group pairs into lists of batch_size
+def batched(pairs, batch_size):
+    batch = []
+    for pair in pairs:
+        batch.append(pair)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _load_checkpoint(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {"offset": 0, "count": 0}
+
+
+def _save_checkpoint(path, checkpoint):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def _upsert(collection, index, batch, embeddings):
+    # Ids come from the normalized question, so repeats within a batch collapse to one row
+    rows = {}
+    for (question, sql, _), embedding in zip(batch, embeddings):
+        rows[question_id(question)] = (embedding.tolist(), {"question": question, "sql_query": sql})
+    ids = list(rows)
+    embeddings = [embedding for embedding, _ in rows.values()]
+    metadatas = [metadata for _, metadata in rows.values()]
+    collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas)
+    # Only ids the index already holds; adding every new row here would compact it over and over
+    index.add(ids, embeddings, metadatas, existing_only=True)
+    return len(rows)
+
+
+# Function to run the ingestion; returns the number of pairs upserted in this run
+def ingest(path, batch_size=1024, encode_batch_size=128, workers=0, question_field="question",
+           sql_field="sql_query", checkpoint_path=None, restart=False, build_index=False):
+    checkpoint_path = checkpoint_path or path + ".checkpoint"
+    checkpoint = {"offset": 0, "count": 0} if restart else _load_checkpoint(checkpoint_path)
+    if checkpoint["offset"]:
+        print(f"Resuming at byte {checkpoint['offset']} ({checkpoint['count']} pairs already ingested)")
+
+    collection = resources.get_db_collection()
+    batches = batched(read_pairs(path, question_field, sql_field, checkpoint["offset"]), batch_size)
+    start = time.perf_counter()
+    ingested = 0
+    index = None
+
+    def done(batch, embeddings):
+        nonlocal ingested, index
+        if index is None:
+            index = load_query_index(embeddings.shape[1])
+        ingested += _upsert(collection, index, batch, embeddings)
+        checkpoint["offset"] = batch[-1][2]
+        checkpoint["count"] += len(batch)
+        _save_checkpoint(checkpoint_path, checkpoint)
+        elapsed = time.perf_counter() - start
+        print(f"{checkpoint['count']} pairs ingested, {ingested / elapsed * 60:.0f} pairs/min")
+
+    if workers > 0:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(threads,)) as executor:
+            # Keep a bounded number of batches in flight and upsert them in input order
+            in_flight = deque()
+            for batch in batches:
+                questions = [question for question, _, _ in batch]
+                in_flight.append((batch, executor.submit(_encode_in_worker, questions, encode_batch_size)))
+                if len(in_flight) >= workers * 2:
+                    batch, future = in_flight.popleft()
+                    done(batch, future.result())
+            while in_flight:
+                batch, future = in_flight.popleft()
+                done(batch, future.result())
+    else:
+        model = resources.get_transformer_model()
+        for batch in batches:
+            questions = [question for question, _, _ in batch]
+            done(batch, model.encode(questions, batch_size=encode_batch_size, convert_to_numpy=True))
+
+    if build_index:
+        index = resources.get_query_index()
+        index.save()
+        print(f"FAISS index saved with {index.ntotal} rows")
+    return ingested
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-load question/SQL pairs into the query_embeddings collection.")
+    parser.add_argument("path", help="JSONL file with one question/SQL pair per line")
+    parser.add_argument("--batch-size", type=int, default=1024, help="pairs encoded and upserted together")
+    parser.add_argument("--encode-batch-size", type=int, default=128, help="batch size passed to encode")
+    parser.add_argument("--workers", type=int, default=0, help="encoder processes (0 encodes in this process)")
+    parser.add_argument("--question-field", default="question")
+    parser.add_argument("--sql-field", default="sql_query")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <path>.checkpoint)")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the top")
+    parser.add_argument("--build-index", action="store_true", help="sync and save the FAISS index afterwards")
+    args = parser.parse_args()
+
+    ingest(
+        args.path,
+        batch_size=args.batch_size,
+        encode_batch_size=args.encode_batch_size,
+        workers=args.workers,
+        question_field=args.question_field,
+        sql_field=args.sql_field,
+        checkpoint_path=args.checkpoint,
+        restart=args.restart,
+        build_index=args.build_index,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+
+import resources
+from answer_cache import question_id
+
+# Backends that turn (prompt, question) into the model's reply text. Every backend has
+#   async generate(prompt, question) -> full reply text
+#   stream(prompt, question)         -> async iterator of reply chunks
+# Leaving a stream early (break) stops the generation.
+#
+# LLM_BACKEND picks one:
+#   gemini  the Gemini API (default)
+#   stub    canned SQL for known questions, no network; for tests and load runs
+#   record  the Gemini API, saving each reply and its chunk timing to LLM_RECORD_FILE
+#   replay  replies from LLM_RECORD_FILE, played back with their recorded timing
+#
+# create_backend() puts an llm_client.LLMClient in front (coalescing, retries, hedging)
+# unless LLM_CLIENT_ENABLED=0.
+
+BACKEND = os.getenv("LLM_BACKEND", "gemini")
+RECORD_FILE = os.getenv("LLM_RECORD_FILE", "./llm_recordings.jsonl")
+
+# JSONL of {"question", "sql_query"} pairs the stub answers from, on top of few_shot_examples
+STUB_FILE = os.getenv("LLM_STUB_FILE")
+# Simulated time to first chunk and between chunks, in seconds
+STUB_LATENCY = float(os.getenv("LLM_STUB_LATENCY", "0"))
+STUB_CHUNK_DELAY = float(os.getenv("LLM_STUB_CHUNK_DELAY", "0"))
+STUB_CHUNK_SIZE = 40
+# Share of stub calls that fail with a TransientError, and share that take
+# STUB_SLOW_FACTOR times as long; for exercising retries and hedging
+STUB_FAILURE_RATE = float(os.getenv("LLM_STUB_FAILURE_RATE", "0"))
+STUB_SLOW_RATE = float(os.getenv("LLM_STUB_SLOW_RATE", "0"))
+STUB_SLOW_FACTOR = 10
+
+# Replay at this multiple of the recorded speed (2 halves every delay; 0 skips them)
+REPLAY_SPEED = float(os.getenv("LLM_REPLAY_SPEED", "1"))
+
+
+# Raised by a backend for a failure worth retrying (quota, overload, dropped connection)
+class TransientError(Exception):
+    pass
+
+
+def prompt_hash(prompt):
+    return hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+class GeminiBackend:
+    name = "gemini"
+
+    async def generate(self, prompt, question):
+        response = await resources.get_gemini_model().generate_content_async([prompt, question])
+        return response.text
+
+    async def stream(self, prompt, question):
+        response = await resources.get_gemini_model().generate_content_async([prompt, question], stream=True)
+        async for chunk in response:
+            yield chunk.text
+
+
+# Answers from a fixed question -> SQL table. Unknown questions get the SQL of the canned
+# question sharing the most words with them, so every question gets a deterministic reply.
+class StubBackend:
+    name = "stub"
+
+    def __init__(self, pairs=None, latency=STUB_LATENCY, chunk_delay=STUB_CHUNK_DELAY,
+                 failure_rate=STUB_FAILURE_RATE, slow_rate=STUB_SLOW_RATE):
+        if pairs is None:
+            from prompt_builder import few_shot_examples
+            pairs = [(example["question"], example["sql_query"]) for example in few_shot_examples]
+            if STUB_FILE:
+                pairs += load_pairs(STUB_FILE)
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.answers = {}
+        self.words = []
+        for question, sql in pairs:
+            self.answers[question_id(question)] = sql
+            self.words.append((_words(question), sql))
+
+    def answer(self, question):
+        sql = self.answers.get(question_id(question))
+        if sql is None:
+            words = _words(question)
+            sql = max(self.words, key=lambda entry: len(words & entry[0]))[1]
+        return "```sql\n" + " ".join(sql.split()) + "\n```"
+
+    # Wait out the time to first chunk, which may be slow or end in a simulated failure
+    async def _first_chunk(self):
+        latency = self.latency * (STUB_SLOW_FACTOR if random.random() < self.slow_rate else 1)
+        await asyncio.sleep(latency)
+        if random.random() < self.failure_rate:
+            raise TransientError("Stub backend: simulated overload")
+
+    async def generate(self, prompt, question):
+        text = self.answer(question)
+        chunks = -(-len(text) // STUB_CHUNK_SIZE)
+        await self._first_chunk()
+        await asyncio.sleep(self.chunk_delay * (chunks - 1))
+        return text
+
+    async def stream(self, prompt, question):
+        text = self.answer(question)
+        await self._first_chunk()
+        for i in range(0, len(text), STUB_CHUNK_SIZE):
+            if i and self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+            yield text[i:i + STUB_CHUNK_SIZE]
+
+
+def _words(text):
+    return set(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+# Function to read (question, sql) pairs from a JSONL file
+def load_pairs(path, question_field="question", sql_field="sql_query"):
+    pairs = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                pairs.append((record[question_field], record[sql_field]))
+    return pairs
+
+
+# Wraps another backend and appends every complete reply to a JSONL file as
+# {"id", "question", "prompt_hash", "latency", "complete", "chunks": [[seconds since the call, text], ...]}
+class RecordingBackend:
+    name = "record"
+
+    def __init__(self, inner, path=RECORD_FILE):
+        self.inner = inner
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _save(self, prompt, question, chunks, started, complete=True):
+        record = {
+            "id": question_id(question),
+            "question": question,
+            "prompt_hash": prompt_hash(prompt),
+            "latency": time.perf_counter() - started,
+            "complete": complete,
+            "chunks": chunks,
+        }
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+    async def generate(self, prompt, question):
+        started = time.perf_counter()
+        text = await self.inner.generate(prompt, question)
+        self._save(prompt, question, [[time.perf_counter() - started, text]], started)
+        return text
+
+    async def stream(self, prompt, question):
+        started = time.perf_counter()
+        chunks = []
+        complete = False
+        try:
+            async for text in self.inner.stream(prompt, question):
+                chunks.append([time.perf_counter() - started, text])
+                yield text
+            complete = True
+        finally:
+            # A stream left early (the pipeline stops once it has a statement) is saved
+            # as far as it got, which is all a replay of the same run will read
+            if chunks:
+                self._save(prompt, question, chunks, started, complete)
+
+
+# Plays back a RecordingBackend file. Replies are matched on the normalized question, so a
+# recording stays usable when prompt construction changes; the last recording of a question wins.
+class ReplayBackend:
+    name = "replay"
+
+    def __init__(self, path=RECORD_FILE, speed=REPLAY_SPEED):
+        self.speed = speed
+        self.recordings = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.recordings[record["id"]] = record
+
+    def _recording(self, question):
+        record = self.recordings.get(question_id(question))
+        if record is None:
+            raise LookupError(f"No recorded reply for question: {question}")
+        return record
+
+    async def _wait_until(self, started, offset):
+        if self.speed > 0:
+            delay = offset / self.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def generate(self, prompt, question):
+        record = self._recording(question)
+        await self._wait_until(time.perf_counter(), record["latency"])
+        return "".join(text for _, text in record["chunks"])
+
+    async def stream(self, prompt, question):
+        record = self._recording(question)
+        started = time.perf_counter()
+        for offset, text in record["chunks"]:
+            await self._wait_until(started, offset)
+            yield text
+
+
+# Token bucket: `rate` tokens per second, holding at most `burst`. acquire() waits for a
+# token; callers queue in arrival order on the event loop.
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # Take a token only if one is free right now; False while callers are queued for one
+    def try_acquire(self):
+        if self._lock.locked():
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+# Wraps another backend so calls start no faster than the bucket allows, e.g. to stay
+# under an API quota during batch runs. Time spent waiting counts towards the llm stage.
+class RateLimitedBackend:
+    def __init__(self, inner, bucket):
+        self.inner = inner
+        self.bucket = bucket
+        self.name = inner.name
+
+    async def generate(self, prompt, question):
+        await self.bucket.acquire()
+        return await self.inner.generate(prompt, question)
+
+    async def stream(self, prompt, question):
+        await self.bucket.acquire()
+        async for text in self.inner.stream(prompt, question):
+            yield text
+
+
+def _create(name):
+    if name == "gemini":
+        return GeminiBackend()
+    if name == "stub":
+        return StubBackend()
+    if name == "record":
+        return RecordingBackend(GeminiBackend())
+    if name == "replay":
+        return ReplayBackend()
+    raise ValueError(f"Unknown LLM_BACKEND: {name}")
+
+
+# Function to build the backend named by LLM_BACKEND (or `name`). With a token bucket,
+# every request waits for a token. The client takes the tokens itself, so its latency
+# samples leave out the wait, and it only hedges when a token is free straight away.
+def create_backend(name=BACKEND, bucket=None):
+    from llm_client import LLMClient, ENABLED as CLIENT_ENABLED
+
+    backend = _create(name)
+    if CLIENT_ENABLED:
+        return LLMClient(backend, bucket=bucket)
+    if bucket is not None:
+        backend = RateLimitedBackend(backend, bucket)
+    return backend
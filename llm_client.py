@@ -0,0 +1,300 @@
+import os
+import time
+import random
+import asyncio
+from collections import deque
+
+import telemetry
+from answer_cache import question_id
+from llm_backend import prompt_hash, TransientError
+
+# Client layer in front of an LLM backend, with the same generate/stream interface.
+#
+#   coalescing  concurrent calls with the same prompt and question share one request;
+#               a caller joining a stream gets the chunks so far, then the rest
+#   retries     transient failures (quota, overload, 5xx, timeouts, dropped connections)
+#               are retried up to LLM_MAX_RETRIES times, sleeping a random time of up to
+#               LLM_BACKOFF_BASE * 2**attempt seconds (at most LLM_BACKOFF_MAX) in between
+#   hedging     once LLM_HEDGE_MIN_SAMPLES requests have completed, a request still waiting
+#               past the LLM_HEDGE_PERCENTILE latency gets an identical second request;
+#               whichever answers first is used and the other is cancelled
+#   rate limit  with a token bucket, each request (retries included) waits for a token
+#               before it is timed; a hedge is only sent if a token is free at once
+#
+# For a stream, latency means time to the first chunk, and only that part is retried or
+# hedged: once a caller has seen text, a failure is passed on. The client keeps its
+# state on the event loop that calls it, i.e. pipeline's background loop.
+
+ENABLED = os.getenv("LLM_CLIENT_ENABLED", "1") != "0"
+COALESCE = os.getenv("LLM_COALESCE", "1") != "0"
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "20"))
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))  # 0 turns hedging off
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+# Request latencies kept per kind, for the hedge threshold and stats()
+LATENCY_WINDOW = 500
+
+# google.api_core exception classes worth retrying, matched by name so the client does
+# not depend on the Gemini SDK
+_TRANSIENT_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "BadGateway", "GatewayTimeout", "DeadlineExceeded", "Aborted",
+}
+
+
+# Function to decide whether a failed request is worth retrying
+def is_transient(error):
+    if isinstance(error, (TransientError, TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    if type(error).__name__ in _TRANSIENT_NAMES:
+        return True
+    # HTTP status on API errors: timeouts, rate limits and server errors
+    code = getattr(error, "code", None)
+    return isinstance(code, int) and (code in (408, 429) or 500 <= code < 600)
+
+
+# Nearest-rank percentile of a list of numbers
+def _percentile(values, p):
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+# One in-flight generate() shared by every caller with the same key. The request is
+# cancelled once every caller has gone.
+class _SharedReply:
+    def __init__(self, task):
+        self.task = task
+        self.callers = 0
+
+
+# One in-flight stream shared by every reader with the same key. Chunks are kept so a
+# reader joining late starts from the beginning.
+class _SharedStream:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def read(self):
+        position = 0
+        while True:
+            if position < len(self.chunks):
+                position += 1
+                yield self.chunks[position - 1]
+            elif self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                await self._changed.wait()
+
+
+class LLMClient:
+    def __init__(self, inner, coalesce=COALESCE, max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE,
+                 backoff_max=BACKOFF_MAX, hedge_percentile=HEDGE_PERCENTILE, hedge_min_samples=HEDGE_MIN_SAMPLES,
+                 bucket=None):
+        self.inner = inner
+        self.bucket = bucket
+        self.name = inner.name
+        self.coalesce = coalesce
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._replies = {}
+        self._streams = {}
+        self._latencies = {"generate": deque(maxlen=LATENCY_WINDOW), "stream": deque(maxlen=LATENCY_WINDOW)}
+        self._stats = {
+            "calls": 0,
+            "requests": 0,
+            "coalesced": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "errors": 0,
+        }
+
+    def _count(self, name):
+        self._stats[name] += 1
+        if name in ("coalesced", "retries", "hedges", "hedge_wins"):
+            telemetry.llm_client_events.inc(event=name)
+
+    async def generate(self, prompt, question):
+        self._count("calls")
+        key = (prompt_hash(prompt), question_id(question))
+        shared = self._replies.get(key) if self.coalesce else None
+        if shared is None:
+            shared = _SharedReply(asyncio.ensure_future(self._with_retries("generate", lambda: self._request(prompt, question))))
+            if self.coalesce:
+                self._replies[key] = shared
+                shared.task.add_done_callback(lambda _: self._forget(self._replies, key, shared))
+        else:
+            self._count("coalesced")
+        shared.callers += 1
+        try:
+            return await asyncio.shield(shared.task)
+        finally:
+            shared.callers -= 1
+            if shared.callers == 0 and not shared.task.done():
+                shared.task.cancel()
+
+    async def stream(self, prompt, question):
+        self._count("calls")
+        key = (prompt_hash(prompt), question_id(question))
+        shared = self._streams.get(key) if self.coalesce else None
+        if shared is None:
+            shared = _SharedStream()
+            shared.task = asyncio.ensure_future(self._produce(shared, prompt, question))
+            if self.coalesce:
+                self._streams[key] = shared
+                shared.task.add_done_callback(lambda _: self._forget(self._streams, key, shared))
+        else:
+            self._count("coalesced")
+        shared.readers += 1
+        reader = shared.read()
+        try:
+            async for text in reader:
+                yield text
+        finally:
+            await reader.aclose()
+            shared.readers -= 1
+            if shared.readers == 0 and not shared.task.done():
+                shared.task.cancel()
+
+    @staticmethod
+    def _forget(inflight, key, shared):
+        if inflight.get(key) is shared:
+            del inflight[key]
+
+    # Run the backend stream once (with retries and hedging up to the first chunk) into `shared`
+    async def _produce(self, shared, prompt, question):
+        stream = None
+        try:
+            stream, first = await self._with_retries("stream", lambda: self._open_stream(prompt, question))
+            if first is not None:
+                shared.chunks.append(first)
+                shared.notify()
+                async for text in stream:
+                    shared.chunks.append(text)
+                    shared.notify()
+        except Exception as e:
+            shared.error = e
+        finally:
+            if stream is not None:
+                await stream.aclose()
+            shared.done = True
+            shared.notify()
+
+    # One generate request, timed
+    async def _request(self, prompt, question):
+        self._stats["requests"] += 1
+        started = time.perf_counter()
+        text = await self.inner.generate(prompt, question)
+        self._record("generate", time.perf_counter() - started)
+        return text
+
+    # Open one backend stream and wait for its first chunk; returns (stream, first chunk or None)
+    async def _open_stream(self, prompt, question):
+        self._stats["requests"] += 1
+        started = time.perf_counter()
+        stream = self.inner.stream(prompt, question)
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except BaseException:
+            await stream.aclose()
+            raise
+        self._record("stream", time.perf_counter() - started)
+        return stream, first
+
+    def _record(self, kind, seconds):
+        self._latencies[kind].append(seconds)
+        telemetry.llm_request_seconds.observe(seconds, kind=kind)
+
+    # Seconds after which a request of this kind gets a hedge, or None while there are too few samples
+    def _hedge_delay(self, kind):
+        samples = self._latencies[kind]
+        if not self.hedge_percentile or len(samples) < self.hedge_min_samples:
+            return None
+        return _percentile(samples, self.hedge_percentile)
+
+    async def _with_retries(self, kind, request):
+        attempt = 0
+        while True:
+            try:
+                return await self._hedged(kind, request)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_transient(e):
+                    self._count("errors")
+                    raise
+                # Full jitter, so callers that failed together do not retry together
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                attempt += 1
+                self._count("retries")
+                await asyncio.sleep(delay)
+
+    # Run request(); if it is still going after the hedge delay, race a second copy against it.
+    # The token is taken before request() starts, so neither its latency sample nor the
+    # hedge delay includes time spent queued behind the rate limit.
+    async def _hedged(self, kind, request):
+        if self.bucket is not None:
+            await self.bucket.acquire()
+        delay = self._hedge_delay(kind)
+        first = asyncio.ensure_future(request())
+        if delay is None:
+            return await first
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # While the bucket is throttling a hedge would only queue for a token too
+            if not done and (self.bucket is None or self.bucket.try_acquire()):
+                self._count("hedges")
+                tasks.add(asyncio.ensure_future(request()))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None:
+                    if winner is not first:
+                        self._count("hedge_wins")
+                    for task in done - {winner}:
+                        await self._discard(kind, task)
+                    return winner.result()
+                error = next(iter(done)).exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # Close the stream of a hedge that finished alongside the winner
+    @staticmethod
+    async def _discard(kind, task):
+        if kind == "stream" and task.exception() is None:
+            await task.result()[0].aclose()
+
+    # Counts plus p50/p95/p99 request latency per kind, in seconds
+    def stats(self):
+        stats = dict(self._stats)
+        stats["in_flight"] = len(self._replies) + len(self._streams)
+        for kind, samples in self._latencies.items():
+            if samples:
+                stats[kind] = {
+                    "samples": len(samples),
+                    "p50": _percentile(samples, 50),
+                    "p95": _percentile(samples, 95),
+                    "p99": _percentile(samples, 99),
+                    "hedge_after": self._hedge_delay(kind),
+                }
+        return stats
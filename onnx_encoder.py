@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+
+import numpy as np
+
+# The question encoder (all-MiniLM-L6-v2 by default) exported to ONNX and run with
+# onnxruntime, optionally with int8 weights. Same encode() interface as the
+# SentenceTransformer it replaces, without loading torch: a smaller model file, less
+# memory and less CPU per question.
+#
+#   python onnx_encoder.py export ./onnx_encoder        # writes model.onnx, model_int8.onnx, tokenizer.json
+#   python onnx_encoder.py report questions.jsonl       # cosine agreement and speed against the reference
+#
+# Experimental and off by default. Embeddings from this encoder are compared with the
+# stored ones, so it is only loaded (EMBEDDING_BACKEND=onnx, see resources.load_encoder)
+# if the agreement export measured for the chosen file is at least MIN_COSINE. Check a
+# real question set with `report` before switching. Export needs sentence-transformers,
+# torch and onnxruntime; running needs onnxruntime and tokenizers.
+
+MODEL_DIR = os.getenv("EMBEDDING_ONNX_DIR", "./onnx_encoder")
+# Use the int8 model; 0 uses the float32 export
+INT8 = os.getenv("EMBEDDING_ONNX_INT8", "1") != "0"
+# Lowest mean cosine to the reference model, as recorded by export, that the encoder loads with
+MIN_COSINE = float(os.getenv("EMBEDDING_ONNX_MIN_COSINE", "0.99"))
+
+
+class OnnxEncoder:
+    def __init__(self, model_dir=MODEL_DIR, threads=0, int8=INT8, min_cosine=MIN_COSINE):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, "encoder_meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        variant = "int8" if int8 else "fp32"
+        if min_cosine:
+            measured = self.meta.get("agreement", {}).get(variant, {}).get("mean_cosine")
+            if measured is None or measured < min_cosine:
+                raise ValueError(
+                    f"ONNX encoder in {model_dir} ({variant}) has mean cosine {measured} to the reference model, "
+                    f"below EMBEDDING_ONNX_MIN_COSINE={min_cosine}; re-export it or use EMBEDDING_BACKEND=torch"
+                )
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        # One question at a time is the common case; parallelism inside the ops is what helps
+        options.inter_op_num_threads = 1
+        if threads:
+            options.intra_op_num_threads = threads
+        model_file = "model_int8.onnx" if int8 else "model.onnx"
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, model_file), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(self.meta["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.meta["pad_token_id"], pad_token=self.meta["pad_token"])
+        # Embeddings from different encoders must not share cache entries
+        self.cache_id = f"onnx:{self.meta['model']}:{variant}"
+
+    def get_sentence_embedding_dimension(self):
+        return self.meta["dim"]
+
+    def _encode_batch(self, sentences):
+        encodings = self.tokenizer.encode_batch(sentences)
+        mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        feeds = {"input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64), "attention_mask": mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+        hidden = self.session.run(None, feeds)[0]
+        # Mean pooling over the real tokens, as the model's Pooling module does
+        weights = mask[..., None].astype(np.float32)
+        return (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+
+    # Same arguments as SentenceTransformer.encode; returns a float32 numpy array
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, normalize_embeddings=False, **kwargs):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        # Longest first, so each batch pads to a similar length
+        order = np.argsort([-len(sentence) for sentence in sentences], kind="stable")
+        embeddings = np.zeros((len(sentences), self.meta["dim"]), dtype=np.float32)
+        for start in range(0, len(sentences), batch_size):
+            batch = order[start:start + batch_size]
+            embeddings[batch] = self._encode_batch([sentences[i] for i in batch])
+        if self.meta["normalize"] or normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings[0] if single else embeddings
+
+
+# Function to measure how closely an encoder reproduces the reference model's embeddings.
+# top1_agreement is the share of sentences whose nearest other sentence is the same under both.
+def agreement(encoder, reference, sentences, batch_size=32):
+    expected = reference.encode(sentences, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+    actual = encoder.encode(sentences, batch_size=batch_size, normalize_embeddings=True)
+    cosines = (expected * actual).sum(axis=1)
+    report = {
+        "sentences": len(sentences),
+        "mean_cosine": float(cosines.mean()),
+        "min_cosine": float(cosines.min()),
+    }
+    if len(sentences) > 1:
+        nearest = []
+        for vectors in (expected, actual):
+            similarity = vectors @ vectors.T
+            np.fill_diagonal(similarity, -np.inf)
+            nearest.append(similarity.argmax(axis=1))
+        report["top1_agreement"] = float((nearest[0] == nearest[1]).mean())
+    return report
+
+
+# Function to export a SentenceTransformer to ONNX (plus an int8 copy) in out_dir.
+# The agreement of both files on the few-shot questions is stored in encoder_meta.json.
+def export(out_dir=MODEL_DIR, model_name=None, opset=14):
+    import torch
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, Pooling
+    import resources
+    from prompt_builder import few_shot_examples
+
+    model_name = model_name or resources.EMBEDDING_MODEL_NAME
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0]
+    pooling = next(module for module in model if isinstance(module, Pooling))
+    # sentence-transformers 2-5 has one flag per mode, 6 a single pooling_mode
+    config = pooling.get_config_dict()
+    if not (config.get("pooling_mode_mean_tokens") or config.get("pooling_mode") == "mean"):
+        raise ValueError(f"{model_name} does not use mean pooling")
+    tokenizer = transformer.tokenizer
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer.save_pretrained(out_dir)
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, inner):
+            super().__init__()
+            self.inner = inner
+
+        def forward(self, *inputs):
+            return self.inner(*inputs)[0]
+
+    sample = tokenizer(["How many films are in the inventory?"], return_tensors="pt")
+    # Positional order of BertModel.forward
+    names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    axes = {name: {0: "batch", 1: "sequence"} for name in names + ["last_hidden_state"]}
+    fp32_path = os.path.join(out_dir, "model.onnx")
+    int8_path = os.path.join(out_dir, "model_int8.onnx")
+    # dynamic_axes is for the TorchScript exporter, which torch 2.9+ no longer uses by default
+    legacy = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            LastHiddenState(transformer.auto_model.eval()), tuple(sample[name] for name in names), fp32_path,
+            input_names=names, output_names=["last_hidden_state"], dynamic_axes=axes, opset_version=opset, **legacy,
+        )
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+
+    meta = {
+        "model": model_name,
+        "dim": model.get_sentence_embedding_dimension(),
+        "max_seq_length": model.max_seq_length,
+        "normalize": any(isinstance(module, Normalize) for module in model),
+        "pad_token": tokenizer.pad_token,
+        "pad_token_id": tokenizer.pad_token_id,
+    }
+    meta_path = os.path.join(out_dir, "encoder_meta.json")
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+    questions = [example["question"] for example in few_shot_examples]
+    meta["agreement"] = {
+        "fp32": agreement(OnnxEncoder(out_dir, int8=False, min_cosine=0), model, questions),
+        "int8": agreement(OnnxEncoder(out_dir, int8=True, min_cosine=0), model, questions),
+    }
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def _per_question_ms(encoder, sentences):
+    start = time.perf_counter()
+    for sentence in sentences:
+        encoder.encode([sentence])
+    return (time.perf_counter() - start) / len(sentences) * 1000
+
+
+# Function to compare the ONNX encoders with the reference model on a list of questions
+def report(sentences, model_dir=MODEL_DIR, threads=0):
+    import resources
+
+    reference = resources.load_encoder(threads, backend="torch")
+    rows = [{"encoder": "torch fp32", "ms_per_question": _per_question_ms(reference, sentences)}]
+    for int8 in (False, True):
+        path = os.path.join(model_dir, "model_int8.onnx" if int8 else "model.onnx")
+        encoder = OnnxEncoder(model_dir, threads, int8, min_cosine=0)
+        rows.append({
+            "encoder": "onnx int8" if int8 else "onnx fp32",
+            "ms_per_question": _per_question_ms(encoder, sentences),
+            "model_mb": os.path.getsize(path) / (1024 * 1024),
+            **agreement(encoder, reference, sentences),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the question encoder to ONNX and check it.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="export the embedding model to ONNX and int8")
+    export_parser.add_argument("out_dir", nargs="?", default=MODEL_DIR)
+    export_parser.add_argument("--model", help="SentenceTransformer name (default EMBEDDING_MODEL)")
+    report_parser = commands.add_parser("report", help="agreement and speed against the reference model")
+    report_parser.add_argument("path", help="JSONL file with one question per line")
+    report_parser.add_argument("--question-field", default="question")
+    report_parser.add_argument("--model-dir", default=MODEL_DIR)
+    report_parser.add_argument("--threads", type=int, default=0, help="intra-op threads (0 = library default)")
+    report_parser.add_argument("--limit", type=int, default=1000, help="questions used")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        meta = export(args.out_dir, args.model)
+        for name, figures in meta["agreement"].items():
+            print(f"{name}: mean cosine {figures['mean_cosine']:.4f}, min {figures['min_cosine']:.4f}")
+        print(f"Encoder written to {args.out_dir}")
+        return
+
+    from bench import read_questions
+    sentences = read_questions(args.path, args.question_field)[:args.limit]
+    if not sentences:
+        sys.exit(f"No questions found in {args.path}")
+    print(f"{'encoder':<12}{'ms/question':>13}{'model MB':>10}{'mean cos':>10}{'min cos':>10}{'top-1':>8}")
+    for row in report(sentences, args.model_dir, args.threads):
+        if "mean_cosine" in row:
+            print(f"{row['encoder']:<12}{row['ms_per_question']:>13.2f}{row['model_mb']:>10.1f}"
+                  f"{row['mean_cosine']:>10.4f}{row['min_cosine']:>10.4f}{row.get('top1_agreement', 1.0):>8.3f}")
+        else:
+            print(f"{row['encoder']:<12}{row['ms_per_question']:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
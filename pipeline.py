@@ -0,0 +1,375 @@
+import os
+import time
+import queue
+import asyncio
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import resources
+import telemetry
+from answer_cache import answer_cache
+from embedding_cache import embedding_cache, ENABLED as EMBEDDING_CACHE_ENABLED
+from db_pool import get_pool, DB_ENGINE, POOL_MAX_SIZE, STREAM_BATCH_SIZE
+from prompt_builder import build_prompt
+from result_cache import result_cache, cached_batches, caching_batches, ENABLED as RESULT_CACHE_ENABLED
+from result_pager import ResultPager
+from schema_catalog import prompt_schema_key
+from sql_extract import StatementExtractor, extract_sql
+import sql_guard
+import query_log
+
+# Question -> SQL -> rows, as an asyncio pipeline.
+#
+# The question is embedded first. Retrieval from the query index and the schema
+# check then run concurrently, and with SPECULATIVE_LLM the Gemini call starts as
+# soon as the schema is known instead of waiting for retrieval; if retrieval turns
+# up a reusable answer the call is cancelled, but the request has already been sent
+# and counts against the quota. Blocking work (encode, ChromaDB,
+# mysql.connector) runs on bounded thread pools so it never stalls the event loop.
+
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_USER = os.getenv("DB_USER", "root")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "root")
+DB_NAME = os.getenv("DB_NAME", "sakila1")
+
+# Per-stage timeouts in seconds
+EMBED_TIMEOUT = float(os.getenv("PIPELINE_EMBED_TIMEOUT", "10"))
+RETRIEVE_TIMEOUT = float(os.getenv("PIPELINE_RETRIEVE_TIMEOUT", "5"))
+SCHEMA_TIMEOUT = float(os.getenv("PIPELINE_SCHEMA_TIMEOUT", "5"))
+LLM_TIMEOUT = float(os.getenv("PIPELINE_LLM_TIMEOUT", "60"))
+GUARD_TIMEOUT = float(os.getenv("PIPELINE_GUARD_TIMEOUT", "5"))
+EXECUTE_TIMEOUT = float(os.getenv("PIPELINE_EXECUTE_TIMEOUT", "30"))
+
+# Stream the Gemini reply and start executing as soon as the first complete statement
+# has arrived, instead of waiting for the model to finish explaining it
+STREAM_LLM = os.getenv("PIPELINE_STREAM_LLM", "1") != "0"
+
+# Start the LLM call before retrieval finishes. The prompt then uses the static
+# few-shot examples only, since retrieved past questions are not known yet. Off by
+# default: every answer-cache hit would still spend a Gemini request and rate-limit token.
+SPECULATIVE_LLM = os.getenv("PIPELINE_SPECULATIVE_LLM", "0") != "0"
+
+# Encoding and FAISS search are CPU bound; database and ChromaDB calls wait on I/O
+_cpu_executor = ThreadPoolExecutor(max_workers=int(os.getenv("PIPELINE_CPU_WORKERS", "2")), thread_name_prefix="pipeline-cpu")
+_io_executor = ThreadPoolExecutor(max_workers=POOL_MAX_SIZE, thread_name_prefix="pipeline-io")
+
+STAGE_ERRORS = {
+    "embed": "Error embedding question",
+    "retrieve": "Semantic search failed",
+    "schema": "Schema lookup failed",
+    "llm": "Error generating response from Gemini model",
+    "guard": "Query rejected",
+    "execute": "Database error",
+}
+
+
+class PipelineError(Exception):
+    def __init__(self, stage, message):
+        super().__init__(message)
+        self.stage = stage
+
+
+# Function to embed a question with the shared encoder, reusing the embedding of an
+# earlier question with the same normalized text
+def embed_question(question, trace=telemetry.NULL_TRACE):
+    model = resources.get_transformer_model()
+    if not EMBEDDING_CACHE_ENABLED:
+        return model.encode([question])
+    embedding, source = embedding_cache.encode(model, resources.embedding_model_id(), question)
+    telemetry.record_cache("embedding", source != "encoded")
+    trace.annotate("embed", embedding_cache=source)
+    return embedding
+
+
+# Function to find the stored questions closest to an embedded question
+def search_similar(question_embedding, top_k=3):
+    index = resources.get_query_index()
+    if index.ntotal == 0:
+        return []
+    return index.search(question_embedding, top_k)
+
+
+# Function to ask the LLM backend for the SQL; returns (response text, extracted SQL).
+# The backends are async so the call can be cancelled. Time spent extracting the SQL,
+# which overlaps the generation when streaming, is added to timings["extract"].
+async def generate_sql(question, prompt, on_text=None, timings=None):
+    timings = {} if timings is None else timings
+    backend = resources.get_llm_backend()
+    if not STREAM_LLM:
+        text = (await backend.generate(prompt, question)).strip()
+        start = time.perf_counter()
+        sql = extract_sql(text)
+        timings["extract"] = time.perf_counter() - start
+        return text, sql
+
+    extractor = StatementExtractor()
+    text = ""
+    timings["extract"] = 0.0
+    stream = backend.stream(prompt, question)
+    try:
+        async for chunk in stream:
+            text += chunk
+            if on_text:
+                on_text(text)
+            start = time.perf_counter()
+            complete = extractor.feed(chunk)
+            timings["extract"] += time.perf_counter() - start
+            if complete:
+                # Leaving the loop drops the stream, which cancels the rest of the generation
+                break
+    finally:
+        await stream.aclose()
+    return text.strip(), extractor.statement
+
+
+# Function to check the SQL before it runs: read-only, LIMIT capped, plan cost within
+# budget, execution time bounded. Returns sql_guard's {"sql", "warnings", ...}.
+def guard_query(query, host=DB_HOST, user=DB_USER, password=DB_PASSWORD, database=DB_NAME):
+    return sql_guard.guard_sql(query, get_pool(host, user, password, database))
+
+
+# Function to open a query's results as a pager holding the first page, from the result
+# cache when possible. Every execution goes to the query log; rows_examined is the
+# guard's plan estimate, when there is one.
+def open_results(query, host=DB_HOST, user=DB_USER, password=DB_PASSWORD, database=DB_NAME,
+                 trace=telemetry.NULL_TRACE, rows_examined=None):
+    started = time.perf_counter()
+    cached = result_cache.get(query, database) if RESULT_CACHE_ENABLED else None
+    if RESULT_CACHE_ENABLED:
+        telemetry.record_cache("result", cached is not None)
+        trace.annotate("execute", result_cache="hit" if cached else "miss")
+    try:
+        if cached:
+            batches = cached_batches(*cached, STREAM_BATCH_SIZE)
+        else:
+            # Taken before the query runs, so a write made meanwhile keeps the result out of the cache
+            versions = result_cache.versions(query, database) if RESULT_CACHE_ENABLED else None
+            batches = get_pool(host, user, password, database).stream(query)
+            if RESULT_CACHE_ENABLED:
+                batches = caching_batches(batches, query, database, result_cache, versions)
+        pager = ResultPager(batches)
+        pager.fetch_next()
+    except Exception as e:
+        query_log.record(query, database, DB_ENGINE, time.perf_counter() - started, 0, rows_examined, error=type(e).__name__)
+        raise
+    query_log.record(
+        query, database, DB_ENGINE, time.perf_counter() - started, len(pager.rows), rows_examined,
+        cached=cached is not None, more=not pager.exhausted
+    )
+    return pager
+
+
+def _in_executor(executor, func, *args):
+    return asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+def _close_abandoned(job):
+    if not job.cancelled() and job.exception() is None:
+        job.result().close()
+
+
+# Function to open a query's results on the I/O pool. If the pipeline stops waiting
+# (the execute stage timed out or the question was cancelled), the job still runs to
+# the end; the pager it returns is then closed so its pooled connection goes back.
+async def _open_results_async(query, **kwargs):
+    job = _io_executor.submit(partial(open_results, query, **kwargs))
+    try:
+        return await asyncio.wrap_future(job)
+    except asyncio.CancelledError:
+        job.add_done_callback(_close_abandoned)
+        raise
+
+
+# Run one stage with a timeout, recording how long it took in the timings and as a
+# trace span. A timed-out executor job keeps running on its thread, but the pipeline
+# stops waiting for it.
+async def _stage(result, name, awaitable, timeout):
+    start = time.perf_counter()
+    span = result["trace"].span(name)
+    error = None
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        error = PipelineError(name, f"{STAGE_ERRORS[name]}: timed out after {timeout:.0f}s")
+        raise error
+    except asyncio.CancelledError:
+        span.set(cancelled=True)
+        raise
+    except PipelineError as e:
+        error = e
+        raise
+    except Exception as e:
+        error = PipelineError(name, f"{STAGE_ERRORS[name]}: {e}")
+        raise error
+    finally:
+        result["timings"][name] = time.perf_counter() - start
+        span.end(error)
+
+
+# Run the whole question flow. Never raises for stage failures: the returned dict
+# carries whatever was produced, plus error/error_stage when a stage failed.
+# Progress events (kind, value) are put on `events`, a thread-safe queue, if given.
+# store_answer=False keeps new answers out of the answer cache (e.g. for benchmarks).
+async def run_question(question, use_answer_cache=True, events=None, store_answer=True):
+    result = {
+        "question": question,
+        "similar_queries": [],
+        "cached_answer": None,
+        "prompt_info": None,
+        "response": None,
+        "sql": None,
+        "executed_sql": None,
+        "pager": None,
+        "warnings": [],
+        "error": None,
+        "error_stage": None,
+        "timings": {},
+        "trace": telemetry.start_trace("question", question=question),
+    }
+    trace = result["trace"]
+    tasks = []
+
+    def start(coroutine):
+        task = asyncio.ensure_future(coroutine)
+        tasks.append(task)
+        return task
+
+    def emit(kind, value):
+        if events is not None:
+            events.put((kind, value))
+
+    def on_text(text):
+        if "llm_first_chunk" not in result["timings"]:
+            result["timings"]["llm_first_chunk"] = time.perf_counter() - started
+        emit("llm_text", text)
+
+    def start_llm(similar_queries, key):
+        with trace.span("prompt") as span:
+            prompt, info = build_prompt(question, embedding, similar_queries, schema_key=key)
+            span.set(prompt_tokens=info["prompt_tokens"], tokens_saved=info["tokens_saved"],
+                     examples=len(info["examples"]), tables=len(info["tables"]))
+        telemetry.prompt_tokens.observe(info["prompt_tokens"])
+        result["prompt_info"] = info
+        return start(_stage(result, "llm", generate_sql(question, prompt, on_text, result["timings"]), LLM_TIMEOUT))
+
+    async def schema_key():
+        try:
+            return await schema
+        except PipelineError as e:
+            result["warnings"].append(str(e))
+            return "static"
+
+    started = time.perf_counter()
+    try:
+        embedding = await _stage(result, "embed", _in_executor(_cpu_executor, embed_question, question, trace), EMBED_TIMEOUT)
+
+        retrieval = start(_stage(result, "retrieve", _in_executor(_io_executor, search_similar, embedding), RETRIEVE_TIMEOUT))
+        schema = start(_stage(
+            result, "schema",
+            _in_executor(_io_executor, prompt_schema_key, DB_HOST, DB_USER, DB_PASSWORD, DB_NAME),
+            SCHEMA_TIMEOUT
+        ))
+
+        llm = None
+        if SPECULATIVE_LLM:
+            llm = start_llm((), await schema_key())
+
+        try:
+            result["similar_queries"] = await retrieval
+            trace.annotate("retrieve", matches=len(result["similar_queries"]))
+            if not result["similar_queries"]:
+                result["warnings"].append("No embeddings found in ChromaDB.")
+        except PipelineError as e:
+            # Retrieval only improves the answer; carry on without it
+            result["warnings"].append(str(e))
+
+        result["cached_answer"] = answer_cache.lookup(result["similar_queries"], bypass=not use_answer_cache)
+        if use_answer_cache:
+            telemetry.record_cache("answer", result["cached_answer"] is not None)
+        if result["cached_answer"]:
+            if llm is not None:
+                llm.cancel()
+            result["response"] = result["cached_answer"]["sql_query"]
+            extract_started = time.perf_counter()
+            with trace.span("extract", source="answer_cache"):
+                result["sql"] = extract_sql(result["response"])
+            result["timings"]["extract"] = time.perf_counter() - extract_started
+        else:
+            if llm is None:
+                llm = start_llm(result["similar_queries"], await schema_key())
+            result["response"], result["sql"] = await llm
+            trace.annotate("llm", response_chars=len(result["response"]), first_chunk=result["timings"].get("llm_first_chunk"))
+            answer_cache.record_llm_latency(result["timings"]["llm"])
+
+        emit("sql", result["sql"])
+        if not result["sql"]:
+            raise PipelineError("extract", "Could not extract SQL query from Gemini response.")
+
+        result["executed_sql"] = result["sql"]
+        estimated_rows = None
+        if sql_guard.ENABLED:
+            guarded = await _stage(result, "guard", _in_executor(_io_executor, guard_query, result["sql"]), GUARD_TIMEOUT)
+            result["executed_sql"] = guarded["sql"]
+            result["warnings"].extend(guarded["warnings"])
+            estimated_rows = guarded["estimated_rows"]
+            trace.annotate("guard", estimated_rows=estimated_rows, warnings=len(guarded["warnings"]))
+
+        result["pager"] = await _stage(
+            result, "execute",
+            _open_results_async(result["executed_sql"], trace=trace, rows_examined=estimated_rows),
+            EXECUTE_TIMEOUT
+        )
+        trace.annotate("execute", rows=len(result["pager"].rows), truncated=result["pager"].truncated)
+        telemetry.result_rows.observe(len(result["pager"].rows))
+        if store_answer and result["pager"].rows and not result["cached_answer"]:
+            answer_cache.store_async(question, result["sql"], embedding)
+    except PipelineError as e:
+        result["error"] = str(e)
+        result["error_stage"] = e.stage
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # Mark failures of abandoned stages as seen
+        result["timings"]["total"] = time.perf_counter() - started
+        trace.set(cached_answer=result["cached_answer"] is not None, error_stage=result["error_stage"])
+        trace.finish(result["error"])
+    return result
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+# The pipeline runs on one long-lived event loop in a background thread, so async
+# clients created on it (such as Gemini's) stay bound to a loop that keeps running
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True, name="pipeline-loop").start()
+        return _loop
+
+
+# Function to run a coroutine on the pipeline loop from synchronous code and wait for it
+def run_sync(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_loop()).result()
+
+
+# Function for synchronous callers such as the Streamlit app. on_event(kind, value) is
+# called on the caller's thread while the pipeline runs, e.g. with the partial reply.
+def answer_question(question, use_answer_cache=True, on_event=None):
+    events = queue.Queue() if on_event else None
+    future = asyncio.run_coroutine_threadsafe(run_question(question, use_answer_cache, events), _get_loop())
+    while on_event and not future.done():
+        try:
+            on_event(*events.get(timeout=0.05))
+        except queue.Empty:
+            pass
+    result = future.result()
+    while events is not None and not events.empty():
+        on_event(*events.get_nowait())
+    return result
@@ -0,0 +1,392 @@
+import os
+import re
+import math
+from functools import lru_cache
+
+import numpy as np
+
+from result_cache import tables_read
+
+# Number of examples and whether the schema is pruned to the tables a question needs
+EXAMPLES_K = int(os.getenv("PROMPT_EXAMPLES_K", "3"))
+PRUNE_SCHEMA = os.getenv("PROMPT_PRUNE_SCHEMA", "1") != "0"
+
+# Sakila schema: table -> (column, type, description). Foreign keys are read from the
+# "Foreign key referencing `table.column`" descriptions.
+SCHEMA = {
+    "actor": [
+        ("actor_id", "INT", "Primary key, unique identifier for each actor."),
+        ("first_name", "VARCHAR", "First name of the actor."),
+        ("last_name", "VARCHAR", "Last name of the actor."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "film": [
+        ("film_id", "INT", "Primary key, unique identifier for each film."),
+        ("title", "VARCHAR", "Title of the film."),
+        ("description", "TEXT", "Description or summary of the film."),
+        ("release_year", "YEAR", "Year of the film's release."),
+        ("language_id", "TINYINT", "Foreign key referencing `language.language_id`."),
+        ("rental_duration", "TINYINT", "Number of days the film can be rented."),
+        ("rental_rate", "DECIMAL", "Rental rate per day for the film."),
+        ("length", "SMALLINT", "Duration of the film in minutes."),
+        ("replacement_cost", "DECIMAL", "Cost to replace the film if lost or damaged."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "film_actor": [
+        ("actor_id", "INT", "Foreign key referencing `actor.actor_id`."),
+        ("film_id", "INT", "Foreign key referencing `film.film_id`."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "category": [
+        ("category_id", "INT", "Primary key, unique identifier for each category."),
+        ("name", "VARCHAR", "Name of the category."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "film_category": [
+        ("film_id", "INT", "Foreign key referencing `film.film_id`."),
+        ("category_id", "INT", "Foreign key referencing `category.category_id`."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "language": [
+        ("language_id", "TINYINT", "Primary key, unique identifier for each language."),
+        ("name", "CHAR", "Name of the language."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "inventory": [
+        ("inventory_id", "INT", "Primary key, unique identifier for each inventory item."),
+        ("film_id", "INT", "Foreign key referencing `film.film_id`."),
+        ("store_id", "INT", "Foreign key referencing `store.store_id`."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "store": [
+        ("store_id", "INT", "Primary key, unique identifier for each store."),
+        ("manager_staff_id", "INT", "Foreign key referencing `staff.staff_id`."),
+        ("address_id", "INT", "Foreign key referencing `address.address_id`."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "staff": [
+        ("staff_id", "INT", "Primary key, unique identifier for each staff member."),
+        ("first_name", "VARCHAR", "First name of the staff member."),
+        ("last_name", "VARCHAR", "Last name of the staff member."),
+        ("address_id", "INT", "Foreign key referencing `address.address_id`."),
+        ("email", "VARCHAR", "Email address of the staff member."),
+        ("store_id", "INT", "Foreign key referencing `store.store_id`."),
+        ("active", "BOOLEAN", "Indicates if the staff member is active."),
+        ("username", "VARCHAR", "Username for staff login."),
+        ("password", "VARCHAR", "Password for staff login."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "address": [
+        ("address_id", "INT", "Primary key, unique identifier for each address."),
+        ("address", "VARCHAR", "Street address."),
+        ("district", "VARCHAR", "District or region."),
+        ("city_id", "INT", "Foreign key referencing `city.city_id`."),
+        ("postal_code", "VARCHAR", "Postal code."),
+        ("phone", "VARCHAR", "Phone number."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "city": [
+        ("city_id", "INT", "Primary key, unique identifier for each city."),
+        ("city", "VARCHAR", "Name of the city."),
+        ("country_id", "INT", "Foreign key referencing `country.country_id`."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "country": [
+        ("country_id", "INT", "Primary key, unique identifier for each country."),
+        ("country", "VARCHAR", "Name of the country."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "customer": [
+        ("customer_id", "INT", "Primary key, unique identifier for each customer."),
+        ("store_id", "INT", "Foreign key referencing `store.store_id`."),
+        ("first_name", "VARCHAR", "First name of the customer."),
+        ("last_name", "VARCHAR", "Last name of the customer."),
+        ("email", "VARCHAR", "Email address of the customer."),
+        ("address_id", "INT", "Foreign key referencing `address.address_id`."),
+        ("active", "BOOLEAN", "Indicates if the customer is active."),
+        ("create_date", "DATETIME", "Date the customer was created."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "rental": [
+        ("rental_id", "INT", "Primary key, unique identifier for each rental."),
+        ("rental_date", "DATETIME", "Date and time the rental was made."),
+        ("inventory_id", "INT", "Foreign key referencing `inventory.inventory_id`."),
+        ("customer_id", "INT", "Foreign key referencing `customer.customer_id`."),
+        ("return_date", "DATETIME", "Date and time the rental was returned."),
+        ("staff_id", "INT", "Foreign key referencing `staff.staff_id`."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+    "payment": [
+        ("payment_id", "INT", "Primary key, unique identifier for each payment."),
+        ("customer_id", "INT", "Foreign key referencing `customer.customer_id`."),
+        ("staff_id", "INT", "Foreign key referencing `staff.staff_id`."),
+        ("rental_id", "INT", "Foreign key referencing `rental.rental_id`."),
+        ("amount", "DECIMAL", "Amount of the payment."),
+        ("payment_date", "DATETIME", "Date and time of the payment."),
+        ("last_update", "TIMESTAMP", "Timestamp of the last update."),
+    ],
+}
+
+
+# Define Few-Shot Examples
+few_shot_examples = [
+    {
+        "question": "What is the average rental duration for all films?",
+        "sql_query": "SELECT AVG(rental_duration) AS average_rental_duration FROM film;",
+        "expected_result": "The average rental duration for all films is 4.98 days."
+    },
+    {
+        "question": "List all the film titles.",
+        "sql_query": "SELECT title FROM film;",
+        "expected_result": "Here are the titles of all films in the database."
+    },
+    {
+        "question": "How many films are there in each category?",
+        "sql_query": """
+            SELECT c.name AS category_name, COUNT(f.film_id) AS num_films
+            FROM category c
+            JOIN film_category fc ON c.category_id = fc.category_id
+            JOIN film f ON fc.film_id = f.film_id
+            GROUP BY c.name;
+        """,
+        "expected_result": "Here is the count of films in each category."
+    },
+    {
+        "question": "Show the top 5 films with the longest rental duration.",
+        "sql_query": """
+            SELECT title, rental_duration
+            FROM film
+            ORDER BY rental_duration DESC
+            LIMIT 5;
+        """,
+        "expected_result": "Here are the top 5 films with the longest rental duration."
+    },
+    {
+        "question": "What is the total revenue generated from film rentals?",
+        "sql_query": """
+            SELECT SUM(p.amount) AS total_revenue
+            FROM payment p
+            JOIN rental r ON p.rental_id = r.rental_id;
+        """,
+        "expected_result": "The total revenue generated from film rentals is $XXXX."
+    }
+]
+
+# Words in a question that point at a table, beyond the table name itself
+TABLE_KEYWORDS = {
+    "actor": {"actor", "actors", "actress", "actresses", "cast", "star", "stars"},
+    "film": {"film", "films", "movie", "movies", "title", "titles", "rating", "length", "release", "duration"},
+    "film_actor": set(),
+    "category": {"category", "categories", "genre", "genres"},
+    "film_category": set(),
+    "language": {"language", "languages"},
+    "inventory": {"inventory", "copy", "copies", "stock"},
+    "store": {"store", "stores", "shop", "shops"},
+    "staff": {"staff", "employee", "employees", "manager", "managers"},
+    "address": {"address", "addresses", "district", "postal", "phone"},
+    "city": {"city", "cities"},
+    "country": {"country", "countries"},
+    "customer": {"customer", "customers", "client", "clients"},
+    "rental": {"rental", "rentals", "rent", "rented", "renting", "return", "returned"},
+    "payment": {"payment", "payments", "revenue", "paid", "amount", "sales", "income", "spent"},
+}
+
+PROMPT_HEADER = """
+        You are interacting with the Sakila database, which contains several key tables:
+        
+        """
+
+PROMPT_FOOTER = """
+        You will be provided with questions, and your task is to generate the appropriate SQL query to retrieve the required data from the Sakila database.
+
+        Here are some examples:
+
+    """
+
+_FK_PATTERN = re.compile(r"Foreign key referencing `(\w+)\.(\w+)`")
+
+
+# Function to build table -> set of tables it references through a foreign key
+def foreign_key_graph(schema):
+    graph = {table: set() for table in schema}
+    for table, columns in schema.items():
+        for _, _, description in columns:
+            match = _FK_PATTERN.search(description)
+            if match and match.group(1) in graph and match.group(1) != table:
+                graph[table].add(match.group(1))
+    return graph
+
+
+# Function to find the tables on a shortest join path between two tables
+def join_path(graph, start, end):
+    neighbours = {table: set(refs) for table, refs in graph.items()}
+    for table, refs in graph.items():
+        for ref in refs:
+            neighbours[ref].add(table)
+    previous = {start: None}
+    queue = [start]
+    for table in queue:
+        if table == end:
+            break
+        for neighbour in sorted(neighbours[table]):
+            if neighbour not in previous:
+                previous[neighbour] = table
+                queue.append(neighbour)
+    if end not in previous:
+        return set()
+    path = set()
+    while end is not None:
+        path.add(end)
+        end = previous[end]
+    return path
+
+
+# Function to render one table's column list; done once per schema and reused for every prompt
+def render_table(table, columns, rows=None, indent="           "):
+    lines = [f"**{table.title()}:**" + (f" (~{rows} rows)" if rows else "")]
+    for column, column_type, description in columns:
+        lines.append(f"{indent}- `{column}` ({column_type}): {description}")
+    return "\n".join(lines)
+
+
+@lru_cache(maxsize=8)
+def _rendered_tables(schema_key):
+    schema = _schemas[schema_key]
+    row_counts = _row_counts.get(schema_key, {})
+    return {table: render_table(table, columns, row_counts.get(table)) for table, columns in schema.items()}
+
+
+# Function to assemble the schema part of the prompt for a set of tables
+@lru_cache(maxsize=256)
+def _schema_section(schema_key, tables):
+    rendered = _rendered_tables(schema_key)
+    blocks = [f"{number}. {rendered[table]}" for number, table in enumerate(tables, start=1)]
+    return PROMPT_HEADER + "\n\n        ".join(blocks) + "\n" + PROMPT_FOOTER
+
+
+# Schemas are registered by key so their rendered text and FK graph are computed once
+_schemas = {}
+_graphs = {}
+_row_counts = {}
+
+
+def register_schema(key, schema, row_counts=None):
+    _schemas[key] = schema
+    _graphs[key] = foreign_key_graph(schema)
+    _row_counts[key] = row_counts or {}
+    _rendered_tables.cache_clear()
+    _schema_section.cache_clear()
+
+
+register_schema("static", SCHEMA)
+
+
+# Function to render an example the way construct_prompt_template always has
+def render_example(example):
+    text = f"    \n\nQuestion: {example['question']}\n    SQL Query: {example['sql_query']}"
+    if example.get("expected_result"):
+        text += f"\n    Expected Result: {example['expected_result']}"
+    return text
+
+
+# Construct Prompt Template for Few-Shot Learning
+def construct_prompt_template(few_shot_examples, schema_key="static"):
+    prompt = _schema_section(schema_key, tuple(_schemas[schema_key]))
+    for example in few_shot_examples:
+        prompt += render_example(example)
+    return prompt
+
+
+# Rough token count (about four characters per token for English and SQL)
+def estimate_tokens(text):
+    return math.ceil(len(text) / 4)
+
+
+_example_embeddings = {}
+
+
+def _embed_examples(examples):
+    key = tuple(example["question"] for example in examples)
+    if key not in _example_embeddings:
+        import resources
+        _example_embeddings[key] = resources.get_transformer_model().encode(list(key), normalize_embeddings=True)
+    return _example_embeddings[key]
+
+
+# Function to pick the k examples closest to the question, from the static few-shot
+# examples plus any past questions already found by semantic_search
+def select_examples(question_embedding, k=EXAMPLES_K, similar_queries=(), examples=few_shot_examples):
+    query = np.asarray(question_embedding, dtype="float32").reshape(-1)
+    query = query / (np.linalg.norm(query) or 1.0)
+    scored = list(zip(_embed_examples(examples) @ query, examples))
+    for record in similar_queries:
+        if record.get("question") and record.get("sql_query"):
+            # Squared L2 distance between unit vectors is 2 - 2 * cosine
+            scored.append((1.0 - record["distance"] / 2.0, record))
+    scored.sort(key=lambda pair: pair[0], reverse=True)
+
+    selected, seen = [], set()
+    for _, example in scored:
+        key = example["question"].strip().lower()
+        if key not in seen:
+            seen.add(key)
+            selected.append(example)
+        if len(selected) >= k:
+            break
+    return selected
+
+
+# Function to choose the tables a question is likely to need: the ones it mentions,
+# the tables they reference by foreign key, and whatever lies on the join paths
+# between them. Falls back to the tables of the chosen examples, then the full schema.
+def relevant_tables(question, examples=(), schema_key="static"):
+    schema = _schemas[schema_key]
+    graph = _graphs[schema_key]
+    words = set(re.findall(r"[a-z]+", question.lower()))
+    matched = set()
+    for table in schema:
+        keywords = TABLE_KEYWORDS.get(table, set()) | {table, table + "s"}
+        if words & keywords:
+            matched.add(table)
+    if not matched:
+        for example in examples:
+            matched.update(table for table in tables_read(example["sql_query"]) if table in schema)
+    if not matched:
+        return tuple(schema)
+
+    tables = set(matched)
+    for table in matched:
+        tables |= graph[table]
+    for start in matched:
+        for end in matched:
+            if start < end:
+                tables |= join_path(graph, start, end)
+    return tuple(table for table in schema if table in tables)
+
+
+# Function to build the prompt for one question: the closest examples and only the tables
+# it is likely to touch. Returns the prompt and a summary with token counts before/after.
+def build_prompt(question, question_embedding, similar_queries=(), k=EXAMPLES_K, schema_key="static"):
+    examples = select_examples(question_embedding, k, similar_queries)
+    if PRUNE_SCHEMA:
+        tables = relevant_tables(question, examples, schema_key)
+    else:
+        tables = tuple(_schemas[schema_key])
+    prompt = _schema_section(schema_key, tables)
+    for example in examples:
+        prompt += render_example(example)
+
+    full_tokens = _full_prompt_tokens(schema_key) + estimate_tokens(question)
+    tokens = estimate_tokens(prompt) + estimate_tokens(question)
+    return prompt, {
+        "tables": list(tables),
+        "examples": [example["question"] for example in examples],
+        "prompt_tokens": tokens,
+        "full_prompt_tokens": full_tokens,
+        "tokens_saved": full_tokens - tokens,
+    }
+
+
+@lru_cache(maxsize=8)
+def _full_prompt_tokens(schema_key):
+    return estimate_tokens(construct_prompt_template(few_shot_examples, schema_key))
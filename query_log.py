@@ -0,0 +1,144 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from functools import lru_cache
+
+from sql_guard import tokenize
+
+# Log of every statement the pipeline runs, one JSON line each, for index_advisor.py.
+# Each line has the statement's shape (literals replaced by ?, IN lists collapsed) and
+# a shape_id, so different questions that produce the same query group together, plus
+# how long it took to open the result, the rows in the first page and the rows the
+# plan examines (the guard's EXPLAIN estimate; None on SQLite or with the guard off).
+
+ENABLED = os.getenv("QUERY_LOG_ENABLED", "1") != "0"
+QUERY_LOG = os.getenv("QUERY_LOG", "./query_log.jsonl")
+# Only statements at least this slow (in seconds) are logged; failures always are
+MIN_SECONDS = float(os.getenv("QUERY_LOG_MIN_SECONDS", "0"))
+
+_IN_LIST = re.compile(r"\bIN\(\?(?:, \?)*\)")
+
+
+# Function to reduce a statement to its shape: literals become ?, identifiers are
+# unquoted, case and whitespace are normalized and IN (...) lists of any length match
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    parts = []
+    previous = None
+    for kind, text, _, _ in tokenize(sql):
+        if kind in ("string", "number"):
+            text = "?"
+        elif kind == "ident":
+            text = text[1:-1].replace("``", "`").upper()
+            kind = "word"
+        elif text == ";":
+            continue
+        if previous is not None and not (
+            previous[1] in ("(", ".") or text in (",", ")", ".")
+            or (text == "(" and previous[0] == "word")
+            or (previous[1] in "<>!=" and text in "<>=")
+        ):
+            parts.append(" ")
+        parts.append(text)
+        previous = (kind, text)
+    shape = _IN_LIST.sub("IN(?+)", "".join(parts))
+    return shape, hashlib.sha1(shape.encode("utf-8")).hexdigest()[:16]
+
+
+_lock = threading.Lock()
+
+
+# Function to log one execution. seconds covers opening the result and reading its
+# first page; error is the exception's class name when the statement failed.
+def record(sql, database, engine, seconds, rows, rows_examined=None, cached=False, more=False, error=None):
+    if not ENABLED or (seconds < MIN_SECONDS and error is None):
+        return
+    shape, shape_id = fingerprint(sql)
+    line = json.dumps({
+        "ts": time.time(),
+        "shape_id": shape_id,
+        "shape": shape,
+        "sql": sql,
+        "database": database,
+        "engine": engine,
+        "seconds": seconds,
+        "rows": rows,
+        "more": more,
+        "rows_examined": rows_examined,
+        "cached": cached,
+        "error": error,
+    }, default=str) + "\n"
+    with _lock, open(QUERY_LOG, "a", encoding="utf-8") as f:
+        f.write(line)
+
+
+# Function to read the log, skipping lines cut short by a crash
+def read_log(path=QUERY_LOG):
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+
+def _percentile(values, p):
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+# Function to group log entries by shape (and database). Result-cache hits count towards
+# how often a shape is asked for but not towards its time, since they never reach the
+# database. The example is the slowest execution. Sorted by total time, slowest first.
+def summarize(entries):
+    groups = {}
+    for entry in entries:
+        key = (entry["shape_id"], entry["database"])
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {
+                "shape_id": entry["shape_id"],
+                "shape": entry["shape"],
+                "database": entry["database"],
+                "engine": entry["engine"],
+                "count": 0,
+                "cached": 0,
+                "errors": 0,
+                "seconds": [],
+                "rows_examined": None,
+                "example": None,
+                "example_seconds": -1.0,
+            }
+        group["count"] += 1
+        if entry.get("cached"):
+            group["cached"] += 1
+            continue
+        if entry.get("error"):
+            group["errors"] += 1
+        group["seconds"].append(entry["seconds"])
+        if entry.get("rows_examined") is not None:
+            group["rows_examined"] = max(group["rows_examined"] or 0, entry["rows_examined"])
+        if entry["seconds"] > group["example_seconds"]:
+            group["example"] = entry["sql"]
+            group["example_seconds"] = entry["seconds"]
+
+    shapes = []
+    for group in groups.values():
+        seconds = group.pop("seconds")
+        group.pop("example_seconds")
+        group["executions"] = len(seconds)
+        group["total_seconds"] = sum(seconds)
+        group["mean_seconds"] = group["total_seconds"] / len(seconds) if seconds else 0.0
+        group["p95_seconds"] = _percentile(seconds, 95) if seconds else 0.0
+        group["max_seconds"] = max(seconds) if seconds else 0.0
+        shapes.append(group)
+    shapes.sort(key=lambda group: group["total_seconds"], reverse=True)
+    return shapes
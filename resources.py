@@ -0,0 +1,167 @@
+import os
+import time
+import threading
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Streamlit re-runs the app script on every interaction, but imported modules stay
+# loaded, so anything kept here is created once per server process and shared by
+# every session. Heavy libraries (torch, faiss, chromadb, genai) are only imported
+# the first time the resource that needs them is requested.
+
+# Set when this module is first imported, i.e. at server cold start
+PROCESS_START = time.perf_counter()
+
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-pro")
+CHROMA_HOST = os.getenv("CHROMA_HOST", "127.0.0.1")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
+CHROMA_COLLECTION = os.getenv("CHROMA_COLLECTION", "query_embeddings")
+
+# "torch" runs EMBEDDING_MODEL with sentence-transformers; "onnx" (experimental) runs
+# the export in EMBEDDING_ONNX_DIR with onnxruntime (see onnx_encoder)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# Threads the encoder may use; 0 leaves the library default (all cores)
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+
+_resources = {}
+_locks = {}
+_locks_guard = threading.Lock()
+_load_times = {}
+
+
+# Function to create a resource on first use; concurrent callers wait for the same instance
+def get_or_create(name, factory):
+    resource = _resources.get(name)
+    if resource is not None:
+        return resource
+    with _locks_guard:
+        lock = _locks.setdefault(name, threading.Lock())
+    with lock:
+        if name not in _resources:
+            start = time.perf_counter()
+            _resources[name] = factory()
+            _load_times[name] = time.perf_counter() - start
+        return _resources[name]
+
+
+# Function to load the question encoder chosen by EMBEDDING_BACKEND. Both kinds have
+# SentenceTransformer's encode() and get_sentence_embedding_dimension().
+def load_encoder(threads=None, backend=EMBEDDING_BACKEND):
+    if threads is None:
+        threads = EMBEDDING_THREADS
+    if backend == "onnx":
+        from onnx_encoder import OnnxEncoder
+        return OnnxEncoder(threads=threads)
+    if backend != "torch":
+        raise ValueError(f"Unknown EMBEDDING_BACKEND: {backend}")
+    from sentence_transformers import SentenceTransformer
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+
+def _load_gemini_model():
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    return genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+
+def _load_chroma_client():
+    import chromadb
+    from chromadb.config import Settings
+    settings = Settings(
+        chroma_api_impl="rest",
+        chroma_server_host=CHROMA_HOST,
+        chroma_server_http_port=CHROMA_PORT
+    )
+    return chromadb.Client(settings)
+    # OR alternatively use PersistentClient:
+    # return chromadb.PersistentClient(path="./chroma_db")
+
+
+# Function to get the shared encoder used for question embeddings
+def get_transformer_model():
+    return get_or_create("transformer_model", load_encoder)
+
+
+# Function to name the shared encoder, so embeddings from different encoders are cached apart
+def embedding_model_id():
+    return getattr(get_transformer_model(), "cache_id", f"torch:{EMBEDDING_MODEL_NAME}")
+
+
+# Function to get the shared Gemini model
+def get_gemini_model():
+    return get_or_create("gemini_model", _load_gemini_model)
+
+
+# Function to get the shared LLM backend chosen by LLM_BACKEND (see llm_backend)
+def get_llm_backend():
+    def load():
+        from llm_backend import create_backend
+        return create_backend()
+
+    return get_or_create("llm_backend", load)
+
+
+# Function to get the shared ChromaDB client
+def get_chroma_client():
+    return get_or_create("chroma_client", _load_chroma_client)
+
+
+# Function to get the query_embeddings collection
+def get_db_collection():
+    return get_or_create("db_collection", lambda: get_chroma_client().get_or_create_collection(CHROMA_COLLECTION))
+
+
+def _load_query_index():
+    from faiss_index import load_query_index
+    return load_query_index(get_transformer_model().get_sentence_embedding_dimension())
+
+
+# Function to get the persistent FAISS index, synced with any rows added to ChromaDB since last call
+def get_query_index():
+    index = get_or_create("query_index", _load_query_index)
+    index.sync(get_db_collection())
+    return index
+
+
+# Function to load the embedding model and the FAISS index without opening any
+# connections or running the model, for a parent process about to fork workers.
+# onnxruntime starts its thread pool when a session is created, and those threads
+# would not exist in the children, so with EMBEDDING_BACKEND=onnx each worker loads its own.
+def preload_models():
+    if EMBEDDING_BACKEND != "torch":
+        return
+    get_transformer_model()
+    get_or_create("query_index", _load_query_index)
+
+
+# Function to start loading the embedding model and index in the background, so the
+# page renders straight away and the first question does not pay for the load
+def warm_up():
+    def run():
+        try:
+            get_transformer_model()
+            get_query_index()
+        except Exception as e:
+            print(f"Warm-up failed: {e}")
+
+    def start():
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    get_or_create("warm_up", start)
+
+
+# Function to report seconds since cold start and how long each resource took to load
+def timings():
+    return {
+        "uptime": time.perf_counter() - PROCESS_START,
+        "load_times": dict(_load_times),
+    }
@@ -0,0 +1,327 @@
+import os
+import re
+import time
+import zlib
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+from db_pool import row_size
+
+ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") != "0"
+
+# Default lifetime of a cached result. Writes made through this app invalidate the
+# tables they touch straight away; the TTL bounds staleness from writes made elsewhere.
+DEFAULT_TTL = float(os.getenv("RESULT_CACHE_TTL", "300"))
+
+# In-memory tier budget, and the largest single result worth caching
+MEMORY_MAX_BYTES = int(os.getenv("RESULT_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+ENTRY_MAX_BYTES = int(os.getenv("RESULT_CACHE_ENTRY_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# Optional on-disk tier: zlib-compressed pickles, one file per entry. Empty disables it.
+DISK_DIR = os.getenv("RESULT_CACHE_DIR", "")
+DISK_MAX_BYTES = int(os.getenv("RESULT_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+
+_TABLE_PATTERN = re.compile(r"\b(?:FROM|JOIN)\s+((?:`?\w+`?\.)?`?\w+`?)", re.IGNORECASE)
+_WRITE_PATTERN = re.compile(
+    r"^\s*(?:INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?|"
+    r"ALTER\s+TABLE|DROP\s+TABLE(?:\s+IF\s+EXISTS)?)\s+((?:`?\w+`?\.)?`?\w+`?)",
+    re.IGNORECASE
+)
+_STRING_PATTERN = re.compile(r"('(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\")")
+_COMMENT_PATTERN = re.compile(r"--[^\n]*|#[^\n]*|/\*.*?\*/", re.DOTALL)
+
+
+# Function to normalize SQL so that formatting and keyword case do not change the cache key.
+# String literals are kept exactly as written.
+def normalize_sql(sql):
+    parts = _STRING_PATTERN.split(sql.strip().rstrip(";"))
+    for i in range(0, len(parts), 2):
+        code = _COMMENT_PATTERN.sub(" ", parts[i])
+        parts[i] = re.sub(r"\s+", " ", code).lower()
+    return "".join(parts).strip()
+
+
+def fingerprint(sql, database):
+    return hashlib.sha1(f"{database}\0{normalize_sql(sql)}".encode("utf-8")).hexdigest()
+
+
+def _table_name(name):
+    return name.replace("`", "").split(".")[-1].lower()
+
+
+# Function to list the tables a query reads from
+def tables_read(sql):
+    return sorted({_table_name(name) for name in _TABLE_PATTERN.findall(_STRING_PATTERN.sub("''", sql))})
+
+
+# Function to list the tables a statement writes to (empty for reads)
+def tables_written(sql):
+    match = _WRITE_PATTERN.match(_COMMENT_PATTERN.sub(" ", sql))
+    return [_table_name(match.group(1))] if match else []
+
+
+# Two-tier cache of query results keyed by normalized SQL and database.
+#
+# Each table has a version number; an entry remembers the versions of the tables it
+# read and is treated as a miss once any of them has moved on. Invalidating a table
+# is therefore one counter bump and works the same for memory and disk entries.
+class ResultCache:
+    def __init__(self, memory_max_bytes=MEMORY_MAX_BYTES, disk_dir=DISK_DIR, disk_max_bytes=DISK_MAX_BYTES):
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "invalidations": 0,
+        }
+
+    def _current(self, entry, database):
+        if entry["expires"] < time.time():
+            return False
+        return all(self._versions.get((database, table), 0) == version for table, version in entry["tables"].items())
+
+    # Return (columns, rows) for a cached query, or None
+    def get(self, sql, database):
+        key = fingerprint(sql, database)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._current(entry, database):
+                    self._entries.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return entry["columns"], entry["rows"]
+                self._drop(key)
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is not None and self._current(entry, database):
+                self._stats["disk_hits"] += 1
+                self._insert(key, entry)
+                return entry["columns"], entry["rows"]
+            self._stats["misses"] += 1
+        if entry is not None:
+            self._remove_disk(key)
+        return None
+
+    # Versions of the tables a query reads; take them before running the query and pass
+    # them to put, so a write that lands while the query runs keeps its result out
+    def versions(self, sql, database):
+        with self._lock:
+            return {table: self._versions.get((database, table), 0) for table in tables_read(sql)}
+
+    # Cache a complete result; results larger than ENTRY_MAX_BYTES, and results whose
+    # tables were invalidated since `versions` was taken, are skipped
+    def put(self, sql, database, columns, rows, ttl=None, versions=None):
+        nbytes = sum(row_size(row) for row in rows)
+        if nbytes > ENTRY_MAX_BYTES:
+            return False
+        key = fingerprint(sql, database)
+        with self._lock:
+            current = {table: self._versions.get((database, table), 0) for table in tables_read(sql)}
+            if versions is not None and versions != current:
+                return False
+            entry = {
+                "columns": list(columns),
+                "rows": rows,
+                "database": database,
+                "tables": current,
+                "expires": time.time() + (DEFAULT_TTL if ttl is None else ttl),
+                "nbytes": nbytes,
+            }
+            self._insert(key, entry)
+            self._stats["stores"] += 1
+        self._write_disk(key, entry)
+        return True
+
+    # Drop every cached result of this database that read from any of these tables
+    def invalidate_tables(self, tables, database):
+        with self._lock:
+            for table in tables:
+                key = (database, table.lower())
+                self._versions[key] = self._versions.get(key, 0) + 1
+                self._stats["invalidations"] += 1
+            stale = [
+                key for key, entry in self._entries.items()
+                if entry.get("database") == database and not self._current(entry, database)
+            ]
+            for key in stale:
+                self._drop(key)
+        self._save_versions()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = 0
+        if self.disk_dir and os.path.isdir(self.disk_dir):
+            for name in os.listdir(self.disk_dir):
+                if name.endswith(".bin"):
+                    os.remove(os.path.join(self.disk_dir, name))
+            self._disk_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+            stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+            stats["entries"] = len(self._entries)
+            stats["memory_bytes"] = self._memory_bytes
+            stats["disk_bytes"] = self._disk_bytes or 0
+            return stats
+
+    def _insert(self, key, entry):
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = entry
+        self._memory_bytes += entry["nbytes"]
+        while self._memory_bytes > self.memory_max_bytes and self._entries:
+            old_key = next(iter(self._entries))
+            self._drop(old_key)
+            self._stats["evictions"] += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._memory_bytes -= entry["nbytes"]
+
+    # Disk tier
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key + ".bin")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        self._load_versions()
+        try:
+            with open(self._path(key), "rb") as f:
+                return pickle.loads(zlib.decompress(f.read()))
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _write_disk(self, key, entry):
+        if not self.disk_dir:
+            return
+        self._load_versions()
+        data = zlib.compress(pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._disk_bytes += len(data)
+            over = self._disk_bytes > self.disk_max_bytes
+        if over:
+            self._trim_disk()
+
+    def _remove_disk(self, key):
+        try:
+            size = os.path.getsize(self._path(key))
+            os.remove(self._path(key))
+        except OSError:
+            return
+        with self._lock:
+            self._disk_bytes -= size
+
+    # Delete the least recently written files until the disk tier is back under budget
+    def _trim_disk(self):
+        files = sorted(
+            (entry for entry in os.scandir(self.disk_dir) if entry.name.endswith(".bin")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        total = sum(entry.stat().st_size for entry in files)
+        for entry in files:
+            if total <= self.disk_max_bytes * 0.9:
+                break
+            total -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+
+    # Table versions are kept next to the disk entries so they stay valid across restarts
+    def _load_versions(self):
+        if self._disk_bytes is not None:
+            return
+        os.makedirs(self.disk_dir, exist_ok=True)
+        versions = {}
+        try:
+            with open(os.path.join(self.disk_dir, "versions.pkl"), "rb") as f:
+                versions = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+        size = sum(entry.stat().st_size for entry in os.scandir(self.disk_dir) if entry.name.endswith(".bin"))
+        with self._lock:
+            for key, version in versions.items():
+                self._versions[key] = max(self._versions.get(key, 0), version)
+            self._disk_bytes = size
+
+    def _save_versions(self):
+        if not self.disk_dir:
+            return
+        self._load_versions()
+        with self._lock:
+            versions = dict(self._versions)
+        tmp_path = os.path.join(self.disk_dir, "versions.pkl.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(versions, f)
+        os.replace(tmp_path, os.path.join(self.disk_dir, "versions.pkl"))
+
+
+# Function to replay a cached result as stream batches, so it can feed a ResultPager
+def cached_batches(columns, rows, batch_size):
+    if not rows:
+        return
+    for start in range(0, len(rows), batch_size):
+        end = "complete" if start + batch_size >= len(rows) else None
+        yield columns, rows[start:start + batch_size], end
+
+
+# Function to pass stream batches through, caching the result once it has been read in full.
+# Statements that write invalidate the tables they touched.
+#
+# The consumer may close this generator as soon as it sees the "complete" batch, so the
+# result is cached before that batch is handed out. A result whose row count is an exact
+# multiple of the batch size ends without a "complete" batch; it is cached when the
+# underlying stream runs out instead. versions are the table versions from before the
+# query was executed (ResultCache.versions); by default they are taken before the
+# first batch is read.
+def caching_batches(batches, sql, database, cache, versions=None):
+    written = tables_written(sql)
+    if versions is None:
+        versions = cache.versions(sql, database)
+    rows = []
+    nbytes = 0
+    columns = None
+    end = None
+    try:
+        for columns, batch, end in batches:
+            if rows is not None:
+                nbytes += sum(row_size(row) for row in batch)
+                if nbytes > ENTRY_MAX_BYTES:
+                    rows = None
+                else:
+                    rows.extend(batch)
+            if end == "complete" and rows is not None:
+                cache.put(sql, database, columns, rows, versions=versions)
+            yield columns, batch, end
+        if end is None and columns is not None and rows is not None:
+            cache.put(sql, database, columns, rows, versions=versions)
+    finally:
+        if written:
+            cache.invalidate_tables(written, database)
+
+
+# Shared by every session in the process
+result_cache = ResultCache()
@@ -0,0 +1,61 @@
+import os
+import time
+import threading
+import weakref
+
+# Pagers left untouched this long are closed so they stop holding a pooled connection
+PAGER_IDLE_TIMEOUT = float(os.getenv("RESULT_PAGER_IDLE_TIMEOUT", "300"))
+
+_open_pagers = weakref.WeakSet()
+_open_pagers_lock = threading.Lock()
+
+
+# Holds a streamed result between Streamlit reruns and pulls one batch per page.
+# Rows are kept as tuples with the column names stored once.
+class ResultPager:
+    def __init__(self, batches):
+        self._batches = batches
+        self.columns = []
+        self.rows = []
+        self.exhausted = False
+        self.truncated = False
+        self.last_access = time.monotonic()
+        close_idle_pagers()
+        with _open_pagers_lock:
+            _open_pagers.add(self)
+
+    # Fetch the next page of rows; returns the new rows (empty once exhausted)
+    def fetch_next(self):
+        self.last_access = time.monotonic()
+        if self.exhausted:
+            return []
+        try:
+            columns, rows, end = next(self._batches)
+        except StopIteration:
+            self.close()
+            return []
+        self.columns = list(columns)
+        self.rows.extend(rows)
+        if end:
+            self.truncated = end == "truncated"
+            self.close()
+        return rows
+
+    def close(self):
+        self.exhausted = True
+        try:
+            self._batches.close()
+        except ValueError:
+            # Still being read from another thread; it releases its connection when done
+            pass
+        with _open_pagers_lock:
+            _open_pagers.discard(self)
+
+
+# Function to close pagers nobody has read from for a while
+def close_idle_pagers(max_idle=PAGER_IDLE_TIMEOUT):
+    now = time.monotonic()
+    with _open_pagers_lock:
+        idle = [pager for pager in _open_pagers if now - pager.last_access > max_idle]
+    for pager in idle:
+        pager.close()
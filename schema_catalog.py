@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+import mysql.connector
+
+import prompt_builder
+from db_pool import get_pool
+
+# Where built catalogs are saved, and how often the live schema version is re-checked
+CATALOG_DIR = os.getenv("SCHEMA_CATALOG_DIR", "./schema_catalog")
+CHECK_INTERVAL = float(os.getenv("SCHEMA_CATALOG_CHECK_INTERVAL", "60"))
+
+# One-row fingerprint of the schema. It changes with any column, type, key or foreign
+# key change but not with ordinary inserts and updates, so it only moves on DDL.
+VERSION_SQL = """
+    SELECT COUNT(*) AS column_count,
+           COALESCE(SUM(CRC32(CONCAT_WS('|', TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, COLUMN_KEY, ORDINAL_POSITION))), 0) AS checksum,
+           (SELECT COUNT(*) FROM information_schema.KEY_COLUMN_USAGE
+            WHERE TABLE_SCHEMA = %s AND REFERENCED_TABLE_NAME IS NOT NULL) AS foreign_keys
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = %s
+"""
+
+TABLES_SQL = """
+    SELECT TABLE_NAME AS table_name, TABLE_ROWS AS table_rows, TABLE_COMMENT AS table_comment
+    FROM information_schema.TABLES
+    WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE'
+    ORDER BY TABLE_NAME
+"""
+
+COLUMNS_SQL = """
+    SELECT TABLE_NAME AS table_name, COLUMN_NAME AS column_name, DATA_TYPE AS data_type,
+           COLUMN_KEY AS column_key, COLUMN_COMMENT AS column_comment
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = %s
+    ORDER BY TABLE_NAME, ORDINAL_POSITION
+"""
+
+FOREIGN_KEYS_SQL = """
+    SELECT TABLE_NAME AS table_name, COLUMN_NAME AS column_name,
+           REFERENCED_TABLE_NAME AS referenced_table, REFERENCED_COLUMN_NAME AS referenced_column
+    FROM information_schema.KEY_COLUMN_USAGE
+    WHERE TABLE_SCHEMA = %s AND REFERENCED_TABLE_NAME IS NOT NULL
+"""
+
+
+# SQLite has no INFORMATION_SCHEMA; the same facts come from sqlite_master and PRAGMAs
+SQLITE_TABLES_SQL = "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+
+
+# Function to read the current schema version of a database
+def schema_version(pool):
+    if pool.engine == "sqlite":
+        # Bumped by SQLite on every schema change
+        return "sqlite-" + str(pool.execute("PRAGMA schema_version")[0]["schema_version"])
+    row = pool.execute(VERSION_SQL, (pool.database, pool.database))[0]
+    return f"{row['column_count']}-{row['checksum']}-{row['foreign_keys']}"
+
+
+def _build_sqlite_catalog(pool, version):
+    tables = {}
+    for row in pool.execute(SQLITE_TABLES_SQL):
+        table = row["name"]
+        columns = [
+            {
+                "name": column["name"],
+                "type": column["type"].split("(")[0].strip().upper(),
+                "primary_key": column["pk"] > 0,
+                "comment": "",
+            }
+            for column in pool.execute(f'PRAGMA table_info("{table}")')
+        ]
+        foreign_keys = {
+            key["from"]: [key["table"], key["to"]]
+            for key in pool.execute(f'PRAGMA foreign_key_list("{table}")')
+        }
+        rows = pool.execute(f'SELECT COUNT(*) AS row_count FROM "{table}"')[0]["row_count"]
+        tables[table] = {"rows": rows, "comment": "", "columns": columns, "foreign_keys": foreign_keys}
+    return {"database": pool.database, "version": version, "built_at": time.time(), "tables": tables}
+
+
+# Function to build the catalog from INFORMATION_SCHEMA:
+# table -> {"rows": estimate, "comment": ..., "columns": [...], "foreign_keys": {column: [table, column]}}
+def build_catalog(pool):
+    version = schema_version(pool)
+    if pool.engine == "sqlite":
+        return _build_sqlite_catalog(pool, version)
+    tables = {}
+    for row in pool.execute(TABLES_SQL, (pool.database,)):
+        tables[row["table_name"]] = {
+            "rows": int(row["table_rows"] or 0),
+            "comment": row["table_comment"] or "",
+            "columns": [],
+            "foreign_keys": {},
+        }
+    for row in pool.execute(COLUMNS_SQL, (pool.database,)):
+        if row["table_name"] in tables:
+            tables[row["table_name"]]["columns"].append({
+                "name": row["column_name"],
+                "type": row["data_type"].upper(),
+                "primary_key": row["column_key"] == "PRI",
+                "comment": row["column_comment"] or "",
+            })
+    for row in pool.execute(FOREIGN_KEYS_SQL, (pool.database,)):
+        if row["table_name"] in tables:
+            tables[row["table_name"]]["foreign_keys"][row["column_name"]] = [row["referenced_table"], row["referenced_column"]]
+    return {"database": pool.database, "version": version, "built_at": time.time(), "tables": tables}
+
+
+# Function to turn a catalog into the table -> (column, type, description) form used by
+# prompt_builder. Hand-written descriptions are kept where the column still exists.
+def prompt_schema(catalog):
+    known = {
+        (table, column): description
+        for table, columns in prompt_builder.SCHEMA.items()
+        for column, _, description in columns
+    }
+    schema = {}
+    for table, info in catalog["tables"].items():
+        columns = []
+        for column in info["columns"]:
+            name = column["name"]
+            reference = info["foreign_keys"].get(name)
+            if reference:
+                description = f"Foreign key referencing `{reference[0]}.{reference[1]}`."
+            elif column["primary_key"]:
+                description = known.get((table, name)) or f"Primary key of {table}."
+            else:
+                description = column["comment"] or known.get((table, name), "")
+                if "Foreign key referencing" in description:
+                    description = ""
+                description = description or name.replace("_", " ").capitalize() + "."
+            columns.append((name, column["type"], description))
+        schema[table] = columns
+    return schema
+
+
+def _catalog_path(database):
+    return os.path.join(CATALOG_DIR, f"{database}.json")
+
+
+def _load_from_disk(database):
+    try:
+        with open(_catalog_path(database), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _save_to_disk(catalog):
+    os.makedirs(CATALOG_DIR, exist_ok=True)
+    path = _catalog_path(catalog["database"])
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(catalog, f)
+    os.replace(path + ".tmp", path)
+
+
+_catalogs = {}
+_checked_at = {}
+_lock = threading.Lock()
+
+
+# Function to get the catalog for a database. The in-memory copy is used as is between
+# version checks; after that one cheap version query decides whether the copy on disk
+# (or in memory) is still good or the catalog has to be rebuilt.
+def get_catalog(host, user, password, database):
+    with _lock:
+        catalog = _catalogs.get(database)
+        if catalog is not None and time.monotonic() - _checked_at[database] < CHECK_INTERVAL:
+            return catalog
+
+        pool = get_pool(host, user, password, database)
+        version = schema_version(pool)
+        if catalog is None or catalog["version"] != version:
+            catalog = _load_from_disk(database)
+            if catalog is None or catalog["version"] != version:
+                catalog = build_catalog(pool)
+                _save_to_disk(catalog)
+            prompt_builder.register_schema(
+                _schema_key(catalog),
+                prompt_schema(catalog),
+                {table: info["rows"] for table, info in catalog["tables"].items()}
+            )
+        _catalogs[database] = catalog
+        _checked_at[database] = time.monotonic()
+        return catalog
+
+
+def _schema_key(catalog):
+    return f"{catalog['database']}@{catalog['version']}"
+
+
+# Function to get the prompt_builder schema key for a live database, falling back to
+# the hand-written schema when the database cannot be reached
+def prompt_schema_key(host, user, password, database):
+    try:
+        return _schema_key(get_catalog(host, user, password, database))
+    except (mysql.connector.Error, sqlite3.Error) as e:
+        print(f"Schema introspection failed, using the built-in schema: {e}")
+        return "static"
@@ -0,0 +1,445 @@
+import os
+import gc
+import sys
+import hmac
+import json
+import time
+import base64
+import signal
+import socket
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# HTTP API over the question pipeline, served by a pool of pre-forked workers.
+#
+#   python service.py --workers 4 --port 8600
+#   SERVICE_URL=http://127.0.0.1:8600 streamlit run 33.py
+#
+# The parent loads the embedding model and FAISS index, then forks the workers, which
+# share those pages copy-on-write and take turns accepting on one listening socket.
+# Connections (MySQL, ChromaDB, Gemini) and the pipeline's event loop are only created
+# inside the workers. Each worker runs at most SERVICE_WORKER_CONCURRENCY questions at
+# a time with up to SERVICE_QUEUE_DEPTH more waiting; anything beyond that gets a 503
+# straight away instead of queueing without bound.
+#
+#   POST /question  {"question", "use_answer_cache", "max_rows", "stream"}
+#                   -> the pipeline result as JSON; with "stream" an NDJSON stream of
+#                      {"event", "value"} lines ending with {"result": ...}
+#   POST /rows      {"rows_token", "offset", "limit"} -> a further page of a result
+#                   (re-runs the query and skips `offset` rows, see read_rows)
+#   GET  /health, /stats, /metrics              -> this worker's state
+
+SERVICE_HOST = os.getenv("SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.getenv("SERVICE_PORT", "8600"))
+# Worker processes; 0 starts one per core
+WORKERS = int(os.getenv("SERVICE_WORKERS", "0"))
+WORKER_CONCURRENCY = int(os.getenv("SERVICE_WORKER_CONCURRENCY", "4"))
+QUEUE_DEPTH = int(os.getenv("SERVICE_QUEUE_DEPTH", "16"))
+# Seconds a queued request waits for a slot before it is turned away
+QUEUE_TIMEOUT = float(os.getenv("SERVICE_QUEUE_TIMEOUT", "10"))
+# Most result rows returned by one request
+MAX_ROWS = int(os.getenv("SERVICE_MAX_ROWS", "1000"))
+# Furthest /rows may page into a result; every page re-reads the rows before it
+MAX_OFFSET = int(os.getenv("SERVICE_MAX_OFFSET", "20000"))
+MAX_BODY_BYTES = 64 * 1024
+
+# Key for signing the rows tokens that /question hands out. Unset, each start picks a
+# random one (shared by its workers, which fork after this import), so tokens from before
+# a restart stop working. Set it when several services sit behind one address.
+ROWS_TOKEN_SECRET = (os.getenv("SERVICE_SECRET", "").encode("utf-8") or os.urandom(32))
+# Seconds a rows token stays valid
+ROWS_TOKEN_TTL = float(os.getenv("SERVICE_ROWS_TOKEN_TTL", "3600"))
+
+# Seconds to wait before restarting a worker that exited, so a crash loop does not spin
+RESTART_DELAY = 1.0
+
+
+# Bounds the requests one worker runs at once and how many may wait for a slot
+class Admission:
+    def __init__(self, concurrency=WORKER_CONCURRENCY, queue_depth=QUEUE_DEPTH, timeout=QUEUE_TIMEOUT):
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self._slots = threading.Semaphore(concurrency)
+        self._lock = threading.Lock()
+        self._running = 0
+        self._waiting = 0
+        self._stats = {
+            "admitted": 0,
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0,
+        }
+
+    # Take a slot; returns False if the queue is full or no slot frees up in time
+    def acquire(self):
+        with self._lock:
+            if self._slots.acquire(blocking=False):
+                self._running += 1
+                self._stats["admitted"] += 1
+                return True
+            if self._waiting >= self.queue_depth:
+                self._stats["rejected_queue_full"] += 1
+                return False
+            self._waiting += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        with self._lock:
+            self._waiting -= 1
+            if acquired:
+                self._running += 1
+                self._stats["admitted"] += 1
+            else:
+                self._stats["rejected_timeout"] += 1
+        return acquired
+
+    def release(self):
+        with self._lock:
+            self._running -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "running": self._running, "waiting": self._waiting}
+
+
+admission = Admission()
+
+
+class RowsTokenError(Exception):
+    pass
+
+
+def _sign(payload):
+    return hmac.new(ROWS_TOKEN_SECRET, payload, hashlib.sha256).hexdigest()
+
+
+# Function to issue the token /rows takes for further pages of a result: the statement
+# /question ran, with an expiry, signed so /rows only ever runs SQL this service produced
+def issue_rows_token(sql, ttl=ROWS_TOKEN_TTL):
+    payload = base64.urlsafe_b64encode(json.dumps({"sql": sql, "expires": time.time() + ttl}).encode("utf-8"))
+    return payload.decode("ascii") + "." + _sign(payload)
+
+
+# Function to check a rows token and return its SQL; raises RowsTokenError
+def read_rows_token(token):
+    payload, _, signature = str(token or "").encode("ascii", "replace").partition(b".")
+    if not payload or not hmac.compare_digest(_sign(payload).encode("ascii"), signature):
+        raise RowsTokenError("Invalid rows token.")
+    try:
+        data = json.loads(base64.urlsafe_b64decode(payload))
+    except ValueError:
+        raise RowsTokenError("Invalid rows token.")
+    if data["expires"] < time.time():
+        raise RowsTokenError("The rows token has expired; ask the question again.")
+    return data["sql"]
+
+
+# Function to turn a pipeline result into JSON-safe data with at most max_rows rows.
+# The pager is read that far and closed; /rows serves anything after it.
+def to_response(result, max_rows):
+    pager = result["pager"]
+    columns, rows, exhausted, truncated = [], [], True, False
+    if pager is not None:
+        while len(pager.rows) < max_rows and not pager.exhausted:
+            if not pager.fetch_next():
+                break
+        columns = pager.columns
+        rows = [list(row) for row in pager.rows[:max_rows]]
+        exhausted = pager.exhausted and len(pager.rows) <= max_rows
+        truncated = pager.truncated
+        pager.close()
+    return {
+        "question": result["question"],
+        "similar_queries": result["similar_queries"],
+        "cached_answer": result["cached_answer"],
+        "prompt_info": result["prompt_info"],
+        "response": result["response"],
+        "sql": result["sql"],
+        "executed_sql": result["executed_sql"],
+        "rows_token": issue_rows_token(result["executed_sql"]) if pager is not None else None,
+        "columns": columns,
+        "rows": rows,
+        "exhausted": exhausted,
+        "truncated": truncated,
+        "warnings": result["warnings"],
+        "error": result["error"],
+        "error_stage": result["error_stage"],
+        "timings": result["timings"],
+        "trace": result["trace"].to_dict(),
+        "worker": os.getpid(),
+    }
+
+
+# Function to read rows offset .. offset + limit of a query's result. The SQL comes from
+# a rows token, so it is the statement /question already guarded and ran.
+#
+# Workers share no state and the next page may reach another worker, so no cursor is
+# kept between requests: each page runs the query again and reads past `offset` rows,
+# costing O(offset + limit) unless the result cache holds it. MAX_OFFSET bounds that.
+def read_rows(sql, offset, limit):
+    from pipeline import open_results
+
+    pager = open_results(sql)
+    try:
+        while len(pager.rows) < offset + limit and not pager.exhausted:
+            if not pager.fetch_next():
+                break
+        return {
+            "columns": pager.columns,
+            "rows": [list(row) for row in pager.rows[offset:offset + limit]],
+            "exhausted": pager.exhausted and len(pager.rows) <= offset + limit,
+            "truncated": pager.truncated,
+        }
+    finally:
+        pager.close()
+
+
+# Function to collect this worker's pool, cache and LLM client figures
+def worker_stats():
+    import resources
+    from answer_cache import answer_cache
+    from db_pool import pool_stats
+    from embedding_cache import embedding_cache
+    from result_cache import result_cache
+
+    llm_backend = resources.get_llm_backend()
+    return {
+        "pid": os.getpid(),
+        "admission": admission.stats(),
+        "pool": pool_stats(),
+        "result_cache": result_cache.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "llm_client": llm_backend.stats() if hasattr(llm_backend, "stats") else None,
+        "timings": resources.timings(),
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _json(self, status, payload, headers=None):
+        self._send(status, json.dumps(payload, default=str), headers=headers)
+
+    def _busy(self):
+        self._json(503, {"error": "The service is busy, try again shortly."}, {"Retry-After": "1"})
+
+    def do_GET(self):
+        import telemetry
+
+        path = self.path.split("?")[0]
+        if path == "/health":
+            self._json(200, {"status": "ok", "pid": os.getpid(), **admission.stats()})
+        elif path == "/stats":
+            self._json(200, worker_stats())
+        elif path == "/metrics":
+            self._send(200, telemetry.render_metrics(), "text/plain; version=0.0.4")
+        else:
+            self._json(404, {"error": f"Unknown path: {path}"})
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            self._json(413, {"error": "Request body too large."})
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._json(400, {"error": "Request body is not valid JSON."})
+            return
+        if path == "/question":
+            self._question(body)
+        elif path == "/rows":
+            self._rows(body)
+        else:
+            self._json(404, {"error": f"Unknown path: {path}"})
+
+    def _question(self, body):
+        from pipeline import answer_question
+
+        question = str(body.get("question") or "").strip()
+        if not question:
+            self._json(400, {"error": "Please enter a question."})
+            return
+        use_answer_cache = bool(body.get("use_answer_cache", True))
+        try:
+            max_rows = max(0, min(int(body.get("max_rows", MAX_ROWS)), MAX_ROWS))
+        except (TypeError, ValueError):
+            self._json(400, {"error": "max_rows must be a number."})
+            return
+        if not admission.acquire():
+            self._busy()
+            return
+        try:
+            if not body.get("stream"):
+                try:
+                    response = to_response(answer_question(question, use_answer_cache), max_rows)
+                except Exception as e:
+                    # Stage failures come back in the result; this is anything else, e.g. reading more rows
+                    self._json(500, {"error": f"Query service error: {e}"})
+                    return
+                self._json(200, response)
+                return
+            # Ends when the connection closes (HTTP/1.0), so no length is needed up front
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            connected = [True]
+
+            def write_line(payload):
+                if not connected[0]:
+                    return
+                try:
+                    self.wfile.write((json.dumps(payload, default=str) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    connected[0] = False
+
+            def on_event(kind, value):
+                write_line({"event": kind, "value": value})
+
+            try:
+                result = answer_question(question, use_answer_cache, on_event=on_event)
+                write_line({"result": to_response(result, max_rows)})
+            except Exception as e:
+                # The 200 has gone out already, so the error travels as the last line
+                write_line({"error": f"Query service error: {e}"})
+        finally:
+            admission.release()
+
+    def _rows(self, body):
+        try:
+            sql = read_rows_token(body.get("rows_token"))
+        except RowsTokenError as e:
+            self._json(403, {"error": str(e)})
+            return
+        try:
+            offset = max(0, int(body.get("offset", 0)))
+            limit = max(0, min(int(body.get("limit", MAX_ROWS)), MAX_ROWS))
+        except (TypeError, ValueError):
+            self._json(400, {"error": "offset and limit must be numbers."})
+            return
+        if offset > MAX_OFFSET:
+            self._json(400, {"error": f"offset is limited to {MAX_OFFSET} rows."})
+            return
+        if not admission.acquire():
+            self._busy()
+            return
+        try:
+            self._json(200, read_rows(sql, offset, limit))
+        except Exception as e:
+            self._json(500, {"error": f"Database error: {e}"})
+        finally:
+            admission.release()
+
+
+class _WorkerServer(ThreadingHTTPServer):
+    # Joined on shutdown, so requests in progress finish before the worker exits
+    daemon_threads = False
+
+
+# Function to serve requests from an inherited listening socket until SIGTERM
+def _run_worker(listener, threads):
+    import resources
+
+    # Ctrl+C reaches the whole process group; the parent decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Split the cores between workers; an encoder loaded after the fork picks this up too
+    resources.EMBEDDING_THREADS = threads
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+    if "faiss" in sys.modules:
+        sys.modules["faiss"].omp_set_num_threads(threads)
+
+    server = _WorkerServer(listener.getsockname(), _Handler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = listener
+    server.server_name, server.server_port = listener.getsockname()[:2]
+    # shutdown() waits for serve_forever to return, so it cannot run on this thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    server.serve_forever()
+    server.server_close()
+
+
+# Function to load the models, fork `workers` processes sharing them and restart any
+# that exit, until SIGTERM or Ctrl+C
+def serve(host=SERVICE_HOST, port=SERVICE_PORT, workers=WORKERS):
+    import resources
+
+    workers = workers or os.cpu_count() or 1
+    threads = resources.EMBEDDING_THREADS or max(1, (os.cpu_count() or 1) // workers)
+    listener = socket.create_server((host, port), backlog=1024)
+
+    start = time.perf_counter()
+    resources.preload_models()
+    print(f"Models loaded in {time.perf_counter() - start:.1f}s")
+    # Keep the loaded objects out of later collections, which would touch (and so copy) their pages
+    gc.collect()
+    gc.freeze()
+
+    children = {}
+    stopping = []
+
+    def spawn(number):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(listener, threads)
+            except BaseException as e:
+                print(f"Worker {number} failed: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = number
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for number in range(workers):
+        spawn(number)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Serving on http://{host}:{port} with {workers} workers, {threads} encoder threads each")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        number = children.pop(pid, None)
+        if number is not None and not stopping:
+            print(f"Worker {number} (pid {pid}) exited with status {status}; restarting")
+            time.sleep(RESTART_DELAY)
+            spawn(number)
+    listener.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the question pipeline over HTTP from pre-forked workers.")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker processes (0 = one per core)")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
+
+
+if __name__ == "__main__":
+    main()
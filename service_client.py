@@ -0,0 +1,161 @@
+import os
+import json
+import urllib.error
+import urllib.request
+
+# Client for service.py, shaped like the in-process pipeline: answer_question returns
+# the same result dict, with a pager that fetches further pages over HTTP and a trace
+# rebuilt from the worker's spans, so the Streamlit page renders either one unchanged.
+
+# Seconds to wait for a reply; a question can take as long as its slowest stage
+TIMEOUT = float(os.getenv("SERVICE_TIMEOUT", "120"))
+# Rows in the first response and in each further page
+PAGE_ROWS = int(os.getenv("SERVICE_PAGE_ROWS", "500"))
+
+
+class ServiceError(Exception):
+    pass
+
+
+# Pager over a result held by the service. Pages are fetched from /rows with the rows
+# token the result came with; the worker runs the query again (from its result cache
+# when it has it).
+class RemotePager:
+    def __init__(self, client, rows_token, columns, rows, exhausted, truncated):
+        self.client = client
+        self.rows_token = rows_token
+        self.columns = columns
+        self.rows = rows
+        self.exhausted = exhausted
+        self.truncated = truncated
+
+    def fetch_next(self):
+        if self.exhausted:
+            return []
+        page = self.client.fetch_rows(self.rows_token, len(self.rows), PAGE_ROWS)
+        self.columns = page["columns"] or self.columns
+        self.rows.extend(page["rows"])
+        self.exhausted = page["exhausted"] or not page["rows"]
+        self.truncated = page["truncated"]
+        return page["rows"]
+
+    def close(self):
+        self.exhausted = True
+
+
+class _RemoteSpan:
+    def __init__(self, name, duration, status="ok", attributes=None):
+        self.name = name
+        self.duration = duration
+        self.status = status
+        self.attributes = attributes or {}
+
+
+# The worker's trace as data. Spans added here (such as the page render) stay local.
+class RemoteTrace:
+    def __init__(self, data):
+        data = data or {}
+        self.trace_id = data.get("trace_id")
+        self.duration = data.get("duration")
+        self.spans = {
+            span["name"]: _RemoteSpan(span["name"], span["duration"], span["status"], span["attributes"])
+            for span in data.get("spans", [])
+        }
+
+    def add_span(self, name, duration, **attributes):
+        self.spans[name] = _RemoteSpan(name, duration, attributes=attributes)
+
+
+class ServiceClient:
+    def __init__(self, base_url, timeout=TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _open(self, path, payload=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(
+            self.base_url + path, data=data, headers={"Content-Type": "application/json"}
+        )
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get("error") or str(e)
+            except ValueError:
+                message = str(e)
+            raise ServiceError(message) from e
+        except OSError as e:
+            raise ServiceError(f"Query service unreachable at {self.base_url}: {e}") from e
+
+    def _get_json(self, path, payload=None):
+        with self._open(path, payload) as response:
+            return json.loads(response.read())
+
+    # Function to ask a question; on_event(kind, value) gets progress such as the
+    # partial LLM reply while the worker runs the pipeline
+    def answer_question(self, question, use_answer_cache=True, on_event=None):
+        payload = {
+            "question": question,
+            "use_answer_cache": use_answer_cache,
+            "max_rows": PAGE_ROWS,
+            "stream": on_event is not None,
+        }
+        try:
+            if on_event is None:
+                data = self._get_json("/question", payload)
+            else:
+                data = None
+                with self._open("/question", payload) as response:
+                    for line in response:
+                        message = json.loads(line)
+                        if "result" in message:
+                            data = message["result"]
+                        elif "error" in message:
+                            raise ServiceError(message["error"])
+                        else:
+                            on_event(message["event"], message["value"])
+                if data is None:
+                    raise ServiceError("The query service closed the connection before answering.")
+        except ServiceError as e:
+            return self._failed(question, str(e))
+        return self._result(data)
+
+    def _result(self, data):
+        result = dict(data)
+        result["pager"] = None
+        if data["rows_token"] and data["columns"]:
+            result["pager"] = RemotePager(
+                self, data["rows_token"], data["columns"], data["rows"], data["exhausted"], data["truncated"]
+            )
+        result["trace"] = RemoteTrace(data["trace"])
+        return result
+
+    @staticmethod
+    def _failed(question, error):
+        return {
+            "question": question,
+            "similar_queries": [],
+            "cached_answer": None,
+            "prompt_info": None,
+            "response": None,
+            "sql": None,
+            "executed_sql": None,
+            "pager": None,
+            "warnings": [],
+            "error": error,
+            "error_stage": "service",
+            "timings": {},
+            "trace": RemoteTrace(None),
+        }
+
+    # Function to fetch rows offset .. offset + limit of a result, given its rows token
+    def fetch_rows(self, rows_token, offset, limit):
+        return self._get_json("/rows", {"rows_token": rows_token, "offset": offset, "limit": limit})
+
+    # Function to get the stats of whichever worker answers
+    def stats(self):
+        return self._get_json("/stats")
+
+    def metrics(self):
+        with self._open("/metrics") as response:
+            return response.read().decode("utf-8")
@@ -0,0 +1,77 @@
+import re
+
+# A statement starts at one of these keywords and ends at the first semicolon that is
+# not inside a string, quoted identifier or comment
+START_PATTERN = re.compile(r"\b(WITH|SELECT|INSERT|UPDATE|DELETE|CREATE|DROP|ALTER)\s")
+
+# Longest keyword plus its trailing space, so a keyword split across chunks is still found
+_KEYWORD_OVERLAP = 8
+
+
+# Finds the first complete SQL statement in text that arrives in pieces.
+# Each feed() only scans the new text, so a long reply is scanned once overall.
+class StatementExtractor:
+    def __init__(self):
+        self.buffer = ""
+        self.start = None
+        self.pos = 0
+        self.quote = None
+        self.comment = None
+        self.statement = None
+
+    # Add the next piece of text; returns the statement once it is complete, else None
+    def feed(self, text):
+        if self.statement is not None:
+            return self.statement
+        self.buffer += text
+        if self.start is None:
+            match = START_PATTERN.search(self.buffer, max(0, self.pos - _KEYWORD_OVERLAP))
+            if not match:
+                self.pos = len(self.buffer)
+                return None
+            self.start = match.start()
+            self.pos = match.start()
+        self._scan()
+        return self.statement
+
+    def _scan(self):
+        buffer = self.buffer
+        i = self.pos
+        end = len(buffer)
+        while i < end:
+            char = buffer[i]
+            # Two-character tokens (--, /*, */) may be split across chunks; wait for the next one
+            if char in "-/*" and i + 1 == end and not self.quote and self.comment != "line":
+                break
+            if self.quote:
+                if char == "\\":
+                    i += 2
+                    continue
+                if char == self.quote:
+                    self.quote = None
+            elif self.comment == "line":
+                if char == "\n":
+                    self.comment = None
+            elif self.comment == "block":
+                if buffer.startswith("*/", i):
+                    self.comment = None
+                    i += 2
+                    continue
+            elif char in "'\"`":
+                self.quote = char
+            elif buffer.startswith("--", i) or char == "#":
+                self.comment = "line"
+            elif buffer.startswith("/*", i):
+                self.comment = "block"
+                i += 2
+                continue
+            elif char == ";":
+                self.statement = buffer[self.start:i + 1]
+                return
+            i += 1
+        self.pos = i
+
+
+# Function to extract the first SQL statement from a complete model response
+def extract_sql(response):
+    return StatementExtractor().feed(response)
@@ -0,0 +1,150 @@
+import os
+import re
+
+# Checks and rewrites generated SQL before it reaches the database:
+#   1. only a single read-only SELECT (or WITH ... SELECT) is allowed
+#   2. the outermost query gets a LIMIT, or its LIMIT is capped
+#   3. EXPLAIN estimates how many rows the plan examines; large plans warn or are rejected
+#   4. a MAX_EXECUTION_TIME hint bounds how long the statement may run
+# Every limit is set per deployment through the environment.
+
+ENABLED = os.getenv("SQL_GUARD_ENABLED", "1") != "0"
+MAX_LIMIT = int(os.getenv("SQL_GUARD_MAX_LIMIT", "10000"))
+EXPLAIN_ENABLED = os.getenv("SQL_GUARD_EXPLAIN", "1") != "0"
+WARN_ROWS = float(os.getenv("SQL_GUARD_WARN_ROWS", "1000000"))
+MAX_ROWS = float(os.getenv("SQL_GUARD_MAX_ROWS", "100000000"))
+TIMEOUT_MS = int(os.getenv("SQL_GUARD_TIMEOUT_MS", "30000"))
+
+_TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>--[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+  | (?P<ident>`(?:[^`]|``)*`)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<number>\d+(?:\.\d+)?)
+  | (?P<punct>.)
+""", re.VERBOSE | re.DOTALL)
+
+# Keywords that start a statement; the main one must be SELECT
+_STATEMENT_WORDS = {
+    "SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "DROP", "ALTER", "TRUNCATE",
+    "RENAME", "GRANT", "REVOKE", "SET", "CALL", "LOAD", "HANDLER", "DO", "LOCK", "UNLOCK",
+}
+
+# Functions that sleep, take locks or burn CPU on purpose
+_BLOCKED_FUNCTIONS = {"SLEEP", "BENCHMARK", "GET_LOCK", "RELEASE_LOCK", "RELEASE_ALL_LOCKS", "LOAD_FILE"}
+
+
+class SqlGuardError(Exception):
+    pass
+
+
+# Function to split SQL into (kind, text, start, depth) tokens, skipping whitespace and comments
+def tokenize(sql):
+    tokens = []
+    depth = 0
+    for match in _TOKEN_PATTERN.finditer(sql):
+        kind = match.lastgroup
+        if kind in ("space", "comment"):
+            continue
+        text = match.group()
+        if text == ")":
+            depth -= 1
+        tokens.append((kind, text.upper() if kind == "word" else text, match.start(), depth))
+        if text == "(":
+            depth += 1
+    return tokens
+
+
+def _check_read_only(tokens):
+    semicolons = [i for i, token in enumerate(tokens) if token[1] == ";"]
+    if semicolons and semicolons[0] != len(tokens) - 1:
+        raise SqlGuardError("Only a single statement can be run.")
+
+    main = next((i for i, (kind, text, _, depth) in enumerate(tokens)
+                 if kind == "word" and depth == 0 and text in _STATEMENT_WORDS), None)
+    if main is None or tokens[main][1] != "SELECT":
+        raise SqlGuardError("Only read-only SELECT queries can be run.")
+
+    words = [(text, i) for i, (kind, text, _, _) in enumerate(tokens) if kind == "word"]
+    for text, i in words:
+        following = tokens[i + 1][1] if i + 1 < len(tokens) else ""
+        if text == "INTO":
+            raise SqlGuardError("SELECT ... INTO is not allowed.")
+        if text == "FOR" and following in ("UPDATE", "SHARE"):
+            raise SqlGuardError("Locking reads are not allowed.")
+        if text == "LOCK" and following == "IN":
+            raise SqlGuardError("Locking reads are not allowed.")
+        if text in _BLOCKED_FUNCTIONS and following == "(":
+            raise SqlGuardError(f"{text}() is not allowed.")
+        if text in _STATEMENT_WORDS - {"SELECT", "REPLACE", "SET"} and tokens[i][3] == 0:
+            raise SqlGuardError("Only read-only SELECT queries can be run.")
+    return main
+
+
+# Returns a list of (position, old_length, new_text) edits that cap the outermost LIMIT
+def _limit_edits(tokens, max_limit):
+    limits = [i for i, (kind, text, _, depth) in enumerate(tokens) if kind == "word" and text == "LIMIT" and depth == 0]
+    if not limits:
+        last = tokens[-1]
+        return [(last[2] + len(last[1]), 0, f" LIMIT {max_limit}")]
+
+    i = limits[-1]
+    count = i + 1
+    if count + 2 < len(tokens) and tokens[count + 1][1] == ",":
+        count += 2  # LIMIT offset, count
+    if count >= len(tokens) or tokens[count][0] != "number":
+        raise SqlGuardError("LIMIT must be a number.")
+    _, text, start, _ = tokens[count]
+    if int(float(text)) > max_limit:
+        return [(start, len(text), str(max_limit))]
+    return []
+
+
+# Function to estimate the rows a plan examines from EXPLAIN output: within one SELECT
+# the tables are joined in a nested loop, so their (rows * filtered) multiply
+def explain_estimate(pool, sql):
+    per_select = {}
+    for row in pool.execute("EXPLAIN " + sql.strip().rstrip(";")):
+        rows = float(row.get("rows") or 1)
+        filtered = float(row.get("filtered") or 100.0) / 100.0
+        key = row.get("id")
+        per_select[key] = per_select.get(key, 1.0) * max(rows * filtered, 1.0)
+    return sum(per_select.values())
+
+
+# Function to check and rewrite a statement. Returns {"sql", "warnings", "estimated_rows"}
+# or raises SqlGuardError if the statement must not run.
+def guard_sql(sql, pool=None, max_limit=MAX_LIMIT, timeout_ms=TIMEOUT_MS):
+    tokens = tokenize(sql)
+    if not tokens or tokens[0][1] == ";":
+        raise SqlGuardError("The query is empty.")
+    main = _check_read_only(tokens)
+    # Drop the semicolon and anything after the last token, such as a trailing comment
+    if tokens[-1][1] == ";":
+        tokens = tokens[:-1]
+    sql = sql[:tokens[-1][2] + len(tokens[-1][1])]
+
+    edits = _limit_edits(tokens, max_limit)
+    if timeout_ms:
+        select_end = tokens[main][2] + len("SELECT")
+        edits.append((select_end, 0, f" /*+ MAX_EXECUTION_TIME({timeout_ms}) */"))
+    guarded = sql
+    for position, length, text in sorted(edits, reverse=True):
+        guarded = guarded[:position] + text + guarded[position + length:]
+    guarded = guarded.strip() + ";"
+
+    warnings = []
+    if any(length for _, length, _ in edits):
+        warnings.append(f"LIMIT reduced to {max_limit} rows.")
+    estimated_rows = None
+    # SQLite's EXPLAIN has no row estimates; there the statement timeout is the backstop
+    if pool is not None and EXPLAIN_ENABLED and pool.engine == "mysql":
+        estimated_rows = explain_estimate(pool, guarded)
+        if estimated_rows > MAX_ROWS:
+            raise SqlGuardError(
+                f"The query plan examines about {estimated_rows:,.0f} rows, over the limit of {MAX_ROWS:,.0f}."
+            )
+        if estimated_rows > WARN_ROWS:
+            warnings.append(f"The query plan examines about {estimated_rows:,.0f} rows and may be slow.")
+    return {"sql": guarded, "warnings": warnings, "estimated_rows": estimated_rows}
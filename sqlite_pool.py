@@ -0,0 +1,289 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+from db_pool import row_size, STREAM_BATCH_SIZE, STREAM_MAX_ROWS, STREAM_MAX_BYTES
+from sql_guard import tokenize
+
+# Runs the generated MySQL queries against a local SQLite copy of Sakila instead of
+# a MySQL server. Selected with DB_ENGINE=sqlite (see db_pool.get_pool).
+#
+# The file is opened read-only, memory-mapped and with a large page cache. Opening
+# a SQLite connection costs microseconds, but its page cache lives in the connection,
+# so each thread keeps one connection for the life of the process.
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "./sakila.db")
+MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", str(256 * 1024 * 1024)))
+CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", str(64 * 1024)))
+# Set when the file never changes while the app runs; skips file locking altogether
+IMMUTABLE = os.getenv("SQLITE_IMMUTABLE", "0") != "0"
+# Statements running longer than this are interrupted (MySQL gets a MAX_EXECUTION_TIME hint instead)
+TIMEOUT_MS = int(os.getenv("SQLITE_TIMEOUT_MS", "30000"))
+
+# The progress handler runs every this many virtual machine instructions
+_PROGRESS_STEPS = 10000
+
+
+def _date_part(pattern):
+    return lambda args: f"CAST(strftime('{pattern}', {args[0]}) AS INTEGER)"
+
+
+# Strip a MySQL INTERVAL argument into (amount, SQLite modifier unit)
+def _interval(text):
+    match = re.fullmatch(r"INTERVAL\s+(.+?)\s+(SECOND|MINUTE|HOUR|DAY|WEEK|MONTH|YEAR)", text.strip(), re.IGNORECASE | re.DOTALL)
+    if not match:
+        raise sqlite3.OperationalError(f"Unsupported interval: {text.strip()}")
+    amount, unit = match.group(1), match.group(2).lower()
+    if unit == "week":
+        return f"({amount}) * 7", "days"
+    return amount, unit + "s"
+
+
+def _date_add(sign):
+    def translate(args):
+        amount, unit = _interval(args[1])
+        return f"datetime({args[0]}, ({sign}({amount})) || ' {unit}')"
+    return translate
+
+
+# MySQL DATE_FORMAT code -> strftime code. Codes missing here have no strftime
+# equivalent (strftime's %M is minutes, not MySQL's month name) and are rejected.
+_DATE_FORMAT_CODES = {
+    "Y": "%Y", "m": "%m", "d": "%d", "H": "%H", "S": "%S", "j": "%j", "w": "%w", "%": "%%",
+    "i": "%M", "s": "%S", "e": "%d", "c": "%m", "T": "%H:%M:%S",
+}
+_DATE_FORMAT_NAMES = {
+    "M": "month name", "b": "abbreviated month name", "W": "weekday name", "a": "abbreviated weekday name",
+    "D": "day with suffix", "h": "12-hour hour", "I": "12-hour hour", "l": "12-hour hour", "p": "AM/PM",
+    "r": "12-hour time", "y": "two-digit year", "f": "microseconds",
+}
+
+
+def _date_format_code(match):
+    code = match.group(1)
+    if code not in _DATE_FORMAT_CODES:
+        name = _DATE_FORMAT_NAMES.get(code)
+        raise sqlite3.OperationalError(f"DATE_FORMAT %{code}" + (f" ({name})" if name else "") + " is not supported on SQLite")
+    return _DATE_FORMAT_CODES[code]
+
+
+def _date_format(args):
+    fmt = re.sub(r"%(.)", _date_format_code, args[1])
+    return f"strftime({fmt}, {args[0]})"
+
+
+def _group_concat(args):
+    match = re.fullmatch(r"(.+?)\s+SEPARATOR\s+('.*')", args[-1], re.IGNORECASE | re.DOTALL)
+    if match:
+        return f"group_concat({', '.join(args[:-1] + [match.group(1)])}, {match.group(2)})"
+    return f"group_concat({', '.join(args)})"
+
+
+# MySQL function -> builder of the SQLite expression from the translated argument texts
+_FUNCTIONS = {
+    "NOW": lambda args: "datetime('now')",
+    "CURRENT_TIMESTAMP": lambda args: "datetime('now')",
+    "CURDATE": lambda args: "date('now')",
+    "CURRENT_DATE": lambda args: "date('now')",
+    "YEAR": _date_part("%Y"),
+    "MONTH": _date_part("%m"),
+    "DAY": _date_part("%d"),
+    "DAYOFMONTH": _date_part("%d"),
+    "HOUR": _date_part("%H"),
+    "MINUTE": _date_part("%M"),
+    "DAYOFWEEK": lambda args: f"(CAST(strftime('%w', {args[0]}) AS INTEGER) + 1)",
+    "DATEDIFF": lambda args: f"CAST(julianday(date({args[0]})) - julianday(date({args[1]})) AS INTEGER)",
+    "DATE_ADD": _date_add("+"),
+    "ADDDATE": _date_add("+"),
+    "DATE_SUB": _date_add("-"),
+    "SUBDATE": _date_add("-"),
+    "DATE_FORMAT": _date_format,
+    "CONCAT": lambda args: "(" + " || ".join(args) + ")",
+    "IF": lambda args: f"(CASE WHEN {args[0]} THEN {args[1]} ELSE {args[2]} END)",
+    "CHAR_LENGTH": lambda args: f"length({args[0]})",
+    "CHARACTER_LENGTH": lambda args: f"length({args[0]})",
+    "LCASE": lambda args: f"lower({args[0]})",
+    "UCASE": lambda args: f"upper({args[0]})",
+    "SUBSTRING": lambda args: f"substr({', '.join(args)})",
+    "LOCATE": lambda args: f"instr({args[1]}, {args[0]})",
+    "LEFT": lambda args: f"substr({args[0]}, 1, {args[1]})",
+    "RIGHT": lambda args: f"substr({args[0]}, -({args[1]}))",
+    "RAND": lambda args: "(abs(random()) / 9223372036854775807.0)",
+    "GROUP_CONCAT": _group_concat,
+}
+
+
+# Function to rewrite the MySQL-only functions in a query into SQLite equivalents.
+# Anything else (LIMIT a, b, backtick identifiers, IFNULL, COALESCE, ...) SQLite already accepts.
+@lru_cache(maxsize=256)
+def translate_mysql(sql):
+    tokens = tokenize(sql)
+    parts = []
+    position = 0
+    i = 0
+    while i < len(tokens):
+        kind, text, start, _ = tokens[i]
+        if kind == "word" and text in _FUNCTIONS and i + 1 < len(tokens) and tokens[i + 1][1] == "(":
+            depth = tokens[i + 1][3]
+            close = next((j for j in range(i + 2, len(tokens)) if tokens[j][1] == ")" and tokens[j][3] == depth), None)
+            if close is None:
+                break
+            # Split the arguments at the commas directly inside the call
+            bounds = [tokens[i + 1][2] + 1]
+            bounds += [tokens[j][2] for j in range(i + 2, close) if tokens[j][1] == "," and tokens[j][3] == depth + 1]
+            bounds.append(tokens[close][2])
+            args = [sql[a + (k > 0):b].strip() for k, (a, b) in enumerate(zip(bounds, bounds[1:]))]
+            args = [translate_mysql(arg) for arg in args if arg]
+            parts.append(sql[position:start])
+            parts.append(_FUNCTIONS[text](args))
+            position = tokens[close][2] + 1
+            i = close + 1
+            continue
+        i += 1
+    parts.append(sql[position:])
+    return "".join(parts)
+
+
+def _regexp(pattern, value):
+    return value is not None and re.search(pattern, str(value), re.IGNORECASE) is not None
+
+
+# Same interface as db_pool.ConnectionPool (execute, stream, size, stats), backed by
+# one read-only SQLite connection per thread
+class SQLitePool:
+    engine = "sqlite"
+
+    def __init__(self, path, database, timeout_ms=TIMEOUT_MS):
+        self.path = os.path.abspath(path)
+        self.database = database
+        self.label = f"sqlite:{path}"
+        self.timeout_ms = timeout_ms
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._in_use = 0
+        self.stats = {
+            "checkouts": 0,
+            "created": 0,
+            "translated": 0,
+            "interrupted": 0,
+        }
+
+    def _connect(self):
+        uri = f"file:{self.path}?mode=ro" + ("&immutable=1" if IMMUTABLE else "")
+        # Cursors of a paged result may be read from a later Streamlit rerun on another thread
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
+        connection.execute(f"PRAGMA mmap_size = {MMAP_BYTES}")
+        connection.execute(f"PRAGMA cache_size = -{CACHE_KB}")
+        connection.execute("PRAGMA query_only = ON")
+        connection.execute("PRAGMA temp_store = MEMORY")
+        connection.create_function("REGEXP", 2, _regexp, deterministic=True)
+        with self._lock:
+            self._connections += 1
+            self.stats["created"] += 1
+        return connection
+
+    # This thread's connection, with the lock its steps run under
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+            self._local.step_lock = threading.Lock()
+        with self._lock:
+            self.stats["checkouts"] += 1
+        return connection, self._local.step_lock
+
+    # Run one step on a connection (executing a statement or fetching a page) with its own
+    # deadline; past it SQLite interrupts the step with OperationalError. The progress
+    # handler belongs to the connection, and an open pager's cursor and a new query may
+    # share one, so each step installs its handler under the connection's lock and
+    # removes it afterwards instead of leaving one cursor's deadline on the other.
+    @contextmanager
+    def _step(self, connection, step_lock):
+        with step_lock:
+            if not self.timeout_ms:
+                yield
+                return
+            deadline = time.monotonic() + self.timeout_ms / 1000
+
+            def check():
+                if time.monotonic() > deadline:
+                    with self._lock:
+                        self.stats["interrupted"] += 1
+                    return 1
+                return 0
+
+            connection.set_progress_handler(check, _PROGRESS_STEPS)
+            try:
+                yield
+            finally:
+                connection.set_progress_handler(None, 0)
+
+    def _prepare(self, query):
+        statement = query.strip().rstrip(";")
+        translated = translate_mysql(statement)
+        if translated != statement:
+            with self._lock:
+                self.stats["translated"] += 1
+        return translated
+
+    # Run a query and return the rows as dicts
+    def execute(self, query, params=None):
+        connection, step_lock = self._connection()
+        statement = self._prepare(query)
+        with self._step(connection, step_lock):
+            cursor = connection.execute(statement, params or ())
+            try:
+                if cursor.description is None:
+                    return []
+                columns = [column[0] for column in cursor.description]
+                return [dict(zip(columns, row)) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+
+    # Same batches as ConnectionPool.stream: (columns, rows, end) with end None, "complete" or "truncated"
+    def stream(self, query, batch_size=STREAM_BATCH_SIZE, max_rows=STREAM_MAX_ROWS, max_bytes=STREAM_MAX_BYTES):
+        connection, step_lock = self._connection()
+        statement = self._prepare(query)
+        with self._step(connection, step_lock):
+            cursor = connection.execute(statement)
+        with self._lock:
+            self._in_use += 1
+        try:
+            if cursor.description is None:
+                return
+            columns = [column[0] for column in cursor.description]
+            row_count = 0
+            byte_count = 0
+            while True:
+                requested = min(batch_size, max_rows - row_count)
+                # Each page gets the full timeout, however long the reader took to ask for it
+                with self._step(connection, step_lock):
+                    rows = cursor.fetchmany(requested)
+                    more = len(rows) == requested and row_count + len(rows) >= max_rows and cursor.fetchone() is not None
+                row_count += len(rows)
+                byte_count += sum(row_size(row) for row in rows)
+                if len(rows) < requested:
+                    if rows:
+                        yield columns, rows, "complete"
+                    return
+                if row_count >= max_rows and not more:
+                    yield columns, rows, "complete"
+                    return
+                if row_count >= max_rows or byte_count >= max_bytes:
+                    yield columns, rows, "truncated"
+                    return
+                yield columns, rows, None
+        finally:
+            # Unlike MySQL nothing is left on the wire; closing just finalizes the statement
+            cursor.close()
+            with self._lock:
+                self._in_use -= 1
+
+    def size(self):
+        with self._lock:
+            return {"size": self._connections, "idle": self._connections - self._in_use, "in_use": self._in_use}
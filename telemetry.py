@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import uuid
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stage timing spans and Prometheus-style metrics for the question flow.
+#
+# Each question gets a Trace; every stage inside it is a span with a duration, a status
+# and attributes such as token counts, row counts and cache hits. Finished spans feed
+# the metrics below, and with TRACE_LOG set each trace is appended to a JSONL file.
+# With TELEMETRY_ENABLED=0 every call returns a shared no-op object, so the hot path
+# pays for one attribute lookup per stage.
+
+ENABLED = os.getenv("TELEMETRY_ENABLED", "1") != "0"
+TRACE_LOG = os.getenv("TRACE_LOG")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+PREFIX = "sqlassist"
+
+# Seconds; the upper end covers slow LLM replies
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 10, 100, 500, 1000, 2500, 5000, 10000, 50000, 100000)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        if not ENABLED:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (plus +Inf), sum, count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_label_text(key + (('le', bound),))} {cumulative}")
+                lines.append(f"{self.name}_sum{_label_text(key)} {total}")
+                lines.append(f"{self.name}_count{_label_text(key)} {count}")
+        return lines
+
+
+stage_seconds = Histogram(f"{PREFIX}_stage_seconds", "Time spent in each stage of the question flow.")
+stage_errors = Counter(f"{PREFIX}_stage_errors_total", "Stages that failed or timed out.")
+questions = Counter(f"{PREFIX}_questions_total", "Questions answered, by outcome.")
+cache_lookups = Counter(f"{PREFIX}_cache_lookups_total", "Answer, result and embedding cache lookups, by outcome.")
+prompt_tokens = Histogram(f"{PREFIX}_prompt_tokens", "Estimated prompt size in tokens.", SIZE_BUCKETS)
+result_rows = Histogram(f"{PREFIX}_result_rows", "Rows in the first page of a result.", SIZE_BUCKETS)
+llm_request_seconds = Histogram(f"{PREFIX}_llm_request_seconds", "LLM request latency, to the reply or to the first chunk.")
+llm_client_events = Counter(f"{PREFIX}_llm_client_events_total", "LLM calls coalesced, retried and hedged.")
+
+METRICS = [
+    stage_seconds, stage_errors, questions, cache_lookups, prompt_tokens, result_rows,
+    llm_request_seconds, llm_client_events,
+]
+
+
+# Function to render every metric in the Prometheus text format
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Function to count a cache lookup; cache is "answer", "result" or "embedding"
+def record_cache(cache, hit):
+    cache_lookups.inc(cache=cache, outcome="hit" if hit else "miss")
+
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.status = "ok"
+        self.attributes = {}
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error=None):
+        self.duration = time.perf_counter() - self.start
+        if error is not None:
+            self.status = "error"
+            self.attributes["error"] = str(error)
+            stage_errors.inc(stage=self.name)
+        stage_seconds.observe(self.duration, stage=self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end(exc)
+        return False
+
+    def to_dict(self):
+        return {"name": self.name, "duration": self.duration, "status": self.status, "attributes": self.attributes}
+
+
+class Trace:
+    def __init__(self, name, **attributes):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.attributes = attributes
+        self.spans = {}
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    # Start a span; use it as a context manager or call end() on it
+    def span(self, name, **attributes):
+        span = self.spans[name] = Span(name)
+        span.set(**attributes)
+        return span
+
+    # Add attributes to a span that was already started, e.g. once its result is known
+    def annotate(self, name, **attributes):
+        span = self.spans.get(name)
+        if span is not None:
+            span.set(**attributes)
+
+    # Record a span measured elsewhere, e.g. the UI render after the pipeline returned
+    def add_span(self, name, duration, **attributes):
+        span = self.spans[name] = Span(name)
+        span.set(**attributes)
+        span.duration = duration
+        stage_seconds.observe(duration, stage=name)
+
+    def finish(self, error=None):
+        self.duration = time.perf_counter() - self.start
+        stage_seconds.observe(self.duration, stage="total")
+        questions.inc(outcome="error" if error else "ok")
+        if TRACE_LOG:
+            _write_trace(self.to_dict())
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "spans": [span.to_dict() for span in self.spans.values()],
+        }
+
+
+class _NullSpan:
+    name = None
+    duration = None
+    status = "ok"
+    attributes = {}
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class _NullTrace:
+    trace_id = None
+    duration = None
+    spans = {}
+
+    def set(self, **attributes):
+        pass
+
+    def span(self, name, **attributes):
+        return NULL_SPAN
+
+    def annotate(self, name, **attributes):
+        pass
+
+    def add_span(self, name, duration, **attributes):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+    def to_dict(self):
+        return None
+
+
+NULL_SPAN = _NullSpan()
+NULL_TRACE = _NullTrace()
+
+
+# Function to start a trace, or get the no-op trace when telemetry is disabled
+def start_trace(name, **attributes):
+    if not ENABLED:
+        return NULL_TRACE
+    return Trace(name, **attributes)
+
+
+_log_lock = threading.Lock()
+
+
+def _write_trace(record):
+    line = json.dumps(record, default=str) + "\n"
+    with _log_lock, open(TRACE_LOG, "a", encoding="utf-8") as f:
+        f.write(line)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Function to serve /metrics on METRICS_PORT from a background thread; returns the
+# server, or None when METRICS_PORT is 0 or telemetry is disabled
+def serve_metrics(port=METRICS_PORT):
+    if not port or not ENABLED:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    return server
@@ -0,0 +1,112 @@
+import os
+import json
+
+import pytest
+
+import batch
+import pipeline
+from answer_cache import question_id
+
+
+@pytest.fixture
+def asked(monkeypatch):
+    questions = []
+
+    async def run_question(question, use_answer_cache=True, events=None, store_answer=True):
+        questions.append(question)
+        failed = "fail" in question
+        return {
+            "sql": None if failed else "SELECT 1;",
+            "executed_sql": None if failed else "SELECT 1 LIMIT 100;",
+            "pager": None,
+            "cached_answer": None,
+            "error": "Could not extract SQL query from Gemini response." if failed else None,
+            "error_stage": "extract" if failed else None,
+            "warnings": [],
+            "timings": {"total": 0.01},
+        }
+
+    monkeypatch.setattr(pipeline, "run_question", run_question)
+    return questions
+
+
+def write_questions(path, questions):
+    with open(path, "w", encoding="utf-8") as f:
+        for question in questions:
+            f.write(json.dumps({"question": question}) + "\n")
+
+
+def read_answers(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_answers_each_question_once(tmp_path, asked):
+    questions = tmp_path / "questions.jsonl"
+    write_questions(questions, ["How many films?", "Which actors?", "how many  FILMS?", "please fail"])
+    output = str(tmp_path / "answers.jsonl")
+
+    summary = batch.batch(str(questions), output)
+    assert summary == {"answered": 2, "failed": 1, "duplicates": 1, "skipped": 0}
+    assert sorted(asked) == ["How many films?", "Which actors?", "please fail"]
+    answers = {answer["question"]: answer for answer in read_answers(output)}
+    assert answers["please fail"]["error_stage"] == "extract"
+    assert answers["How many films?"]["id"] == question_id("How many films?")
+
+
+def test_resume_skips_answered_questions(tmp_path, asked):
+    questions = tmp_path / "questions.jsonl"
+    output = str(tmp_path / "answers.jsonl")
+    write_questions(questions, ["How many films?", "Which actors?"])
+    batch.batch(str(questions), output)
+
+    write_questions(questions, ["How many films?", "Which actors?", "Which stores?"])
+    del asked[:]
+    summary = batch.batch(str(questions), output)
+    assert asked == ["Which stores?"]
+    assert summary["skipped"] == 2
+    assert len(read_answers(output)) == 3
+
+
+def test_restart_discards_earlier_answers(tmp_path, asked):
+    questions = tmp_path / "questions.jsonl"
+    output = str(tmp_path / "answers.jsonl")
+    write_questions(questions, ["How many films?"])
+    batch.batch(str(questions), output)
+    batch.batch(str(questions), output, restart=True)
+    assert asked == ["How many films?", "How many films?"]
+    assert len(read_answers(output)) == 1
+
+
+def test_malformed_lines_are_skipped(tmp_path, asked):
+    questions = tmp_path / "questions.jsonl"
+    questions.write_text('{"question": "How many films?"}\nnot json\n\n{"other": 1}\n', encoding="utf-8")
+    summary = batch.batch(str(questions), str(tmp_path / "answers.jsonl"))
+    assert summary["answered"] == 1
+
+
+def test_parquet_resume_asks_again_for_answers_in_a_broken_part(tmp_path, asked, monkeypatch):
+    pytest.importorskip("pyarrow")
+    pandas = pytest.importorskip("pandas")
+
+    monkeypatch.setattr(batch, "PARQUET_ROW_GROUP", 2)
+    questions = tmp_path / "questions.jsonl"
+    output = str(tmp_path / "answers.parquet")
+    write_questions(questions, [f"Question {number}?" for number in range(5)])
+    batch.batch(str(questions), output)
+    parts = sorted(os.listdir(output))
+    assert parts == ["part-00000.parquet", "part-00001.parquet", "part-00002.parquet"]
+
+    # A part cut short by a killed run, and a temporary file it left behind
+    broken = os.path.join(output, parts[1])
+    lost = set(pandas.read_parquet(broken)["question"])
+    with open(broken, "r+b") as f:
+        f.truncate(os.path.getsize(broken) - 8)
+    open(os.path.join(output, "part-00003.parquet.tmp"), "wb").close()
+
+    del asked[:]
+    summary = batch.batch(str(questions), output)
+    assert set(asked) == lost
+    assert summary["skipped"] == 3
+    assert len(pandas.read_parquet(output)) == 5
+    assert not any(name.endswith(".tmp") for name in os.listdir(output))
@@ -0,0 +1,113 @@
+from index_advisor import ParsedQuery, propose_indexes
+
+
+def table(*columns, primary="id"):
+    return {"rows": 1000, "comment": "", "foreign_keys": {}, "columns": [
+        {"name": name, "type": kind, "primary_key": name == primary} for name, kind in columns
+    ]}
+
+
+CATALOG = {"tables": {
+    "film": table(("film_id", "SMALLINT"), ("title", "VARCHAR"), ("description", "TEXT"),
+                  ("rental_rate", "DECIMAL"), ("release_year", "YEAR"), primary="film_id"),
+    "inventory": table(("inventory_id", "INT"), ("film_id", "SMALLINT"), ("store_id", "TINYINT"), primary="inventory_id"),
+    "rental": table(("rental_id", "INT"), ("inventory_id", "INT"), ("customer_id", "INT"),
+                    ("rental_date", "DATETIME"), ("return_date", "DATETIME"), primary="rental_id"),
+}}
+
+
+def parse(sql):
+    return ParsedQuery(sql, CATALOG)
+
+
+def filters(query):
+    return [(alias, column, kind, clause) for alias, column, kind, _, clause in query.filters]
+
+
+def test_tables_and_aliases():
+    query = parse("SELECT f.title FROM film AS f JOIN inventory i ON i.film_id = f.film_id, sakila.rental")
+    assert query.tables == {"f": "film", "i": "inventory", "rental": "rental"}
+
+
+def test_equality_and_range_filters():
+    query = parse("SELECT title FROM film WHERE rental_rate = 0.99 AND release_year > 2005 AND 'x' = title")
+    assert filters(query) == [
+        ("film", "rental_rate", "eq", "where"),
+        ("film", "release_year", "range", "where"),
+        ("film", "title", "eq", "where"),
+    ]
+    assert not query.where_complex
+
+
+def test_between_keeps_its_upper_bound():
+    query = parse("SELECT rental_id FROM rental WHERE rental_date BETWEEN '2005-05-01' AND '2005-06-01' AND customer_id = 5")
+    assert query.filters[0][3] == "rental_date BETWEEN '2005-05-01' AND '2005-06-01'"
+    assert filters(query) == [("rental", "rental_date", "range", "where"), ("rental", "customer_id", "eq", "where")]
+    assert not query.where_complex
+
+
+def test_between_a_column_is_not_a_range_filter():
+    query = parse("SELECT rental_id FROM rental WHERE rental_date BETWEEN '2005-05-01' AND return_date")
+    assert query.filters == []
+    assert query.where_complex
+
+
+def test_joins_in_on_and_where():
+    query = parse("SELECT f.title FROM film f JOIN inventory i ON f.film_id = i.film_id, rental r "
+                  "WHERE r.inventory_id = i.inventory_id")
+    assert ("f", "film_id", "i", "film_id") in [join[:4] for join in query.joins]
+    assert ("r", "inventory_id", "i", "inventory_id") in [join[:4] for join in query.joins]
+    assert query.where_joins == ["r.inventory_id = i.inventory_id"]
+
+
+def test_join_using():
+    query = parse("SELECT title FROM film JOIN inventory USING (film_id)")
+    assert [join[:4] for join in query.joins] == [("inventory", "film_id", "film", "film_id"), ("film", "film_id", "inventory", "film_id")]
+
+
+def test_unindexable_predicates_are_noted():
+    query = parse("SELECT rental_id FROM rental WHERE YEAR(rental_date) = 2005 AND customer_id LIKE '%5'")
+    assert query.filters == []
+    assert any("YEAR" in note for note in query.notes)
+    assert any("wildcard" in note for note in query.notes)
+
+
+def test_or_makes_the_where_complex():
+    query = parse("SELECT title FROM film WHERE rental_rate = 0.99 OR release_year = 2006")
+    assert query.filters == []
+    assert query.where_complex
+
+
+def test_subqueries_are_skipped():
+    query = parse("SELECT title FROM film WHERE film_id IN (SELECT film_id FROM inventory WHERE store_id = 1)")
+    assert query.filters == []
+    assert query.tables == {"film": "film"}
+
+
+def test_group_order_and_aggregates():
+    query = parse("SELECT i.store_id, COUNT(*) AS n, SUM(f.rental_rate) FROM inventory i JOIN film f ON f.film_id = i.film_id "
+                  "GROUP BY i.store_id ORDER BY n DESC")
+    assert query.group == [("i", "store_id")]
+    assert query.order == []
+    assert query.aggregates() == [("COUNT", "*", "COUNT(*)"), ("SUM", "f.rental_rate", "SUM(f.rental_rate)")]
+
+
+def test_star_selects_every_table():
+    assert parse("SELECT * FROM film f JOIN inventory i USING (film_id)").star == {"f", "i"}
+    assert parse("SELECT i.*, f.title FROM film f JOIN inventory i USING (film_id)").star == {"i"}
+
+
+def test_proposes_equality_then_range_columns():
+    query = parse("SELECT rental_id FROM rental WHERE rental_date > '2005-06-01' AND customer_id = 5")
+    plan = [{"alias": "rental", "access": "scan"}]
+    [proposal] = propose_indexes(query, plan, {})
+    assert proposal["key_columns"] == ["customer_id", "rental_date"]
+    # rental_id is the primary key, so the index covers the query without it
+    assert proposal["covering"]
+    assert proposal["ddl"] == "CREATE INDEX `idx_rental_customer_id_rental_date` ON `rental` (`customer_id`, `rental_date`)"
+
+
+def test_no_proposal_when_an_index_already_starts_with_the_columns():
+    query = parse("SELECT rental_id FROM rental WHERE customer_id = 5")
+    indexes = {"rental": {"idx_fk_customer_id": ["customer_id", "rental_date"]}}
+    assert propose_indexes(query, [{"alias": "rental", "access": "lookup"}], indexes) == []
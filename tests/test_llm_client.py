@@ -0,0 +1,203 @@
+import asyncio
+
+import pytest
+
+from llm_backend import TokenBucket, TransientError
+from llm_client import LLMClient
+
+
+# Backend whose replies are scripted per request: a string is returned, an exception
+# raised, and an asyncio.Event waited on before the default reply is returned
+class FakeBackend:
+    name = "fake"
+
+    def __init__(self, script=(), reply="SELECT 1;", delay=0.0):
+        self.script = list(script)
+        self.reply = reply
+        self.delay = delay
+        self.requests = 0
+        self.cancelled = 0
+
+    async def _next(self):
+        self.requests += 1
+        step = self.script.pop(0) if self.script else None
+        try:
+            await asyncio.sleep(self.delay)
+            if isinstance(step, asyncio.Event):
+                await step.wait()
+            elif isinstance(step, Exception):
+                raise step
+            elif isinstance(step, str):
+                return step
+            return self.reply
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+    async def generate(self, prompt, question):
+        return await self._next()
+
+    async def stream(self, prompt, question):
+        text = await self._next()
+        for start in range(0, len(text), 4):
+            await asyncio.sleep(0)
+            yield text[start:start + 4]
+
+
+def client(backend, **kwargs):
+    options = {"max_retries": 3, "backoff_base": 0, "hedge_percentile": 0}
+    options.update(kwargs)
+    return LLMClient(backend, **options)
+
+
+async def _read(stream):
+    return "".join([chunk async for chunk in stream])
+
+
+def test_concurrent_generates_share_one_request():
+    backend = FakeBackend(delay=0.05)
+    llm = client(backend)
+
+    async def run():
+        return await asyncio.gather(*(llm.generate("prompt", "How many films?") for _ in range(5)))
+
+    assert asyncio.run(run()) == ["SELECT 1;"] * 5
+    assert backend.requests == 1
+    assert llm.stats()["coalesced"] == 4
+
+
+def test_questions_differing_in_case_and_spacing_coalesce():
+    backend = FakeBackend(delay=0.05)
+    llm = client(backend)
+
+    async def run():
+        return await asyncio.gather(llm.generate("prompt", "How many films?"), llm.generate("prompt", "  how many   FILMS? "))
+
+    asyncio.run(run())
+    assert backend.requests == 1
+
+
+def test_different_prompts_are_not_coalesced():
+    backend = FakeBackend(delay=0.01)
+    llm = client(backend)
+
+    async def run():
+        return await asyncio.gather(llm.generate("one", "q"), llm.generate("two", "q"))
+
+    asyncio.run(run())
+    assert backend.requests == 2
+
+
+def test_late_stream_reader_gets_the_whole_reply():
+    backend = FakeBackend(reply="SELECT title FROM film;", delay=0.02)
+    llm = client(backend)
+
+    async def run():
+        first = llm.stream("prompt", "q")
+        head = await first.__anext__()
+        # Joins once the first reader has had a chunk
+        second = await _read(llm.stream("prompt", "q"))
+        return head + await _read(first), second
+
+    assert asyncio.run(run()) == ("SELECT title FROM film;", "SELECT title FROM film;")
+    assert backend.requests == 1
+
+
+def test_cancelling_every_caller_cancels_the_request():
+    gate = asyncio.Event()
+    backend = FakeBackend([gate])
+    llm = client(backend)
+
+    async def run():
+        callers = [asyncio.ensure_future(llm.generate("prompt", "q")) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert backend.cancelled == 1
+    assert llm.stats()["in_flight"] == 0
+
+
+def test_transient_errors_are_retried():
+    backend = FakeBackend([TransientError("quota"), ConnectionError("reset")])
+    llm = client(backend)
+
+    assert asyncio.run(llm.generate("prompt", "q")) == "SELECT 1;"
+    assert backend.requests == 3
+    assert llm.stats()["retries"] == 2
+
+
+def test_other_errors_are_not_retried():
+    backend = FakeBackend([ValueError("bad prompt")])
+    llm = client(backend)
+
+    with pytest.raises(ValueError):
+        asyncio.run(llm.generate("prompt", "q"))
+    assert backend.requests == 1
+    assert llm.stats()["errors"] == 1
+
+
+def test_retries_stop_after_max_retries():
+    backend = FakeBackend([TransientError("quota")] * 5)
+    llm = client(backend, max_retries=2)
+
+    with pytest.raises(TransientError):
+        asyncio.run(llm.generate("prompt", "q"))
+    assert backend.requests == 3
+
+
+def test_stream_that_fails_before_its_first_chunk_is_retried():
+    backend = FakeBackend([TransientError("overloaded")], reply="SELECT 2;")
+    llm = client(backend)
+
+    assert asyncio.run(_read(llm.stream("prompt", "q"))) == "SELECT 2;"
+    assert backend.requests == 2
+
+
+def test_slow_request_is_hedged():
+    gate = asyncio.Event()
+    backend = FakeBackend(["SELECT 1;", gate, "SELECT 2;"], delay=0.01)
+    llm = client(backend, hedge_percentile=50, hedge_min_samples=1)
+
+    async def run():
+        await llm.generate("prompt", "first")
+        return await asyncio.wait_for(llm.generate("prompt", "second"), 1)
+
+    assert asyncio.run(run()) == "SELECT 2;"
+    stats = llm.stats()
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+    # The request that lost the race is cancelled
+    assert backend.cancelled == 1
+
+
+def test_no_hedge_before_enough_samples():
+    backend = FakeBackend(delay=0.01)
+    llm = client(backend, hedge_percentile=50, hedge_min_samples=5)
+
+    async def run():
+        for number in range(3):
+            await llm.generate("prompt", f"question {number}")
+
+    asyncio.run(run())
+    assert llm.stats()["hedges"] == 0
+    assert backend.requests == 3
+
+
+def test_no_hedge_while_the_bucket_is_empty():
+    backend = FakeBackend(["SELECT 1;", "SELECT 2;"], delay=0.01)
+
+    async def run():
+        llm = client(backend, hedge_percentile=50, hedge_min_samples=1, bucket=TokenBucket(rate=0.01, burst=2))
+        await llm.generate("prompt", "first")
+        # The second request takes the last token; it is slow, but there is none left for a hedge
+        backend.delay = 0.1
+        return await llm.generate("prompt", "second"), llm.stats()
+
+    text, stats = asyncio.run(run())
+    assert text == "SELECT 2;"
+    assert stats["hedges"] == 0
+    assert backend.requests == 2
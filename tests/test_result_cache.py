@@ -0,0 +1,134 @@
+import pytest
+
+import result_cache
+from result_cache import ResultCache, caching_batches, normalize_sql, tables_read, tables_written
+
+COLUMNS = ["title"]
+ROWS = [("ACADEMY DINOSAUR",), ("ACE GOLDFINGER",)]
+
+
+@pytest.fixture
+def cache():
+    return ResultCache(disk_dir="")
+
+
+def test_hit_after_put(cache):
+    assert cache.get("SELECT title FROM film", "sakila") is None
+    assert cache.put("SELECT title FROM film", "sakila", COLUMNS, ROWS)
+    # Formatting and keyword case do not change the key; string literals do
+    assert cache.get("select  title\nfrom FILM;", "sakila") == (COLUMNS, ROWS)
+    assert cache.get("SELECT title FROM film", "other") is None
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["misses"]) == (1, 2)
+
+
+def test_normalize_keeps_string_literals():
+    assert normalize_sql("SELECT * FROM film WHERE title = 'Ace'") != normalize_sql("SELECT * FROM film WHERE title = 'ACE'")
+    assert normalize_sql("SELECT 1 -- comment\n;") == "select 1"
+
+
+def test_table_names():
+    assert tables_read("SELECT * FROM film f JOIN sakila.`inventory` i ON f.film_id = i.film_id WHERE 'FROM x'") == ["film", "inventory"]
+    assert tables_written("UPDATE `film` SET title = 'x'") == ["film"]
+    assert tables_written("/* note */ DELETE FROM sakila.rental") == ["rental"]
+    assert tables_written("SELECT * FROM film") == []
+
+
+def test_expires_after_the_ttl(cache):
+    cache.put("SELECT title FROM film", "sakila", COLUMNS, ROWS, ttl=-1)
+    assert cache.get("SELECT title FROM film", "sakila") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_invalidating_a_table_drops_the_results_that_read_it(cache):
+    cache.put("SELECT title FROM film", "sakila", COLUMNS, ROWS)
+    cache.put("SELECT first_name FROM actor", "sakila", ["first_name"], [("PENELOPE",)])
+    cache.invalidate_tables(["FILM"], "sakila")
+    assert cache.get("SELECT title FROM film", "sakila") is None
+    assert cache.get("SELECT first_name FROM actor", "sakila") is not None
+
+
+def test_invalidation_is_scoped_to_the_database(cache):
+    cache.put("SELECT title FROM film", "sakila", COLUMNS, ROWS)
+    cache.put("SELECT title FROM film", "copy", COLUMNS, ROWS)
+    cache.invalidate_tables(["film"], "copy")
+    assert cache.stats()["entries"] == 1
+    assert cache.get("SELECT title FROM film", "sakila") == (COLUMNS, ROWS)
+    assert cache.get("SELECT title FROM film", "copy") is None
+
+
+def test_result_invalidated_while_the_query_ran_is_not_stored(cache):
+    versions = cache.versions("SELECT title FROM film", "sakila")
+    cache.invalidate_tables(["film"], "sakila")
+    assert not cache.put("SELECT title FROM film", "sakila", COLUMNS, ROWS, versions=versions)
+    assert cache.get("SELECT title FROM film", "sakila") is None
+
+
+def test_entries_over_the_size_limit_are_skipped(cache, monkeypatch):
+    monkeypatch.setattr(result_cache, "ENTRY_MAX_BYTES", 10)
+    assert not cache.put("SELECT title FROM film", "sakila", COLUMNS, ROWS)
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ResultCache(memory_max_bytes=60, disk_dir="")
+    for number in range(3):
+        cache.put(f"SELECT {number} FROM film", "sakila", COLUMNS, [("x" * 20,)])
+    cache.get("SELECT 0 FROM film", "sakila")
+    cache.put("SELECT 3 FROM film", "sakila", COLUMNS, [("x" * 20,)])
+    assert cache.get("SELECT 0 FROM film", "sakila") is not None
+    assert cache.get("SELECT 1 FROM film", "sakila") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_disk_tier_survives_a_restart_and_keeps_invalidations(tmp_path):
+    first = ResultCache(disk_dir=str(tmp_path))
+    first.put("SELECT title FROM film", "sakila", COLUMNS, ROWS)
+    first.put("SELECT first_name FROM actor", "sakila", ["first_name"], [("PENELOPE",)])
+    first.invalidate_tables(["actor"], "sakila")
+
+    second = ResultCache(disk_dir=str(tmp_path))
+    assert second.get("SELECT title FROM film", "sakila") == (COLUMNS, ROWS)
+    assert second.stats()["disk_hits"] == 1
+    assert second.get("SELECT first_name FROM actor", "sakila") is None
+
+
+def batches(*pages):
+    for page, end in pages:
+        yield COLUMNS, page, end
+
+
+def test_caching_batches_stores_a_complete_result(cache):
+    stream = caching_batches(batches(([ROWS[0]], None), ([ROWS[1]], "complete")), "SELECT title FROM film", "sakila", cache)
+    assert next(stream)[2] is None
+    assert next(stream)[2] == "complete"
+    # Stored before the last batch is handed out, so closing the stream there is fine
+    stream.close()
+    assert cache.get("SELECT title FROM film", "sakila") == (COLUMNS, ROWS)
+
+
+def test_caching_batches_stores_a_result_ending_without_a_complete_batch(cache):
+    list(caching_batches(batches((ROWS, None)), "SELECT title FROM film", "sakila", cache))
+    assert cache.get("SELECT title FROM film", "sakila") == (COLUMNS, ROWS)
+
+
+def test_caching_batches_skips_truncated_and_abandoned_results(cache):
+    list(caching_batches(batches((ROWS, "truncated")), "SELECT title FROM film", "sakila", cache))
+    stream = caching_batches(batches((ROWS, None), (ROWS, "complete")), "SELECT title FROM actor", "sakila", cache)
+    next(stream)
+    stream.close()
+    assert cache.stats()["entries"] == 0
+
+
+def test_caching_batches_ignores_a_write_made_while_the_query_ran(cache):
+    def racing():
+        cache.invalidate_tables(["film"], "sakila")
+        yield COLUMNS, ROWS, "complete"
+
+    list(caching_batches(racing(), "SELECT title FROM film", "sakila", cache))
+    assert cache.get("SELECT title FROM film", "sakila") is None
+
+
+def test_writes_through_caching_batches_invalidate_their_table(cache):
+    cache.put("SELECT title FROM film", "sakila", COLUMNS, ROWS)
+    list(caching_batches(iter(()), "UPDATE film SET title = 'x'", "sakila", cache))
+    assert cache.get("SELECT title FROM film", "sakila") is None
@@ -0,0 +1,62 @@
+import pytest
+
+from sql_extract import StatementExtractor, extract_sql
+
+
+# Feed text in pieces of `size` characters; returns (statement, characters fed when it completed)
+def feed_in_pieces(text, size):
+    extractor = StatementExtractor()
+    for start in range(0, len(text), size):
+        if extractor.feed(text[start:start + size]):
+            return extractor.statement, start + size
+    return extractor.statement, None
+
+
+REPLIES = [
+    ("```sql\nSELECT title FROM film;\n```", "SELECT title FROM film;"),
+    ("Here you go:\nSELECT COUNT(*) FROM rental;\nThis counts the rentals.", "SELECT COUNT(*) FROM rental;"),
+    ("SELECT 'a;b' AS x FROM film;", "SELECT 'a;b' AS x FROM film;"),
+    ("SELECT \"it\\\"s;\" FROM film;", "SELECT \"it\\\"s;\" FROM film;"),
+    ("SELECT `odd;name` FROM film;", "SELECT `odd;name` FROM film;"),
+    ("SELECT title -- first; second\nFROM film;", "SELECT title -- first; second\nFROM film;"),
+    ("SELECT title /* a; b */ FROM film;", "SELECT title /* a; b */ FROM film;"),
+    ("SELECT title # note;\nFROM film;", "SELECT title # note;\nFROM film;"),
+    ("WITH f AS (SELECT 1) SELECT * FROM f; SELECT 2;", "WITH f AS (SELECT 1) SELECT * FROM f;"),
+]
+
+
+@pytest.mark.parametrize("reply, statement", REPLIES)
+def test_extracts_the_first_statement(reply, statement):
+    assert extract_sql(reply) == statement
+
+
+# Splitting the reply anywhere, down to one character at a time, gives the same statement
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16])
+@pytest.mark.parametrize("reply, statement", REPLIES)
+def test_streamed_in_pieces(reply, statement, size):
+    assert feed_in_pieces(reply, size)[0] == statement
+
+
+def test_completes_as_soon_as_the_semicolon_arrives():
+    reply = "SELECT title FROM film; and then a long explanation that need not be read"
+    statement, fed = feed_in_pieces(reply, 4)
+    assert statement == "SELECT title FROM film;"
+    assert fed == 24
+
+
+def test_finds_a_keyword_split_across_chunks():
+    extractor = StatementExtractor()
+    assert extractor.feed("The query is SEL") is None
+    assert extractor.feed("ECT 1 FROM film;") == "SELECT 1 FROM film;"
+
+
+def test_incomplete_or_missing_statements():
+    assert extract_sql("I cannot answer that question.") is None
+    assert extract_sql("SELECT title FROM film") is None
+    assert extract_sql("SELECT ';' FROM film") is None
+
+
+def test_feeding_after_completion_keeps_the_statement():
+    extractor = StatementExtractor()
+    extractor.feed("SELECT 1;")
+    assert extractor.feed(" SELECT 2;") == "SELECT 1;"
@@ -0,0 +1,92 @@
+import pytest
+
+import sql_guard
+from sql_guard import guard_sql, SqlGuardError
+
+
+# Stands in for a MySQL pool: EXPLAIN returns the given plan rows
+class ExplainPool:
+    engine = "mysql"
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.statements = []
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+        return self.plan
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT * FROM film", "SELECT * FROM film LIMIT 100;"),
+    ("select title from film;", "select title from film LIMIT 100;"),
+    ("SELECT * FROM film LIMIT 20;", "SELECT * FROM film LIMIT 20;"),
+    ("SELECT * FROM film LIMIT 5000", "SELECT * FROM film LIMIT 100;"),
+    ("SELECT * FROM film LIMIT 10, 5000", "SELECT * FROM film LIMIT 10, 100;"),
+    ("SELECT * FROM film; -- all films", "SELECT * FROM film LIMIT 100;"),
+    ("WITH f AS (SELECT * FROM film LIMIT 5000) SELECT * FROM f",
+     "WITH f AS (SELECT * FROM film LIMIT 5000) SELECT * FROM f LIMIT 100;"),
+    ("SELECT * FROM film WHERE title = 'DROP TABLE film; INSERT'",
+     "SELECT * FROM film WHERE title = 'DROP TABLE film; INSERT' LIMIT 100;"),
+    ("SELECT COUNT(*) FROM (SELECT DISTINCT film_id FROM inventory) t",
+     "SELECT COUNT(*) FROM (SELECT DISTINCT film_id FROM inventory) t LIMIT 100;"),
+])
+def test_accepts_and_caps_selects(sql, expected):
+    assert guard_sql(sql, max_limit=100, timeout_ms=0)["sql"] == expected
+
+
+def test_reports_a_reduced_limit():
+    assert guard_sql("SELECT * FROM film LIMIT 5000", max_limit=100, timeout_ms=0)["warnings"] == ["LIMIT reduced to 100 rows."]
+    assert guard_sql("SELECT * FROM film", max_limit=100, timeout_ms=0)["warnings"] == []
+
+
+def test_adds_the_execution_time_hint_to_the_main_select():
+    guarded = guard_sql("WITH f AS (SELECT 1) SELECT * FROM f", max_limit=100, timeout_ms=500)
+    assert guarded["sql"] == "WITH f AS (SELECT 1) SELECT /*+ MAX_EXECUTION_TIME(500) */ * FROM f LIMIT 100;"
+
+
+@pytest.mark.parametrize("sql", [
+    "",
+    ";",
+    "-- nothing here",
+    "DELETE FROM film",
+    "UPDATE film SET title = 'x'",
+    "INSERT INTO film (title) SELECT title FROM film",
+    "DROP TABLE film",
+    "SELECT * FROM film; DROP TABLE film",
+    "SELECT * INTO OUTFILE '/tmp/films' FROM film",
+    "SELECT * FROM film FOR UPDATE",
+    "SELECT * FROM film LOCK IN SHARE MODE",
+    "SELECT SLEEP(10)",
+    "SELECT BENCHMARK(1000000, MD5('x'))",
+    "SELECT LOAD_FILE('/etc/passwd')",
+    "SELECT * FROM film LIMIT ALL",
+    "WITH f AS (SELECT 1) DELETE FROM film",
+])
+def test_rejects(sql):
+    with pytest.raises(SqlGuardError):
+        guard_sql(sql, max_limit=100, timeout_ms=0)
+
+
+def test_rejects_a_plan_over_the_row_budget(monkeypatch):
+    monkeypatch.setattr(sql_guard, "MAX_ROWS", 1000)
+    # Two tables joined in one SELECT multiply: 100 * 50% * 40 = 2000 rows
+    pool = ExplainPool([{"id": 1, "rows": 100, "filtered": 50.0}, {"id": 1, "rows": 40, "filtered": 100.0}])
+    with pytest.raises(SqlGuardError, match="2,000 rows"):
+        guard_sql("SELECT * FROM film JOIN inventory USING (film_id)", pool, max_limit=100, timeout_ms=0)
+    assert pool.statements[0].startswith("EXPLAIN SELECT")
+
+
+def test_warns_about_a_large_plan(monkeypatch):
+    monkeypatch.setattr(sql_guard, "WARN_ROWS", 100)
+    pool = ExplainPool([{"id": 1, "rows": 500, "filtered": 100.0}])
+    guarded = guard_sql("SELECT * FROM film", pool, max_limit=100, timeout_ms=0)
+    assert guarded["estimated_rows"] == 500
+    assert any("may be slow" in warning for warning in guarded["warnings"])
+
+
+def test_sqlite_pools_are_not_explained():
+    pool = ExplainPool([])
+    pool.engine = "sqlite"
+    assert guard_sql("SELECT * FROM film", pool, max_limit=100, timeout_ms=0)["estimated_rows"] is None
+    assert pool.statements == []